@@ -7,24 +7,109 @@ import requests
 import sys
 import os
 import ipaddress
-from ping3 import ping
+import json
+import sqlite3
+import bisect
+import mmap
+import csv
+import argparse
+import ctypes
+import re
+import shutil
+import heapq
+import random
+import unicodedata
+import signal
+import queue
+import multiprocessing
+from functools import lru_cache
+from array import array
+from multiprocessing import shared_memory
 from colorama import Fore, Style, init
-from collections import deque, defaultdict
+from collections import deque, defaultdict, OrderedDict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs
 
 # === 配置 ===
-SAMPLE_INTERVAL = 2
-UI_REFRESH_RATE = 10
+SAMPLE_INTERVAL = 2  # 汇总周期（秒）：历史、摘要、异常检测都按此周期更新
+SAMPLE_RESOLUTION = 0.1  # 读取计数器的间隔（秒），用于记录周期内的突发峰值，最小 MIN_SAMPLE_RESOLUTION
+MIN_SAMPLE_RESOLUTION = 0.1
+UI_REFRESH_RATE = 1  # 增量渲染，只重写变化的单元格
+UI_FULL_REDRAW_INTERVAL = 60  # 每隔一段时间整屏重绘一次，修正被其他输出打乱的画面
+EVENT_LOG_SIZE = 5  # 画面底部显示的最近事件数量
 HISTORY_SIZE = 10
+PEER_IDLE_TIMEOUT = SAMPLE_INTERVAL * HISTORY_SIZE * 1.5  # 远端多久没有流量后移除（秒）
+PACKET_STATS_SLOTS = 4096  # 包到达统计的槽位数量（同时跟踪的远端上限）
+FLOW_TABLE_SLOTS = 8192  # 流表槽位数量（同时跟踪的 远端IP+本地端口+远端端口 上限）
+FLOW_IDLE_TIMEOUT = 30  # 流多久没有流量后从流表淘汰（秒）
+FLOW_WHEEL_TICK = 1.0  # 流淘汰时间轮的刻度（秒）
+FLOW_WHEEL_SIZE = 64  # 时间轮的桶数
+SHARED_TABLE_SLOTS = 16384  # 多进程抓包时共享计数表的槽位数量（2的幂，用满3/4后整表清空）
+HISTORY_SLOTS = 256  # 历史矩阵的初始行数（远端多于此数时按倍数扩容）
+# 长时间历史分级：(每桶秒数, 桶数量)，None 表示按采样间隔保存原始样本
+# 默认保留 3分钟原始样本 + 1小时的1分钟聚合 + 12小时的10分钟聚合
+HISTORY_TIERS = [(None, 90), (60, 60), (600, 72)]
+DEPARTED_HISTORY_LIMIT = 256  # 已断开连接的长时间历史最多保留多少个
+# 卡逼检测（流式异常检测）
+LAG_EWMA_ALPHA = 0.2  # 每个远端均值/方差的平滑系数
+LAG_WARMUP = 5  # 远端至少有这么多样本才参与判断
+LAG_ENTER = 2  # 连续异常样本数达到后标记
+LAG_EXIT = 5  # 连续正常样本数达到后解除
+LAG_BASELINE_MIN_PEERS = 3  # 会话基线至少需要的远端数量
+LAG_DEVIATION_Z = 6  # 流量超过会话中位数多少个稳健标准差（1.4826*MAD）算异常
+LAG_DEVIATION_RATIO = 3  # 且至少是会话中位数的倍数
+LAG_MIN_SPEED = 20  # 且至少达到的速度 (KB/s)
+LAG_MIN_PPS = 5  # 平均包速达到后才检测包速骤降/断流
+LAG_COLLAPSE_RATIO = 0.25  # 包速低于自身均值的比例算骤降
+LAG_GAP_MS = 1000  # 周期内最大到达间隔超过此值且随后恢复算断流
+LAG_LATENCY_MIN_MS = 50  # 延迟至少比自身均值高出的毫秒数
 GEO_CACHE_TTL = 3600  # 1小时缓存
+PROBE_TIMEOUT = 1.0  # ICMP延迟探测超时（秒）
+PROBE_MIN_INTERVAL = 1.0  # 同一目标两次探测的最小间隔（秒）
+PROBE_MAX_INFLIGHT = 256  # 同时等待回包的探测数量上限
+PROBE_MAX_RESTARTS = 3  # 接收线程出错后最多重新打开几次套接字
+DNS_CACHE_TTL = 86400  # 反向DNS缓存1天
+DNS_NEGATIVE_TTL = 3600  # 没有PTR记录的IP多久内不再查询
+DNS_FAILURE_TTL = 300  # 查询超时或服务器出错的IP多久内不再查询
+DNS_SERVER = "auto"  # 反向DNS服务器：auto（读取/etc/resolv.conf，读不到用系统解析）/ system / IP[:端口]
+DNS_TIMEOUT = 2.0  # 单个反向DNS查询的超时（秒）
+DNS_MAX_INFLIGHT = 16  # 同时进行的反向DNS查询数量上限
+CACHE_DB_FILE = "gtao_cache.db"  # 持久化缓存文件（重启后保留）
+CACHE_MAX_ENTRIES = 5000  # 每张缓存表最多保留的IP数量（超出按LRU淘汰）
+
+# 离线IP数据库：优先加载预编译的二进制文件，否则从文本库（iptoasn TSV / MaxMind风格CSV）编译
+OFFLINE_DB_FILE = "ipdb.bin"
+OFFLINE_DB_SOURCES = ["ip2asn-v4.tsv", "ip2asn-v4-u32.tsv", "GeoLite2-ASN-Blocks-IPv4.csv", "ipdb.csv"]
+
+# ip-api 批量查询（单次POST最多100个IP）
+GEO_BATCH_URL = "http://ip-api.com/batch"
+GEO_BATCH_FIELDS = "status,message,country,regionName,city,isp,org,as,query"
+GEO_BATCH_SIZE = 100
+GEO_BATCH_WINDOW = 0.3  # 收集待查询IP的时间窗口（秒）
+GEO_WORKERS = 2  # 查询工作线程数量
+GEO_MAX_ATTEMPTS = 5  # 单个IP最多查询几次（失败后指数退避重试）
+GEO_BACKOFF_BASE = 2.0  # 退避的初始秒数，每次失败翻倍
+GEO_BACKOFF_MAX = 120.0  # 退避的最长秒数
+GEO_NEGATIVE_TTL = 1800  # 接口明确返回失败（保留地址等）的IP多久内不再查询
+GEO_FAILURE_TTL = 300  # 重试用尽的IP多久内不再查询
 
 # UDP监控端口（GTA在线模式专用）
 UDP_PORTS_TO_MONITOR = {6672, 61455, 61456, 61457, 61458}
+
+# 无界面模式下指标服务的监听地址（/metrics 为Prometheus文本，/stream 为NDJSON流）
+METRICS_LISTEN = "127.0.0.1:9105"
+
+# 抓包后端：auto（Linux用AF_PACKET，其他系统用原始套接字）/ raw / afpacket
+CAPTURE_BACKEND = "auto"
 # ============
 
 init(autoreset=True)
 TARGET_PROCESS_KEYWORDS = ["GTA5", "GTA5_Enhanced", "RDR2"]
+PORT_SCAN_INTERVAL = 5  # 未找到游戏进程时全量扫描进程列表的间隔（秒）
+PORT_CHECK_INTERVAL = 1  # 已找到游戏进程时检查其UDP端口的间隔（秒）
+CLEANUP_JOIN_TIMEOUT = 3.0  # 退出时最多等待工作线程结束的秒数
 
-# 官方服务器配置
+# 官方服务器配置（内置规则，可用 SERVER_RULES_FILE 替换）
 TRADE_SERVER_IPS = {"192.81.245.200", "192.81.245.201"}
 CLOUD_SAVE_SERVER_IPS = {"192.81.241.171"}
 ROCKSTAR_DOMAINS = {
@@ -37,23 +122,581 @@ ROCKSTAR_DOMAINS = {
 }
 # 官方中转服务器网段
 ROCKSTAR_IP_RANGES = [
-    "52.139.",  # Rockstar官方中转服务器网段
+    "52.139.0.0/16",  # Rockstar官方中转服务器网段
+]
+TAKE_TWO_ASN_NAMES = ["take-two", "take two"]
+# 识别规则按类别匹配：精确IP > 域名后缀 > 网段 > ASN号 > ASN名称关键字
+DEFAULT_SERVER_RULES = [
+    {"type": "官方-交易服务器", "ips": sorted(TRADE_SERVER_IPS)},
+    {"type": "官方-云存档服务器", "ips": sorted(CLOUD_SAVE_SERVER_IPS)},
+    {"type": "官方-CDN服务器与云服务器", "domains": sorted(ROCKSTAR_DOMAINS)},
+    {"type": "官方-中转服务器", "cidrs": ROCKSTAR_IP_RANGES},
+    {"type": "官方-其他服务器", "asn_names": TAKE_TWO_ASN_NAMES},
 ]
+SERVER_RULES_FILE = "server_rules.json"  # 存在时替换内置规则，修改后自动重新加载
+SERVER_RULES_CHECK_INTERVAL = 2  # 检查规则文件是否修改的间隔（秒）
+ASN_NUMBER_PATTERN = re.compile(r'\s*AS(\d+)', re.IGNORECASE)
 
 # 线程锁
 data_lock = threading.Lock()
 geo_lock = threading.Lock()
 dns_lock = threading.Lock()
 
-# 存储UDP流量
-raw_bytes_map = defaultdict(int)
-geo_cache = {}
-dns_cache = {}
+
+class PersistentCache:
+    """带TTL和LRU容量上限的IP缓存，可选SQLite持久化（open之后生效）"""
+
+    FLUSH_INTERVAL = 5
+
+    def __init__(self, table, ttl, max_entries=CACHE_MAX_ENTRIES):
+        self.table = table
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.data = OrderedDict()  # ip -> (stored_at, value)，末尾为最近使用
+        self.db = None
+        self.db_lock = threading.Lock()
+        self.pending_lock = threading.Lock()  # 只保护 dirty/deleted，写盘时不持有
+        self.dirty = {}  # ip -> (stored_at, last_access, value)，待写入磁盘
+        self.deleted = set()
+        self.stop = threading.Event()
+
+    def open(self, path=CACHE_DB_FILE):
+        """打开持久化文件并预热加载未过期的条目"""
+        try:
+            db = sqlite3.connect(path, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute(f"CREATE TABLE IF NOT EXISTS {self.table} ("
+                       "ip TEXT PRIMARY KEY, stored_at REAL, last_access REAL, value TEXT)")
+            db.execute(f"DELETE FROM {self.table} WHERE stored_at < ?", (time.time() - self.ttl,))
+            db.commit()
+            rows = db.execute(f"SELECT ip, stored_at, value FROM {self.table} "
+                              f"ORDER BY last_access DESC LIMIT ?", (self.max_entries,)).fetchall()
+        except Exception as e:
+            print(f"{Fore.RED}缓存文件打开失败，使用内存缓存: {e}{Style.RESET_ALL}")
+            return 0
+
+        with self.db_lock:
+            self.db = db
+            # 按最近使用由旧到新插入，保持LRU顺序
+            for ip, stored_at, value in reversed(rows):
+                value = json.loads(value)
+                self.data[ip] = (stored_at, tuple(value) if isinstance(value, list) else value)
+        # 由后台线程定期写盘，调用方（持有 geo_lock 等）不等待SQLite
+        threading.Thread(target=self._flush_loop, daemon=True).start()
+        return len(rows)
+
+    def _flush_loop(self):
+        while not self.stop.wait(self.FLUSH_INTERVAL):
+            self.flush()
+
+    def __contains__(self, ip):
+        item = self.data.get(ip)
+        if item is None:
+            return False
+        if time.time() - item[0] >= self.ttl:
+            self.__delitem__(ip)
+            return False
+        return True
+
+    def __getitem__(self, ip):
+        stored_at, value = self.data[ip]
+        self.data.move_to_end(ip)
+        if self.db is not None:
+            with self.pending_lock:
+                self.dirty[ip] = (stored_at, time.time(), value)
+        return value
+
+    def __setitem__(self, ip, value):
+        now = time.time()
+        self.data[ip] = (now, value)
+        self.data.move_to_end(ip)
+        with self.pending_lock:
+            self.deleted.discard(ip)
+            if self.db is not None:
+                self.dirty[ip] = (now, now, value)
+            while len(self.data) > self.max_entries:
+                old_ip, _ = self.data.popitem(last=False)
+                self.dirty.pop(old_ip, None)
+                self.deleted.add(old_ip)
+
+    def __delitem__(self, ip):
+        self.data.pop(ip, None)
+        with self.pending_lock:
+            self.dirty.pop(ip, None)
+            self.deleted.add(ip)
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, ip, default=None):
+        return self[ip] if ip in self else default
+
+    def clear(self):
+        self.data.clear()
+        with self.pending_lock:
+            self.dirty.clear()
+            self.deleted.clear()
+
+    def flush(self):
+        """把变更写入磁盘（由后台线程定期调用，关闭时再调用一次）"""
+        with self.db_lock:
+            if self.db is None:
+                return
+            with self.pending_lock:
+                dirty, self.dirty = self.dirty, {}
+                deleted, self.deleted = self.deleted, set()
+            if not dirty and not deleted:
+                return
+            try:
+                self.db.executemany(
+                    f"INSERT OR REPLACE INTO {self.table} (ip, stored_at, last_access, value) VALUES (?, ?, ?, ?)",
+                    [(ip, st, la, json.dumps(v, ensure_ascii=False)) for ip, (st, la, v) in dirty.items()])
+                self.db.executemany(f"DELETE FROM {self.table} WHERE ip = ?", [(ip,) for ip in deleted])
+                self.db.commit()
+            except Exception:
+                pass
+
+    def close(self):
+        self.stop.set()
+        self.flush()
+        with self.db_lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+
+class PacketStats:
+    """每个远端的字节/包计数与包到达统计，存放在固定容量的数组中（远端 -> 槽位）
+
+    采集线程逐包更新：累计字节、包数、到达间隔、RFC 3550 式平滑抖动（J += (|D| - J) / 16，
+    D 为相邻两个到达间隔之差）以及本周期最大间隔。采样线程按周期读取。
+    只有一个抓包线程写入（多个网卡时每个线程一份，见 CaptureCounters），累加不加锁；
+    分配槽位（抓包线程）和回收槽位（采样线程）会同时修改空闲列表，持有 self.lock。
+    与 SharedCounterTable 一样同时提供 swap 接口（按累计值求字节增量），可直接作为 byte_counters。
+    """
+
+    def __init__(self, capacity=PACKET_STATS_SLOTS):
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.slots = {}  # remote -> 槽位
+        self.free = list(range(capacity - 1, -1, -1))
+        # 逐包读写的列用 list：array 每次读写都要装箱/拆箱，在包处理路径上慢一倍以上
+        self.remotes = [0] * capacity  # 槽位当前属于哪个远端（0 表示空闲）
+        self.bytes = [0] * capacity  # 累计字节数
+        self.packets = [0] * capacity  # 累计包数
+        self.last_arrival = [0.0] * capacity
+        self.last_gap = [0.0] * capacity
+        self.jitter = [0.0] * capacity
+        self.max_gap = [0.0] * capacity  # 本周期最大到达间隔
+        # 只由采样线程读写的基线列
+        self.last_bytes = array('Q', bytes(8 * capacity))  # 上次 swap 时的累计字节数
+        self.last_packets = array('Q', bytes(8 * capacity))  # 上次采样时的累计包数
+
+    def record(self, remote, length, now):
+        """记录一个到达的包（采集线程调用；FlowTable 已知槽位时直接调用 update）"""
+        slot = self.slots.get(remote)
+        if slot is None:
+            slot = self._allocate(remote)
+            if slot is None:
+                return
+        self.update(slot, length, now)
+
+    def update(self, slot, length, now):
+        """按槽位累加一个包"""
+        self.bytes[slot] += length
+        self.packets[slot] += 1
+        last = self.last_arrival[slot]
+        self.last_arrival[slot] = now
+        if last:
+            gap = now - last
+            if gap > self.max_gap[slot]:
+                self.max_gap[slot] = gap
+            prev_gap = self.last_gap[slot]
+            if prev_gap:
+                self.jitter[slot] += (abs(gap - prev_gap) - self.jitter[slot]) / 16
+            self.last_gap[slot] = gap
+
+    def _allocate(self, remote):
+        """为新远端分配槽位；另一个抓包线程可能刚刚分配过，持锁后重新检查"""
+        with self.lock:
+            slot = self.slots.get(remote)
+            if slot is None and self.free:
+                slot = self.free.pop()
+                self.remotes[slot] = remote
+                self.slots[remote] = slot
+            return slot
+
+    def swap(self):
+        """返回自上次调用以来每个远端的字节增量（只含有流量的远端）"""
+        deltas = {}
+        for remote, slot in list(self.slots.items()):
+            total = self.bytes[slot]
+            delta = total - self.last_bytes[slot]
+            if delta:
+                deltas[remote] = delta
+                self.last_bytes[slot] = total
+        return deltas
+
+    def collect(self, remote):
+        """读取本周期的 (包数, 抖动秒, 最大间隔秒)，并开始新的周期（采样线程调用）"""
+        slot = self.slots.get(remote)
+        if slot is None:
+            return 0, 0.0, 0.0
+        total = self.packets[slot]
+        delta = total - self.last_packets[slot]
+        self.last_packets[slot] = total
+        max_gap = self.max_gap[slot]
+        self.max_gap[slot] = 0.0
+        return delta, self.jitter[slot], max_gap
+
+    def release(self, remote):
+        """远端移除后回收槽位"""
+        with self.lock:
+            slot = self.slots.pop(remote, None)
+            if slot is None:
+                return
+            for column in (self.remotes, self.bytes, self.last_bytes, self.packets, self.last_packets):
+                column[slot] = 0
+            for column in (self.last_arrival, self.last_gap, self.jitter, self.max_gap):
+                column[slot] = 0.0
+            self.free.append(slot)
+
+    def clear(self):
+        for remote in list(self.slots):
+            self.release(remote)
+
+
+class TimerWheel:
+    """分层时间轮：第 k 层每个桶跨 size**k 个刻度，条目按离到期的远近放进对应的层
+
+    推进时只处理最底层当前的桶；底层每转一圈，把上一层对应的桶下放到更低的层。
+    每个条目最多下放 levels-1 次，所以到期处理的开销只与到期条目数有关，与条目总数无关。
+    超出最高层范围的条目放在最高层，下放时重新计算位置。
+    """
+
+    def __init__(self, tick=1.0, size=64, levels=3, now=None):
+        self.tick = tick
+        self.size = size
+        self.levels = levels
+        self.wheels = [[[] for _ in range(size)] for _ in range(levels)]
+        self.current = int((time.monotonic() if now is None else now) // tick)  # 已推进到的刻度
+
+    def schedule(self, item, when):
+        """安排 item 在 when 时刻到期（已经过去的时刻按下一个刻度处理）"""
+        self._insert(max(int(when // self.tick), self.current + 1), item)
+
+    def _insert(self, t, item):
+        delta = t - self.current
+        span = 1  # 当前层每个桶跨的刻度数
+        for level in range(self.levels):
+            if delta < span * self.size or level == self.levels - 1:
+                self.wheels[level][(t // span) % self.size].append((t, item))
+                return
+            span *= self.size
+
+    def advance(self, now):
+        """推进到 now，返回所有已到期的条目"""
+        target = int(now // self.tick)
+        due = []
+        if target - self.current >= self.size ** self.levels:
+            # 长时间没有推进（例如系统休眠）：直接整理所有条目
+            entries = [entry for wheel in self.wheels for bucket in wheel for entry in bucket]
+            self.wheels = [[[] for _ in range(self.size)] for _ in range(self.levels)]
+            self.current = target
+            for t, item in entries:
+                if t <= target:
+                    due.append(item)
+                else:
+                    self._insert(t, item)
+            return due
+
+        while self.current < target:
+            self.current += 1
+            t = self.current
+            # 跨过上层的桶边界时，从高到低把对应的桶下放
+            span = self.size
+            cascade = []
+            for level in range(1, self.levels):
+                if t % span:
+                    break
+                cascade.append((level, (t // span) % self.size))
+                span *= self.size
+            for level, index in reversed(cascade):
+                bucket = self.wheels[level][index]
+                self.wheels[level][index] = []
+                for entry_t, item in bucket:
+                    self._insert(entry_t, item)
+
+            bucket = self.wheels[0][t % self.size]
+            if bucket:
+                self.wheels[0][t % self.size] = []
+                due.extend(item for _, item in bucket)
+        return due
+
+
+class FlowTable:
+    """按 (远端IP, 本地端口, 远端端口) 区分的流表，收发方向分别计数，存放在固定容量的数组中
+
+    采集线程逐包累加，流键编码为一个整数（远端 << 32 | 本地端口 << 16 | 远端端口），新建的流放入队列；
+    每个流记下所属远端在 PacketStats 中的槽位，一个包只查一次流键就同时更新流和远端的计数。
+    采样线程按周期读取每个远端的收发增量，并用时间轮淘汰超过 idle_timeout 没有流量的流。
+    与 PacketStats 一样只有一个抓包线程写入；分配和回收槽位时持有 self.lock，已有流的累加不加锁。
+    也提供 swap/collect/release（转给 stats），一个 FlowTable 就是 CaptureCounters 的一个完整分片。
+    """
+
+    COUNTERS = ('tx_bytes', 'rx_bytes', 'tx_packets', 'rx_packets')
+
+    def __init__(self, stats=None, capacity=FLOW_TABLE_SLOTS, idle_timeout=FLOW_IDLE_TIMEOUT):
+        self.stats = stats if stats is not None else PacketStats()
+        self.capacity = capacity
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.slots = {}  # 流键 -> 槽位
+        self.free = list(range(capacity - 1, -1, -1))
+        self.keys = array('Q', bytes(8 * capacity))
+        # 逐包读写的列用 list（同 PacketStats）
+        self.peer_slots = [0] * capacity  # 所属远端在 stats 中的槽位
+        self.tx_bytes = [0] * capacity
+        self.rx_bytes = [0] * capacity
+        self.tx_packets = [0] * capacity
+        self.rx_packets = [0] * capacity
+        self.seen = [array('Q', bytes(8 * capacity)) for _ in self.COUNTERS]  # 上次采样时的累计值
+        self.last_active = array('d', bytes(8 * capacity))
+        self.created = deque()  # 采集线程新建、采样线程尚未登记的槽位
+        self.remote_flows = {}  # 远端 -> {槽位}
+        self.wheel = TimerWheel(FLOW_WHEEL_TICK, FLOW_WHEEL_SIZE)
+        self.dropped = 0  # 流表已满时未能计入的包数
+
+    def account(self, remote, local_port, remote_port, length, outbound, now):
+        """累计一个包：远端的字节/包/到达统计和流的收发计数（采集线程调用）"""
+        key = remote << 32 | local_port << 16 | remote_port
+        slot = self.slots.get(key)
+        if slot is None:
+            slot = self._allocate(key)
+            if slot is None:
+                # 流表已满时只计入远端的统计
+                self.dropped += 1
+                self.stats.record(remote, length, now)
+                return
+        stats = self.stats
+        peer_slot = self.peer_slots[slot]
+        if stats.remotes[peer_slot] != remote:
+            # 远端移除后其统计槽位已回收，流还在：重新分配
+            peer_slot = stats._allocate(remote)
+            if peer_slot is None:
+                return
+            self.peer_slots[slot] = peer_slot
+        stats.update(peer_slot, length, now)
+        if outbound:
+            self.tx_bytes[slot] += length
+            self.tx_packets[slot] += 1
+        else:
+            self.rx_bytes[slot] += length
+            self.rx_packets[slot] += 1
+
+    def _allocate(self, key):
+        """为新流分配槽位（同时确保远端有统计槽位）；另一个抓包线程可能刚刚分配过，持锁后重新检查"""
+        peer_slot = self.stats.slots.get(key >> 32)
+        if peer_slot is None:
+            peer_slot = self.stats._allocate(key >> 32)
+            if peer_slot is None:
+                return None
+        with self.lock:
+            slot = self.slots.get(key)
+            if slot is None and self.free:
+                slot = self.free.pop()
+                self.keys[slot] = key
+                self.peer_slots[slot] = peer_slot
+                self.slots[key] = slot
+                self.created.append(slot)
+            return slot
+
+    def directions(self, now):
+        """读取本周期每个远端的 (发送字节, 接收字节, 发送包数, 接收包数) 增量（采样线程调用）"""
+        while self.created:
+            slot = self.created.popleft()
+            self.remote_flows.setdefault(self.keys[slot] >> 32, set()).add(slot)
+            self.wheel.schedule((slot, self.keys[slot]), now + self.idle_timeout)
+
+        counters = list(zip([getattr(self, name) for name in self.COUNTERS], self.seen))
+        result = {}
+        for remote, slots in self.remote_flows.items():
+            totals = [0, 0, 0, 0]
+            for slot in slots:
+                active = False
+                for i, (column, seen) in enumerate(counters):
+                    delta = column[slot] - seen[slot]
+                    if delta:
+                        totals[i] += delta
+                        seen[slot] += delta
+                        active = True
+                if active:
+                    self.last_active[slot] = now
+            if any(totals):
+                result[remote] = tuple(totals)
+        return result
+
+    def expire(self, now):
+        """淘汰空闲超时的流，仍有流量的按最后活动时间重新排进时间轮；返回淘汰数量"""
+        evicted = 0
+        for slot, key in self.wheel.advance(now):
+            if self.slots.get(key) != slot:
+                continue
+            deadline = self.last_active[slot] + self.idle_timeout
+            if deadline > now:
+                self.wheel.schedule((slot, key), deadline)
+                continue
+            self._evict(slot, key)
+            evicted += 1
+        return evicted
+
+    def _evict(self, slot, key):
+        remote = key >> 32
+        flows = self.remote_flows.get(remote)
+        if flows is not None:
+            flows.discard(slot)
+            if not flows:
+                del self.remote_flows[remote]
+        with self.lock:
+            del self.slots[key]
+            for column in [getattr(self, name) for name in self.COUNTERS] + self.seen:
+                column[slot] = 0
+            self.last_active[slot] = 0.0
+            self.free.append(slot)
+
+    def flows(self, remote):
+        """某个远端当前的所有流（累计值），按本地端口、远端端口排序"""
+        result = []
+        for slot in sorted(self.remote_flows.get(remote, ()), key=lambda s: self.keys[s] & 0xFFFFFFFF):
+            key = self.keys[slot]
+            result.append({'local_port': key >> 16 & 0xFFFF, 'remote_port': key & 0xFFFF,
+                           'tx_bytes': self.tx_bytes[slot], 'rx_bytes': self.rx_bytes[slot],
+                           'tx_packets': self.tx_packets[slot], 'rx_packets': self.rx_packets[slot]})
+        return result
+
+    def swap(self):
+        return self.stats.swap()
+
+    def collect(self, remote):
+        return self.stats.collect(remote)
+
+    def release(self, remote):
+        self.stats.release(remote)
+
+    def clear(self):
+        """回收所有流，并清空远端计数"""
+        self.directions(time.monotonic())  # 登记队列中的新流，保证全部回收
+        for key, slot in list(self.slots.items()):
+            self._evict(slot, key)
+        self.wheel = TimerWheel(FLOW_WHEEL_TICK, FLOW_WHEEL_SIZE)
+        self.stats.clear()
+
+
+class CaptureCounters:
+    """抓包计数：每个抓包线程只写自己的一份分片，采样线程读取时合并
+
+    槽位内的累加是“读-改-写”，两个线程同时累加同一个远端会丢失计数；每个线程一份分片就没有写端竞争，
+    包处理路径上也不需要加锁。分片默认是 FlowTable（含 PacketStats），抓包进程模式下是各网卡的共享内存表。
+    提供与 SharedCounterTable 相同的 swap/collect/directions/expire/flows/release/clear，
+    可同时作为 byte_counters / packet_stats / flow_table。
+    同一个远端出现在多个分片时字节和包数相加，抖动和最大间隔取本周期包数最多的分片（到达统计只在分片内连续）。
+    """
+
+    def __init__(self, shards=(), factory=None):
+        self.factory = factory or (lambda: FlowTable(PacketStats()))
+        self.lock = threading.Lock()
+        self.shards = tuple(shards)  # 只整体替换，读端不加锁遍历
+        self.local = threading.local()
+
+    def shard(self):
+        """当前线程写入的分片（第一次调用时创建）"""
+        table = getattr(self.local, 'table', None)
+        if table is None:
+            table = self.local.table = self.factory()
+            with self.lock:
+                if table not in self.shards:
+                    self.shards = self.shards + (table,)
+        return table
+
+    def account(self, remote, local_port, remote_port, length, outbound, now):
+        self.shard().account(remote, local_port, remote_port, length, outbound, now)
+
+    def swap(self):
+        shards = self.shards
+        if len(shards) == 1:
+            return shards[0].swap()
+        deltas = defaultdict(int)
+        for table in shards:
+            for remote, delta in table.swap().items():
+                deltas[remote] += delta
+        return dict(deltas)
+
+    def collect(self, remote):
+        shards = self.shards
+        if not shards:
+            return 0, 0.0, 0.0
+        results = [table.collect(remote) for table in shards]
+        packets = sum(r[0] for r in results)
+        _, jitter, max_gap = max(results, key=lambda r: (r[0], r[1]))
+        return packets, jitter, max_gap
+
+    def directions(self, now):
+        shards = self.shards
+        if len(shards) == 1:
+            return shards[0].directions(now)
+        result = {}
+        for table in shards:
+            for remote, counts in table.directions(now).items():
+                current = result.get(remote)
+                result[remote] = counts if current is None else tuple(a + b for a, b in zip(current, counts))
+        return result
+
+    def expire(self, now):
+        return sum(table.expire(now) for table in self.shards)
+
+    def flows(self, remote):
+        merged = {}
+        for table in self.shards:
+            for flow in table.flows(remote):
+                key = (flow['local_port'], flow['remote_port'])
+                if key in merged:
+                    for name in FlowTable.COUNTERS:
+                        merged[key][name] += flow[name]
+                else:
+                    merged[key] = dict(flow)
+        return [merged[key] for key in sorted(merged)]
+
+    def release(self, remote):
+        for table in self.shards:
+            table.release(remote)
+
+    def clear(self):
+        for table in self.shards:
+            table.clear()
+
+
+# 存储UDP流量：每个抓包线程一份远端计数+流表（共用一次查找），三个名称都指向合并读取的 CaptureCounters
+flow_table = CaptureCounters()
+byte_counters = packet_stats = flow_table
+geo_cache = PersistentCache("geo", GEO_CACHE_TTL)
+dns_cache = PersistentCache("dns", DNS_CACHE_TTL)
 gta_ports = set(UDP_PORTS_TO_MONITOR)
+port_listeners = []  # 端口集合变化时的回调，参数为新的端口集合
+event_log = deque(maxlen=EVENT_LOG_SIZE)
+ui_active = False  # 界面接管终端后，后台线程的消息只写入事件日志
 running = True
+worker_threads = []  # 读写计数表的采样/抓包/回放线程，退出时先等它们结束再清空数据
 LOCAL_IP = ""
 
 
+def log_event(message):
+    """记录后台事件：界面运行时显示在画面底部，否则直接打印"""
+    event_log.append(f"{time.strftime('%H:%M:%S')} {message}")
+    if not ui_active:
+        print(message)
+
+
 def display_all_network_interfaces():
     """显示所有网络接口的IP地址"""
     print(f"\n{Fore.CYAN}=== 本地网络接口信息 ==={Style.RESET_ALL}")
@@ -126,6 +769,7 @@ def get_user_input_ip():
     print(f"{Fore.YELLOW}路由模式玩家请输入虚拟网卡的IP{Style.RESET_ALL}")
     print(f"{Fore.YELLOW}进程模式玩家请输入您的物理网卡的IP{Style.RESET_ALL}")
     print(f"{Fore.YELLOW}提示: 可以直接按回车使用自动检测的IP{Style.RESET_ALL}")
+    print(f"{Fore.YELLOW}提示: 不确定选哪个可以输入 all 同时监控所有网卡，多个IP用逗号分隔{Style.RESET_ALL}")
 
     # 自动检测可用的IP
     default_ip = ""
@@ -159,10 +803,14 @@ def get_user_input_ip():
             return "127.0.0.1"
 
     ip = ip_input.strip()
+    if ip.lower() == "all":
+        print(f"\n{Fore.GREEN}✓ 已设置监控所有网卡{Style.RESET_ALL}")
+        return "all"
 
     # 基本IP格式验证
     try:
-        socket.inet_aton(ip)
+        for item in ip.split(","):
+            socket.inet_aton(item.strip())
 
         # 检查是否为本地/回环地址
         if ip.startswith("127."):
@@ -181,27 +829,44 @@ def get_user_input_ip():
 
 
 # ... 中间的函数保持不变，包括：get_str_width, truncate_mixed_string, pad_text, mask_ip_for_privacy,
-# parse_asn_info, get_friendly_isp_name, is_chinese_ip, is_take_two_ip, is_rockstar_ip_range,
-# reverse_dns_lookup, get_rockstar_server_type, Peer类等 ...
+# parse_asn_info, get_friendly_isp_name, is_chinese_ip, ServerRules,
+# ReverseDnsResolver, get_rockstar_server_type, Peer类等 ...
 
+ANSI_ESCAPE = re.compile(r'\x1b\[[0-9;]*[A-Za-z]')
+
+
+@lru_cache(maxsize=4096)
+def char_width(char):
+    """单个字符的显示宽度：全角/宽字符（含emoji）为2，组合字符与变体选择符为0"""
+    if unicodedata.combining(char) or char in '\u200d\ufe0e\ufe0f':
+        return 0
+    return 2 if unicodedata.east_asian_width(char) in ('W', 'F') else 1
+
+
+@lru_cache(maxsize=8192)
 def get_str_width(s):
-    """计算字符串显示宽度（中文字符算2个宽度）"""
-    width = 0
-    for char in s:
-        width += 2 if '\u4e00' <= char <= '\u9fff' else 1
-    return width
+    """计算字符串显示宽度（宽字符算2个宽度，忽略ANSI颜色码）"""
+    return sum(char_width(char) for char in ANSI_ESCAPE.sub('', s))
 
 
 def truncate_mixed_string(text, max_width):
-    """截断混合字符串到指定显示宽度"""
+    """截断混合字符串到指定显示宽度（ANSI颜色码原样保留，不计宽度）"""
     current_width = 0
     result = ""
-    for char in text:
-        char_width = 2 if '\u4e00' <= char <= '\u9fff' else 1
-        if current_width + char_width > max_width:
+    pos = 0
+    while pos < len(text):
+        m = ANSI_ESCAPE.match(text, pos)
+        if m:
+            result += m.group()
+            pos = m.end()
+            continue
+        char = text[pos]
+        w = char_width(char)
+        if current_width + w > max_width:
             return result + ".."
         result += char
-        current_width += char_width
+        current_width += w
+        pos += 1
     return result
 
 
@@ -222,6 +887,20 @@ def pad_text(text, width, align='left'):
         return " " * left + text + " " * right
 
 
+def compact_number(value, width, decimals=1):
+    """把数值格式化为不超过 width 个字符：先减少小数位，仍放不下时用 k/M/G 缩写（如 12.3k）"""
+    for digits in range(decimals, -1, -1):
+        text = f"{value:.{digits}f}"
+        if len(text) <= width:
+            return text
+    for unit, scale in (('k', 1e3), ('M', 1e6), ('G', 1e9)):
+        for digits in (1, 0):
+            text = f"{value / scale:.{digits}f}{unit}"
+            if len(text) <= width:
+                return text
+    return text
+
+
 def mask_ip_for_privacy(ip, is_chinese):
     """为裸连的玩家隐藏IP中间2位以确保隐私"""
     if not is_chinese:
@@ -314,6 +993,9 @@ def get_friendly_isp_name(isp_data, org_data, as_data):
 
 def is_chinese_ip(ip):
     """判断是否为国内IP"""
+    d = offline_geo.lookup(ip)
+    if d:
+        return d['country'] == '中国'
     try:
         url = f"http://ip-api.com/json/{ip}?lang=zh-CN&fields=status,country"
         r = requests.get(url, timeout=3)
@@ -326,59 +1008,269 @@ def is_chinese_ip(ip):
     return False
 
 
-def is_take_two_ip(asn_info):
-    """判断是否为Take-Two官方IP"""
-    if not asn_info:
-        return False
-    asn_info_lower = str(asn_info).lower()
-    return "take-two" in asn_info_lower or "take two" in asn_info_lower
-
-
-def is_rockstar_ip_range(ip):
-    """判断IP是否属于Rockstar官方网段"""
-    for ip_range in ROCKSTAR_IP_RANGES:
-        if ip.startswith(ip_range):
-            return True
-    return False
+DNS_HEADER = struct.Struct('!HHHHHH')  # 标识符, 标志, 问题数, 回答数, 授权数, 附加数
+DNS_RR = struct.Struct('!HHIH')  # 类型, 类, TTL, 数据长度
+DNS_TYPE_PTR = 12
 
 
-def reverse_dns_lookup(ip):
-    """反向DNS查询，获取域名"""
+def read_resolv_conf(path="/etc/resolv.conf"):
+    """读取系统配置的第一个IPv4 DNS服务器，读不到返回None"""
     try:
-        with dns_lock:
-            if ip in dns_cache:
-                return dns_cache[ip]
+        with open(path, 'r', encoding='utf-8', errors='ignore') as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) >= 2 and parts[0] == 'nameserver':
+                    try:
+                        socket.inet_aton(parts[1])
+                    except OSError:
+                        continue
+                    return parts[1]
+    except OSError:
+        pass
+    return None
 
-        domain = socket.gethostbyaddr(ip)[0]
 
+def ptr_query_name(ip):
+    """IPv4地址对应的PTR查询名，例如 1.2.3.4 -> 4.3.2.1.in-addr.arpa"""
+    return ".".join(reversed(ip.split('.'))) + ".in-addr.arpa"
+
+
+def build_ptr_query(qid, ip):
+    """构造一个递归查询的PTR请求报文"""
+    question = b''.join(bytes([len(label)]) + label.encode('ascii') for label in ptr_query_name(ip).split('.'))
+    return DNS_HEADER.pack(qid, 0x0100, 1, 0, 0, 0) + question + b'\x00' + struct.pack('!HH', DNS_TYPE_PTR, 1)
+
+
+def read_dns_name(data, offset):
+    """读取（可能带压缩指针的）域名，返回 (域名, 域名之后的偏移)"""
+    labels = []
+    end = None
+    for _ in range(64):  # 防止指针成环
+        length = data[offset]
+        if length & 0xC0 == 0xC0:
+            if end is None:
+                end = offset + 2
+            offset = ((length & 0x3F) << 8) | data[offset + 1]
+            continue
+        offset += 1
+        if length == 0:
+            return ".".join(labels), offset if end is None else end
+        labels.append(data[offset:offset + length].decode('ascii', 'replace'))
+        offset += length
+    raise ValueError("DNS域名压缩指针过多")
+
+
+def parse_ptr_response(data):
+    """解析PTR响应，返回 (标识符, 查询名, 状态, 域名)
+
+    状态: "ok" 找到PTR记录 / "nxdomain" 没有记录 / "error" 服务器错误或截断
+    """
+    qid, flags, qdcount, ancount, _, _ = DNS_HEADER.unpack_from(data)
+    if not flags & 0x8000 or qdcount != 1:
+        raise ValueError("不是DNS响应")
+    qname, offset = read_dns_name(data, DNS_HEADER.size)
+    offset += 4
+    rcode = flags & 0x000F
+    if rcode == 3:
+        return qid, qname, "nxdomain", None
+    if rcode != 0 or flags & 0x0200:
+        return qid, qname, "error", None
+    for _ in range(ancount):
+        _, offset = read_dns_name(data, offset)
+        rtype, _, _, rdlength = DNS_RR.unpack_from(data, offset)
+        offset += DNS_RR.size
+        if rtype == DNS_TYPE_PTR:
+            return qid, qname, "ok", read_dns_name(data, offset)[0]
+        offset += rdlength
+    return qid, qname, "nxdomain", None  # NOERROR但没有PTR记录
+
+
+class ReverseDnsResolver:
+    """异步反向DNS查询
+
+    - 默认直接向DNS服务器发UDP PTR查询，单个套接字按标识符匹配响应（与 LatencyProber 相同）；
+      找不到可用的服务器（如Windows）时退回到工作线程中调用系统的 gethostbyaddr
+    - 同时进行的查询数量有上限，超出的排队；每个查询单独超时
+    - 同一IP的并发请求合并；有结果的写入 dns_cache，没有PTR记录和超时分别按不同时长做负缓存
+    """
+
+    def __init__(self, server=DNS_SERVER, timeout=DNS_TIMEOUT, max_inflight=DNS_MAX_INFLIGHT):
+        self.server = server
+        self.timeout = timeout
+        self.max_inflight = max_inflight
+        self.cond = threading.Condition()
+        self.pending = deque()  # 等待发送的IP
+        self.inflight = {}  # 标识符 -> (ip, 查询名, 截止时间)；系统解析模式下为 ip -> (ip, None, 截止时间)
+        self.waiters = {}  # ip -> [callback, ...]
+        self.negative = {}  # ip -> 过期时间
+        self.address = None  # (服务器IP, 端口)，None 表示使用系统解析
+        self.sock = None
+        self.started = False
+        self.blocking = 0  # 系统解析模式下正在运行的工作线程数（超时后线程可能仍卡在系统调用中）
+
+    def _start(self):
+        """首次查询时确定解析方式并启动接收/超时线程"""
+        self.started = True
+        server = self.server
+        if server == "auto":
+            server = read_resolv_conf()
+        if server and server != "system":
+            host, _, port = server.partition(':')
+            try:
+                self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                self.sock.settimeout(0.2)
+                self.sock.bind(('0.0.0.0', 0))  # 接收线程先于第一次发送运行，未绑定时Windows上recvfrom会报错
+                self.address = (socket.gethostbyname(host), int(port or 53))
+            except (OSError, ValueError) as e:
+                log_event(f"{Fore.RED}DNS服务器 {server} 不可用，改用系统解析: {e}{Style.RESET_ALL}")
+                self.sock = None
+                self.address = None
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def cached(self, ip):
+        """只查缓存：返回 (是否命中, 域名)"""
         with dns_lock:
-            dns_cache[ip] = domain
-
-        return domain
-    except:
-        return None
+            if ip in dns_cache:
+                return True, dns_cache[ip]
+        with self.cond:
+            expires = self.negative.get(ip)
+            if expires is not None:
+                if expires > time.time():
+                    return True, None
+                del self.negative[ip]
+        return False, None
+
+    def resolve(self, ip, callback):
+        """异步查询，结果通过 callback(ip, domain) 返回，没有记录或超时domain为None"""
+        hit, domain = self.cached(ip)
+        if hit:
+            callback(ip, domain)
+            return
+        with self.cond:
+            if ip in self.waiters:
+                self.waiters[ip].append(callback)
+                return
+            self.waiters[ip] = [callback]
+            self.pending.append(ip)
+            if not self.started:
+                self._start()
+            self._send_pending()
+
+    def _send_pending(self):
+        """在并发上限内发出排队的查询（持有 self.cond 时调用）"""
+        while self.pending:
+            if self.address is None:
+                if self.blocking >= self.max_inflight:
+                    return
+                ip = self.pending.popleft()
+                self.blocking += 1
+                self.inflight[ip] = (ip, None, time.monotonic() + self.timeout)
+                threading.Thread(target=self._system_lookup, args=(ip,), daemon=True).start()
+                continue
 
+            if len(self.inflight) >= self.max_inflight:
+                return
+            ip = self.pending.popleft()
+            qid = random.getrandbits(16)
+            while qid in self.inflight:
+                qid = random.getrandbits(16)
+            self.inflight[qid] = (ip, ptr_query_name(ip), time.monotonic() + self.timeout)
+            try:
+                self.sock.sendto(build_ptr_query(qid, ip), self.address)
+            except OSError:
+                pass  # 按超时处理
 
-def get_rockstar_server_type(ip, domain, asn_info):
-    """获取Rockstar服务器类型"""
+    def _system_lookup(self, ip):
+        try:
+            domain = socket.gethostbyaddr(ip)[0]
+            status = "ok"
+        except socket.herror:
+            domain, status = None, "nxdomain"
+        except OSError:
+            domain, status = None, "error"
+        with self.cond:
+            self.blocking -= 1
+            current = self.inflight.pop(ip, None)
+            self._send_pending()
+        # 已超时的查询也缓存结果，下次直接命中
+        self._finish(ip, status, domain, current is not None)
+
+    def _run(self):
+        while running:
+            if self.sock is not None:
+                try:
+                    data, addr = self.sock.recvfrom(2048)
+                except socket.timeout:
+                    data = None
+                except OSError as e:
+                    # 套接字不可用时改用系统解析；在途的查询收不到响应了，放回队首用系统解析重新查询，
+                    # 按标识符记录的条目不能留在 inflight 中占用系统解析的名额
+                    log_event(f"{Fore.RED}DNS套接字出错，改用系统解析: {e}{Style.RESET_ALL}")
+                    with self.cond:
+                        self.sock.close()
+                        self.sock = None
+                        self.address = None
+                        self.pending.extendleft(reversed([ip for ip, _, _ in self.inflight.values()]))
+                        self.inflight.clear()
+                        self._send_pending()
+                    continue
+                if data and addr == self.address:
+                    self._receive(data)
+            else:
+                with self.cond:
+                    self.cond.wait(0.2)
+            self._expire(time.monotonic())
 
-    if ip in TRADE_SERVER_IPS:
-        return "官方-交易服务器"
-    elif ip in CLOUD_SAVE_SERVER_IPS:
-        return "官方-云存档服务器"
+    def _receive(self, data):
+        try:
+            qid, qname, status, domain = parse_ptr_response(data)
+        except (ValueError, IndexError, struct.error):
+            return
+        with self.cond:
+            entry = self.inflight.get(qid)
+            # 查询名也要一致，避免把迟到的旧响应当成新查询的结果
+            if entry is None or entry[1].lower() != qname.lower():
+                return
+            del self.inflight[qid]
+            self._send_pending()
+        self._finish(entry[0], status, domain, True)
+
+    def _expire(self, now):
+        """超时的查询按失败返回"""
+        with self.cond:
+            expired = [key for key, (_, _, deadline) in self.inflight.items() if deadline <= now]
+            ips = [self.inflight.pop(key)[0] for key in expired]
+            if ips:
+                self._send_pending()
+        for ip in ips:
+            self._finish(ip, "error", None, True)
+
+    def _finish(self, ip, status, domain, notify):
+        """写缓存并回调等待该IP的所有请求"""
+        if status == "ok":
+            with dns_lock:
+                dns_cache[ip] = domain
+        with self.cond:
+            if status != "ok":
+                ttl = DNS_NEGATIVE_TTL if status == "nxdomain" else DNS_FAILURE_TTL
+                self.negative[ip] = time.time() + ttl
+                if len(self.negative) > CACHE_MAX_ENTRIES:
+                    now = time.time()
+                    self.negative = {k: t for k, t in self.negative.items() if t > now}
+            callbacks = self.waiters.pop(ip, []) if notify else []
+        for callback in callbacks:
+            try:
+                callback(ip, domain)
+            except Exception:
+                pass
 
-    if domain:
-        for rockstar_domain in ROCKSTAR_DOMAINS:
-            if rockstar_domain in domain:
-                return "官方-CDN服务器与云服务器"
 
-    if is_rockstar_ip_range(ip):
-        return "官方-中转服务器"
+dns_resolver = ReverseDnsResolver()
 
-    if is_take_two_ip(asn_info):
-        return "官方-其他服务器"
 
-    return None
+def get_rockstar_server_type(ip, domain, asn_info):
+    """获取Rockstar服务器类型（按当前加载的识别规则）"""
+    return server_rules.classify(ip, domain, asn_info)
 
 def is_public_ip(ip_str):
     try:
@@ -387,6 +1279,1072 @@ def is_public_ip(ip_str):
     except ValueError:
         return False
 
+# 常见国家/地区代码（离线库只有代码，与ip-api中文结果保持一致）
+COUNTRY_NAMES_ZH = {
+    "CN": "中国", "HK": "香港", "MO": "澳门", "TW": "台湾", "JP": "日本", "KR": "韩国",
+    "SG": "新加坡", "MY": "马来西亚", "TH": "泰国", "VN": "越南", "PH": "菲律宾", "ID": "印度尼西亚",
+    "IN": "印度", "AU": "澳大利亚", "NZ": "新西兰", "US": "美国", "CA": "加拿大", "MX": "墨西哥",
+    "BR": "巴西", "GB": "英国", "DE": "德国", "FR": "法国", "NL": "荷兰", "IE": "爱尔兰",
+    "SE": "瑞典", "FI": "芬兰", "NO": "挪威", "DK": "丹麦", "PL": "波兰", "IT": "意大利",
+    "ES": "西班牙", "RU": "俄罗斯", "UA": "乌克兰", "TR": "土耳其",
+}
+
+
+def ip_to_int(ip):
+    """点分IPv4转32位整数"""
+    return struct.unpack('!I', socket.inet_aton(ip))[0]
+
+
+class ServerRuleIndex:
+    """编译后的官方服务器识别规则（只读，重新加载时整体替换）
+
+    - 精确IP和ASN号: 字典
+    - 网段: 按起始地址排序的不重叠整数区间，bisect查找；嵌套网段拆分后更具体的优先
+    - 域名后缀: 按标签倒序的字典树（com -> rockstargames -> ros），取匹配最长的后缀
+    - ASN名称关键字: 逐个子串比较（只用于少量厂商名称）
+    匹配顺序: 精确IP > 域名后缀 > 网段 > ASN号 > ASN名称关键字；同类规则中先出现的优先。
+    """
+
+    def __init__(self, rules):
+        self.ips = {}
+        self.asns = {}
+        self.asn_names = []
+        self.trie = {}
+        self.starts = array('I')
+        self.ends = array('I')
+        self.types = []
+        self.rule_count = 0
+
+        cidrs = []
+        for rule in rules:
+            server_type = rule['type']
+            for ip in rule.get('ips', []):
+                self.ips.setdefault(ip_to_int(ip), server_type)
+            for cidr in rule.get('cidrs', []):
+                net = ipaddress.IPv4Network(cidr, strict=False)
+                cidrs.append((net.prefixlen, len(cidrs), int(net.network_address),
+                              int(net.broadcast_address), server_type))
+            for asn in rule.get('asns', []):
+                self.asns.setdefault(int(str(asn).upper().removeprefix('AS')), server_type)
+            for name in rule.get('asn_names', []):
+                self.asn_names.append((name.lower(), server_type))
+            for domain in rule.get('domains', []):
+                node = self.trie
+                for label in reversed(domain.lower().strip('.').removeprefix('*.').split('.')):
+                    node = node.setdefault(label, {})
+                node.setdefault(None, server_type)
+            self.rule_count += 1
+
+        # 先铺较大的网段，再用更小的网段覆盖其中的一部分（CIDR只会嵌套或不相交）
+        for _, _, start, end, server_type in sorted(cidrs):
+            self._paint(start, end, server_type)
+
+    def _paint(self, start, end, server_type):
+        i = bisect.bisect_right(self.starts, start) - 1
+        if i >= 0 and self.ends[i] >= end:
+            outer_start, outer_end, outer_type = self.starts[i], self.ends[i], self.types[i]
+            if (outer_start, outer_end) == (start, end):
+                return  # 相同网段保留先出现的规则
+            pieces = [(outer_start, start - 1, outer_type), (start, end, server_type), (end + 1, outer_end, outer_type)]
+            pieces = [p for p in pieces if p[0] <= p[1]]
+            del self.starts[i], self.ends[i], self.types[i]
+        else:
+            i += 1
+            pieces = [(start, end, server_type)]
+        for offset, (s, e, t) in enumerate(pieces):
+            self.starts.insert(i + offset, s)
+            self.ends.insert(i + offset, e)
+            self.types.insert(i + offset, t)
+
+    def match_domain(self, domain):
+        node = self.trie
+        found = None
+        for label in reversed(domain.lower().rstrip('.').split('.')):
+            node = node.get(label)
+            if node is None:
+                break
+            found = node.get(None, found)
+        return found
+
+    def match_ip_range(self, value):
+        i = bisect.bisect_right(self.starts, value) - 1
+        if i >= 0 and value <= self.ends[i]:
+            return self.types[i]
+        return None
+
+    def match_asn(self, asn_info):
+        match = ASN_NUMBER_PATTERN.match(asn_info)
+        if match:
+            server_type = self.asns.get(int(match.group(1)))
+            if server_type:
+                return server_type
+        lower = asn_info.lower()
+        for name, server_type in self.asn_names:
+            if name in lower:
+                return server_type
+        return None
+
+    def classify(self, ip, domain, asn_info):
+        try:
+            value = ip_to_int(ip)
+        except OSError:
+            value = None
+        if value is not None and value in self.ips:
+            return self.ips[value]
+        if domain:
+            server_type = self.match_domain(domain)
+            if server_type:
+                return server_type
+        if value is not None:
+            server_type = self.match_ip_range(value)
+            if server_type:
+                return server_type
+        if asn_info:
+            return self.match_asn(str(asn_info))
+        return None
+
+
+class ServerRules:
+    """从规则文件加载识别规则，文件修改后重新编译；文件不存在时使用内置规则
+
+    规则文件为JSON: {"rules": [{"type": "官方-中转服务器", "cidrs": ["52.139.0.0/16"]}, ...]}，
+    每条规则可包含 ips / cidrs / domains / asns / asn_names 中的任意几项。
+    """
+
+    def __init__(self, path=SERVER_RULES_FILE, defaults=DEFAULT_SERVER_RULES):
+        self.path = path
+        self.defaults = defaults
+        self.index = ServerRuleIndex(defaults)
+        self.source = "内置规则"
+        self.mtime = None
+
+    def load(self):
+        """加载规则文件；格式错误时保留当前规则。返回是否替换了规则"""
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime == self.mtime:
+            return False
+        self.mtime = mtime
+
+        if mtime is None:
+            rules, source = self.defaults, "内置规则"
+        else:
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    rules = json.load(f)['rules']
+                source = self.path
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                log_event(f"{Fore.RED}规则文件 {self.path} 读取失败，继续使用{self.source}: {e}{Style.RESET_ALL}")
+                return False
+        try:
+            index = ServerRuleIndex(rules)
+        except (KeyError, ValueError, TypeError, AttributeError, OSError) as e:
+            log_event(f"{Fore.RED}规则文件 {self.path} 格式错误，继续使用{self.source}: {e}{Style.RESET_ALL}")
+            return False
+        self.index = index  # 整体替换，查询线程不会看到编译到一半的规则
+        self.source = source
+        return True
+
+    def classify(self, ip, domain, asn_info):
+        return self.index.classify(ip, domain, asn_info)
+
+
+server_rules = ServerRules()
+
+
+class OfflineGeoDB:
+    """离线IP段数据库：有序整数数组 + 二分查找，支持mmap加载的二进制格式"""
+
+    MAGIC = b"GTAOIPDB"
+    VERSION = 1
+    HEADER = struct.Struct('<8sBBxxIII')  # magic, version, 字节序, 段数, 记录数, 记录区长度
+
+    def __init__(self):
+        self.starts = array('I')
+        self.ends = array('I')
+        self.rec_index = array('I')
+        self.records = []  # (country, region, city, asn, as_name)
+        self.mm = None
+
+    def __len__(self):
+        return len(self.starts)
+
+    def load_text(self, path):
+        """解析iptoasn TSV或MaxMind风格CSV，构建有序区间数组"""
+        ranges = []
+        record_ids = {}
+
+        def add(start, end, country, region, city, asn, as_name):
+            rec = (country, region, city, int(asn or 0), as_name)
+            if rec not in record_ids:
+                record_ids[rec] = len(record_ids)
+            ranges.append((start, end, record_ids[rec]))
+
+        with open(path, 'r', encoding='utf-8', newline='') as f:
+            if path.endswith('.tsv'):
+                for line in f:
+                    parts = line.rstrip('\n').split('\t')
+                    if len(parts) < 5:
+                        continue
+                    start, end, asn, country, as_name = parts[:5]
+                    if asn == '0' or country == 'None':
+                        continue  # iptoasn 用 AS0 表示未分配
+                    start = int(start) if start.isdigit() else ip_to_int(start)
+                    end = int(end) if end.isdigit() else ip_to_int(end)
+                    add(start, end, country, '', '', asn, as_name)
+            else:
+                for row in csv.DictReader(f):
+                    if row.get('network'):
+                        net = ipaddress.ip_network(row['network'], strict=False)
+                        if net.version != 4:
+                            continue
+                        start, end = int(net.network_address), int(net.broadcast_address)
+                    else:
+                        start, end = ip_to_int(row['start']), ip_to_int(row['end'])
+                    add(start, end,
+                        row.get('country') or row.get('country_iso_code') or '',
+                        row.get('region') or row.get('regionName') or '',
+                        row.get('city') or '',
+                        row.get('asn') or row.get('autonomous_system_number') or 0,
+                        row.get('as_name') or row.get('autonomous_system_organization') or '')
+
+        ranges.sort()
+        self.starts = array('I', (r[0] for r in ranges))
+        self.ends = array('I', (r[1] for r in ranges))
+        self.rec_index = array('I', (r[2] for r in ranges))
+        self.records = [None] * len(record_ids)
+        for rec, i in record_ids.items():
+            self.records[i] = rec
+        return len(ranges)
+
+    def save(self, path):
+        """写出预编译二进制格式（头部 + starts/ends/rec_index 三个uint32数组 + JSON记录表）"""
+        blob = json.dumps(self.records, ensure_ascii=False).encode('utf-8')
+        little = sys.byteorder == 'little'
+        with open(path, 'wb') as f:
+            f.write(self.HEADER.pack(self.MAGIC, self.VERSION, 1 if little else 0,
+                                     len(self.starts), len(self.records), len(blob)))
+            self.starts.tofile(f)
+            self.ends.tofile(f)
+            self.rec_index.tofile(f)
+            f.write(blob)
+
+    def load_binary(self, path):
+        """mmap加载预编译文件，区间数组直接映射无需解析"""
+        with open(path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, little, n, n_records, blob_len = self.HEADER.unpack_from(mm, 0)
+        if magic != self.MAGIC or version != self.VERSION:
+            mm.close()
+            raise ValueError("离线数据库格式不匹配")
+
+        off = self.HEADER.size
+        size = n * 4
+        if little == (sys.byteorder == 'little'):
+            view = memoryview(mm)
+            self.starts = view[off:off + size].cast('I')
+            self.ends = view[off + size:off + 2 * size].cast('I')
+            self.rec_index = view[off + 2 * size:off + 3 * size].cast('I')
+            self.mm = mm
+        else:
+            # 字节序不同时只能复制一份再翻转
+            arrays = []
+            for i in range(3):
+                a = array('I', mm[off + i * size:off + (i + 1) * size])
+                a.byteswap()
+                arrays.append(a)
+            self.starts, self.ends, self.rec_index = arrays
+        blob_off = off + 3 * size
+        self.records = [tuple(r) for r in json.loads(bytes(mm[blob_off:blob_off + blob_len]).decode('utf-8'))]
+        return n
+
+    def lookup(self, ip):
+        """查询IP，返回与ip-api相同字段的字典；未命中返回None"""
+        if not len(self.starts):
+            return None
+        try:
+            value = ip_to_int(ip)
+        except OSError:
+            return None
+        i = bisect.bisect_right(self.starts, value) - 1
+        if i < 0 or self.ends[i] < value:
+            return None
+        country, region, city, asn, as_name = self.records[self.rec_index[i]]
+        return {
+            'status': 'success',
+            'country': COUNTRY_NAMES_ZH.get(country, country),
+            'regionName': region,
+            'city': city,
+            'isp': as_name,
+            'org': '',
+            'as': f"AS{asn} {as_name}" if asn else '',
+        }
+
+
+offline_geo = OfflineGeoDB()
+
+
+def load_offline_db():
+    """加载离线IP库：有二进制文件直接mmap，否则编译文本库并保存二进制文件"""
+    try:
+        if os.path.exists(OFFLINE_DB_FILE):
+            return offline_geo.load_binary(OFFLINE_DB_FILE)
+        for source in OFFLINE_DB_SOURCES:
+            if os.path.exists(source):
+                count = offline_geo.load_text(source)
+                offline_geo.save(OFFLINE_DB_FILE)
+                return count
+    except Exception as e:
+        print(f"{Fore.RED}离线IP库加载失败: {e}{Style.RESET_ALL}")
+    return 0
+
+
+class GeoLookupQueue:
+    """地理位置查询调度：优先级队列 + 固定数量的工作线程，按批POST
+
+    - 同一IP的并发请求合并；流量大、出现晚的IP优先（优先级可由采样线程更新）
+    - 读取响应头 X-Rl（窗口内剩余次数）/ X-Ttl（窗口剩余秒数）控制请求节奏，429时等到窗口重置
+    - 失败按指数退避（带随机抖动）重试，次数有限；明确失败或重试用尽的IP做负缓存
+    """
+
+    def __init__(self, url=GEO_BATCH_URL, window=GEO_BATCH_WINDOW, batch_size=GEO_BATCH_SIZE, timeout=10,
+                 workers=GEO_WORKERS):
+        self.url = url
+        self.window = window
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.worker_count = workers
+        self.local = threading.local()  # 每个工作线程一个 requests.Session（复用keep-alive连接）
+        self.cond = threading.Condition()
+        self.heap = []  # (优先级, 序号, 条目)，优先级更新后旧条目惰性丢弃，过期条目过多时整理
+        self.priority = {}  # 排队中的 ip -> 当前有效的条目 [优先级, 序号, ip]
+        self.delayed = []  # 退避中的 (可重试时间, 序号, ip, 优先级)
+        self.waiters = {}  # ip -> [callback, ...]，同一IP只发一次请求
+        self.attempts = {}  # ip -> 已失败次数
+        self.negative = {}  # ip -> (过期时间, data, error)
+        self.not_before = 0.0  # 下一次请求的最早时间（限速/退避）
+        self.failures = 0  # 连续失败的批次数
+        self.sequence = 0
+        self.workers = []
+
+    def submit(self, ip, callback, priority=(0,)):
+        """提交查询，结果通过 callback(data, error) 返回；priority 越小越先查询"""
+        with self.cond:
+            if len(self.negative) > CACHE_MAX_ENTRIES:
+                now = time.time()
+                self.negative = {k: v for k, v in self.negative.items() if v[0] > now}
+            cached = self.negative.get(ip)
+            if cached and cached[0] > time.time():
+                result = cached[1:]
+            else:
+                result = None
+                if ip in self.waiters:
+                    self.waiters[ip].append(callback)
+                    return
+                self.waiters[ip] = [callback]
+                self._push(ip, priority)
+                self.workers = [t for t in self.workers if t.is_alive()]
+                while len(self.workers) < self.worker_count:
+                    worker = threading.Thread(target=self._run, daemon=True)
+                    worker.start()
+                    self.workers.append(worker)
+                self.cond.notify()
+        if result is not None:
+            callback(*result)
+
+    def reprioritize(self, priorities):
+        """更新排队中IP的优先级，priorities 为 {ip: 优先级}"""
+        with self.cond:
+            for ip, priority in priorities.items():
+                entry = self.priority.get(ip)
+                if entry is not None and entry[0] != priority:
+                    self._push(ip, priority)
+            # 过期条目多于有效条目时原地重建，堆的大小不随优先级更新次数增长
+            if len(self.heap) > 2 * len(self.priority) + 64:
+                self.heap = [item for item in self.heap if self.priority.get(item[2][2]) is item[2]]
+                heapq.heapify(self.heap)
+
+    def _push(self, ip, priority):
+        self.sequence += 1
+        entry = [priority, self.sequence, ip]
+        self.priority[ip] = entry
+        heapq.heappush(self.heap, (priority, self.sequence, entry))
+
+    def _pop(self):
+        """取出优先级最高的有效条目，返回 (ip, 优先级)"""
+        while self.heap:
+            priority, _, entry = heapq.heappop(self.heap)
+            ip = entry[2]
+            if self.priority.get(ip) is entry:
+                del self.priority[ip]
+                return ip, priority
+        return None, None
+
+    def _delay(self, ip, priority, ready_at):
+        self.sequence += 1
+        heapq.heappush(self.delayed, (ready_at, self.sequence, ip, priority))
+
+    def _wait_time(self, now):
+        """距离可以发送下一批还要等多久；没有待查询IP时返回None"""
+        while self.delayed and self.delayed[0][0] <= now:
+            _, _, ip, priority = heapq.heappop(self.delayed)
+            if ip in self.waiters:
+                self._push(ip, priority)
+        if self.priority:
+            return max(0.0, self.not_before - now)
+        if self.delayed:
+            return max(self.delayed[0][0], self.not_before) - now
+        return None
+
+    def _run(self):
+        while running:
+            with self.cond:
+                while True:
+                    wait = self._wait_time(time.time())
+                    if wait == 0:
+                        break
+                    self.cond.wait(wait)
+                # 等待时间窗口，让同一时刻出现的IP合并进同一批
+                deadline = time.time() + self.window
+                while len(self.priority) < self.batch_size:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                batch = {}  # ip -> 优先级（重试时沿用）
+                while len(batch) < self.batch_size:
+                    ip, priority = self._pop()
+                    if ip is None:
+                        break
+                    batch[ip] = priority
+                # 其他工作线程至少间隔一个窗口再发，收到响应头后再按剩余配额调整
+                self.not_before = max(self.not_before, time.time() + self.window)
+
+            if batch:
+                self._send(batch)
+
+    def _session(self):
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = self.local.session = requests.Session()
+        return session
+
+    def _send(self, batch):
+        """发送一批查询，成功的分发结果，失败的安排退避重试"""
+        results = {}
+        error = None
+        sent_at = time.time()
+        rate_limited = False
+        ips = list(batch)
+        try:
+            r = self._session().post(self.url, params={'fields': GEO_BATCH_FIELDS, 'lang': 'zh-CN'},
+                                     json=ips, timeout=self.timeout)
+            self._apply_rate_limit(r, sent_at)
+            if r.status_code == 200:
+                for i, d in enumerate(r.json()):
+                    ip = d.get('query') or (ips[i] if i < len(ips) else None)
+                    if ip:
+                        results[ip] = d
+            elif r.status_code == 429:
+                rate_limited = True
+            else:
+                error = Exception(f"HTTP {r.status_code}")
+        except Exception as e:
+            error = e
+
+        finished = []
+        with self.cond:
+            now = time.time()
+            if rate_limited:
+                # 配额用尽不算失败，等窗口重置后按原优先级重新排队
+                for ip, priority in batch.items():
+                    self._delay(ip, priority, self.not_before)
+                self.cond.notify()
+                return
+            if error is None:
+                self.failures = 0
+            else:
+                self.failures += 1
+                self.not_before = max(self.not_before, now + self._backoff(self.failures))
+
+            for ip, priority in batch.items():
+                d = results.get(ip)
+                if d is not None:
+                    if d.get('status') != 'success':
+                        # 保留地址等明确无法查询的IP，一段时间内直接返回同样的结果
+                        self.negative[ip] = (now + GEO_NEGATIVE_TTL, d, None)
+                    finished.append((ip, d, None))
+                    continue
+
+                attempts = self.attempts.get(ip, 0) + 1
+                if attempts >= GEO_MAX_ATTEMPTS:
+                    self.negative[ip] = (now + GEO_FAILURE_TTL, None, error)
+                    finished.append((ip, None, error or Exception("查询结果缺失")))
+                else:
+                    self.attempts[ip] = attempts
+                    self._delay(ip, priority, now + self._backoff(attempts))
+            if self.delayed:
+                self.cond.notify()
+
+            callbacks = []
+            for ip, d, err in finished:
+                self.attempts.pop(ip, None)
+                callbacks.extend((callback, d, err) for callback in self.waiters.pop(ip, []))
+
+        for callback, d, err in callbacks:
+            try:
+                callback(d, err)
+            except Exception:
+                pass
+
+    def _apply_rate_limit(self, response, sent_at):
+        """按 X-Rl/X-Ttl 把窗口内剩余的请求次数均匀分布到窗口剩余时间里"""
+        try:
+            remaining = int(response.headers['X-Rl'])
+            reset = int(response.headers['X-Ttl'])
+        except (KeyError, ValueError):
+            if response.status_code != 429:
+                return
+            remaining, reset = 0, GEO_BACKOFF_MAX / 2
+        if remaining <= 0 or response.status_code == 429:
+            delay = reset + random.uniform(0, 1)
+        else:
+            delay = reset / remaining
+        with self.cond:
+            self.not_before = max(self.not_before, sent_at + delay)
+
+    @staticmethod
+    def _backoff(attempt):
+        """指数退避，一半固定一半随机，避免多个客户端同时重试"""
+        delay = min(GEO_BACKOFF_MAX, GEO_BACKOFF_BASE * 2 ** (attempt - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+
+geo_lookup = GeoLookupQueue()
+
+
+def build_geo_entry(ip, d, domain):
+    """把ip-api返回的数据整理为 (location, isp, asn_info, is_chinese, server_type)"""
+    country = d.get('country', '')
+    region = d.get('regionName', '')
+    city = d.get('city', '')
+
+    is_chinese = country == '中国'
+
+    if is_chinese:
+        location = f"{region}{city}" if city else region or country
+    else:
+        location_parts = []
+        if country:
+            location_parts.append(country)
+        if region and region != city:
+            location_parts.append(region)
+        if city:
+            location_parts.append(city)
+        location = " ".join(location_parts[:2])
+
+    isp_raw = d.get('isp', '')
+    org_raw = d.get('org', '')
+    as_raw = d.get('as', '')
+
+    friendly_name = get_friendly_isp_name(isp_raw, org_raw, as_raw)
+    asn_info = as_raw if as_raw else org_raw if org_raw else isp_raw
+    server_type = get_rockstar_server_type(ip, domain, as_raw or org_raw or isp_raw)
+
+    return location.strip() or "未知", friendly_name, asn_info, is_chinese, server_type
+
+
+ICMP_ECHO_HEADER = struct.Struct('!BBHHH')  # 类型, 代码, 校验和, 标识符, 序号
+
+
+def icmp_checksum(data):
+    """计算ICMP校验和"""
+    if len(data) % 2:
+        data += b'\x00'
+    total = sum(array('H', data))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return socket.htons(~total & 0xFFFF)
+
+
+class LatencyProber:
+    """用单个ICMP套接字并发探测所有活跃连接的延迟，按标识符/序号匹配回包"""
+
+    def __init__(self, timeout=PROBE_TIMEOUT, min_interval=PROBE_MIN_INTERVAL, max_inflight=PROBE_MAX_INFLIGHT):
+        self.timeout = timeout
+        self.min_interval = min_interval
+        self.max_inflight = max_inflight
+        self.lock = threading.Lock()
+        self.inflight = OrderedDict()  # seq -> (ip, 发送时间, callback)，按发送顺序
+        self.last_probe = {}  # ip -> 上次发送时间
+        self.ident = os.getpid() & 0xFFFF
+        self.seq = 0
+        self.sock = None
+        self.raw = True  # 原始套接字收到的回包带IP首部
+        self.failed = False
+        self.restarts = 0  # 接收线程异常退出后重新打开套接字的次数
+
+    def _open(self):
+        """打开ICMP套接字：优先原始套接字，Linux无权限时退回ICMP数据报套接字（持有 self.lock 时调用）
+
+        先绑定本机地址再启动接收线程：Windows 上未绑定的原始套接字 recvfrom 会直接报错（WSAEINVAL）。
+        """
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+            self.raw = True
+        except OSError:
+            try:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+                self.raw = False
+            except OSError as e:
+                self.failed = True
+                log_event(f"{Fore.RED}延迟探测不可用: {e}{Style.RESET_ALL}")
+                return
+        try:
+            sock.bind((LOCAL_IP or '0.0.0.0', 0))
+        except OSError:
+            try:
+                sock.bind(('0.0.0.0', 0))
+            except OSError as e:
+                sock.close()
+                self.failed = True
+                log_event(f"{Fore.RED}延迟探测不可用: {e}{Style.RESET_ALL}")
+                return
+        sock.settimeout(0.2)
+        self.sock = sock
+        threading.Thread(target=self._receive, args=(sock,), daemon=True).start()
+
+    def probe(self, ip, callback):
+        """异步发送一次探测，结果通过 callback(ip, rtt_ms) 返回，超时rtt为None；被限速时返回False"""
+        now = time.monotonic()
+        # 接收线程不在时也能清理超时的探测，不会让等待表一直占满
+        self._expire(now)
+        with self.lock:
+            if self.sock is None and not self.failed:
+                self._open()
+            if self.failed:
+                return False
+            if now - self.last_probe.get(ip, -self.min_interval) < self.min_interval:
+                return False
+            if len(self.inflight) >= self.max_inflight:
+                return False
+            self.seq = (self.seq + 1) & 0xFFFF
+            seq = self.seq
+            self.inflight[seq] = (ip, now, callback)
+            self.last_probe[ip] = now
+            sock = self.sock
+
+        payload = b'GTAO' * 8
+        header = ICMP_ECHO_HEADER.pack(8, 0, 0, self.ident, seq)
+        checksum = icmp_checksum(header + payload)
+        packet = ICMP_ECHO_HEADER.pack(8, 0, checksum, self.ident, seq) + payload
+        try:
+            sock.sendto(packet, (ip, 0))
+        except OSError:
+            with self.lock:
+                self.inflight.pop(seq, None)
+            return False
+        return True
+
+    def _restart(self, sock, error):
+        """接收出错时关闭套接字，下一次探测重新打开；连续出错次数过多则停用"""
+        with self.lock:
+            if self.sock is sock:
+                self.sock = None
+            self.restarts += 1
+            if self.restarts > PROBE_MAX_RESTARTS:
+                self.failed = True
+        try:
+            sock.close()
+        except OSError:
+            pass
+        if self.failed:
+            log_event(f"{Fore.RED}延迟探测接收多次出错，已停用: {error}{Style.RESET_ALL}")
+        else:
+            log_event(f"{Fore.YELLOW}延迟探测接收出错，将重新打开套接字: {error}{Style.RESET_ALL}")
+
+    def _receive(self, sock):
+        while running:
+            try:
+                data, addr = sock.recvfrom(2048)
+            except socket.timeout:
+                data = None
+            except OSError as e:
+                if running:
+                    self._restart(sock, e)
+                return
+
+            now = time.monotonic()
+            if data:
+                if self.raw and data and data[0] >> 4 == 4:
+                    data = data[(data[0] & 0xF) * 4:]
+                if len(data) >= ICMP_ECHO_HEADER.size:
+                    icmp_type, _, _, ident, seq = ICMP_ECHO_HEADER.unpack_from(data)
+                    # 数据报套接字的标识符由内核改写，回包只会送到本套接字
+                    if icmp_type == 0 and (ident == self.ident or not self.raw):
+                        with self.lock:
+                            entry = self.inflight.get(seq)
+                            if entry and entry[0] == addr[0]:
+                                del self.inflight[seq]
+                            else:
+                                entry = None
+                        if entry:
+                            self._deliver(entry[2], entry[0], (now - entry[1]) * 1000)
+
+            self._expire(now)
+
+    def _expire(self, now):
+        """清理超时的探测，并回调None"""
+        expired = []
+        with self.lock:
+            while self.inflight:
+                seq, (ip, sent, callback) = next(iter(self.inflight.items()))
+                if now - sent < self.timeout:
+                    break
+                del self.inflight[seq]
+                expired.append((callback, ip))
+            if len(self.last_probe) > self.max_inflight * 4:
+                self.last_probe = {ip: t for ip, t in self.last_probe.items() if now - t < self.min_interval}
+        for callback, ip in expired:
+            self._deliver(callback, ip, None)
+
+    @staticmethod
+    def _deliver(callback, ip, rtt):
+        try:
+            callback(ip, rtt)
+        except Exception:
+            pass
+
+
+latency_prober = LatencyProber()
+
+
+NAN = float('nan')
+
+
+class HistoryStore:
+    """列式历史数据：所有远端共用 (槽位 × HISTORY_SIZE) 的环形缓冲矩阵
+
+    每列（速度/延迟/包速/抖动/断流/突发/上传/下载）是一块连续的 array('d')，延迟缺失记为NaN。
+    远端占用可复用的行槽位，增删远端不会重新分配矩阵；
+    摘要在下次读取时对所有有新样本的行一次性批量计算，并缓存到下一次采样。
+    """
+
+    COLUMNS = ('speed', 'latency', 'pps', 'jitter', 'max_gap', 'burst', 'up', 'down')
+
+    def __init__(self, capacity=HISTORY_SLOTS, size=HISTORY_SIZE):
+        self.size = size
+        self.capacity = 0
+        self.columns = {name: array('d') for name in self.COLUMNS}
+        self.count = array('I')  # 每行已写入的样本数（不超过size）
+        self.head = array('I')  # 每行下一个写入位置
+        self.free = []
+        self.summaries = {}  # 槽位 -> 摘要缓存
+        self.dirty = set()  # 有新样本、摘要待重算的槽位
+        self.lock = threading.Lock()
+        self._grow(capacity)
+
+    def _grow(self, capacity):
+        """扩容到指定行数（只在槽位用尽时发生）"""
+        extra = capacity - self.capacity
+        for name, column in self.columns.items():
+            column.extend(array('d', [NAN if name == 'latency' else 0.0]) * (extra * self.size))
+        self.count.extend(array('I', bytes(4 * extra)))
+        self.head.extend(array('I', bytes(4 * extra)))
+        self.free.extend(range(capacity - 1, self.capacity - 1, -1))
+        self.capacity = capacity
+
+    def allocate(self):
+        """分配一个空行，返回槽位"""
+        with self.lock:
+            if not self.free:
+                self._grow(self.capacity * 2)
+            return self.free.pop()
+
+    def release(self, slot):
+        """回收槽位，清空该行"""
+        with self.lock:
+            base = slot * self.size
+            for name, column in self.columns.items():
+                fill = NAN if name == 'latency' else 0.0
+                for i in range(base, base + self.size):
+                    column[i] = fill
+            self.count[slot] = 0
+            self.head[slot] = 0
+            self.summaries.pop(slot, None)
+            self.dirty.discard(slot)
+            self.free.append(slot)
+
+    def append(self, slot, speed, latency, pps, jitter, max_gap, burst=0.0, up=0.0, down=0.0):
+        """写入一个采样点（latency 为None时记为NaN）"""
+        with self.lock:
+            pos = slot * self.size + self.head[slot]
+            self.columns['speed'][pos] = speed
+            self.columns['latency'][pos] = NAN if latency is None else latency
+            self.columns['pps'][pos] = pps
+            self.columns['jitter'][pos] = jitter
+            self.columns['max_gap'][pos] = max_gap
+            self.columns['burst'][pos] = burst
+            self.columns['up'][pos] = up
+            self.columns['down'][pos] = down
+            self.head[slot] = (self.head[slot] + 1) % self.size
+            if self.count[slot] < self.size:
+                self.count[slot] += 1
+            self.dirty.add(slot)
+
+    def summarize(self):
+        """对所有有新样本的行批量计算摘要（均值/峰值/分位数）"""
+        with self.lock:
+            if not self.dirty:
+                return
+            speed_col = self.columns['speed']
+            latency_col = self.columns['latency']
+            pps_col = self.columns['pps']
+            jitter_col = self.columns['jitter']
+            gap_col = self.columns['max_gap']
+            burst_col = self.columns['burst']
+            up_col = self.columns['up']
+            down_col = self.columns['down']
+            size = self.size
+
+            for slot in self.dirty:
+                n = self.count[slot]
+                base = slot * size
+                end = base + n
+                speeds = speed_col[base:end]
+                latencies = [x for x in latency_col[base:end] if x == x]
+                ordered = sorted(speeds)
+                self.summaries[slot] = {
+                    'avg_speed': sum(speeds) / n,
+                    'max_speed': ordered[-1],
+                    'p95_speed': ordered[min(n - 1, int(0.95 * n))],
+                    'avg_lat': sum(latencies) / len(latencies) if latencies else None,
+                    'avg_pps': sum(pps_col[base:end]) / n,
+                    'jitter': jitter_col[base + (self.head[slot] - 1) % size],
+                    'max_gap': max(gap_col[base:end]),
+                    'max_burst': max(burst_col[base:end]),
+                    'avg_up': sum(up_col[base:end]) / n,
+                    'avg_down': sum(down_col[base:end]) / n,
+                }
+            self.dirty.clear()
+
+    def summary(self, slot):
+        """读取某行的摘要（没有样本时返回None）"""
+        if self.dirty:
+            self.summarize()
+        return self.summaries.get(slot)
+
+    def clear(self):
+        with self.lock:
+            slots = [slot for slot in range(self.capacity) if slot not in self.free]
+        for slot in slots:
+            self.release(slot)
+
+
+history_store = HistoryStore()
+
+
+class _SeriesTier:
+    """一级时间桶：固定数量的环形桶，每桶记录各指标的 min/max/sum/count"""
+
+    __slots__ = ('width', 'size', 'ids', 'last_bid', 'mins', 'maxs', 'sums', 'counts')
+
+    def __init__(self, width, size, metrics):
+        self.width = width
+        self.size = size
+        self.ids = array('q', [-1]) * size  # 每个位置当前存放的桶编号
+        self.last_bid = -1
+        self.mins = [array('f', bytes(4 * size)) for _ in metrics]
+        self.maxs = [array('f', bytes(4 * size)) for _ in metrics]
+        self.sums = [array('f', bytes(4 * size)) for _ in metrics]
+        self.counts = [array('H', bytes(2 * size)) for _ in metrics]
+
+    def add(self, t, values):
+        bid = int(t // self.width)
+        pos = bid % self.size
+        if self.ids[pos] != bid:
+            # 环形覆盖最旧的桶
+            self.ids[pos] = bid
+            for m in range(len(values)):
+                self.counts[m][pos] = 0
+                self.sums[m][pos] = 0.0
+        if bid > self.last_bid:
+            self.last_bid = bid
+
+        for m, value in enumerate(values):
+            if value is None:
+                continue
+            count = self.counts[m][pos]
+            if count == 0 or value < self.mins[m][pos]:
+                self.mins[m][pos] = value
+            if count == 0 or value > self.maxs[m][pos]:
+                self.maxs[m][pos] = value
+            self.sums[m][pos] += value
+            if count < 0xFFFF:
+                self.counts[m][pos] = count + 1
+
+    def oldest_time(self):
+        """当前保留的最早时间"""
+        return (self.last_bid - self.size + 1) * self.width
+
+    def points(self, m, start, end):
+        """按桶编号直接定位窗口内的桶，不扫描其他数据"""
+        first = max(int(start // self.width), self.last_bid - self.size + 1)
+        last = min(int(end // self.width), self.last_bid)
+        result = []
+        for bid in range(first, last + 1):
+            pos = bid % self.size
+            count = self.counts[m][pos]
+            if self.ids[pos] == bid and count:
+                result.append((bid * self.width, self.mins[m][pos], self.sums[m][pos] / count,
+                               self.maxs[m][pos], count))
+        return result
+
+
+class TieredSeries:
+    """多分辨率长时间历史：原始采样 / 1分钟 / 10分钟聚合，每个远端占用的内存固定，与会话时长无关"""
+
+    METRICS = ('speed', 'latency')
+
+    def __init__(self, tiers=None):
+        tiers = tiers or HISTORY_TIERS
+        self.tiers = [_SeriesTier(width or SAMPLE_INTERVAL, size, self.METRICS) for width, size in tiers]
+
+    def add(self, t, speed, latency):
+        """写入一个采样点，同时累加到每一级聚合"""
+        values = (speed, latency)
+        for tier in self.tiers:
+            tier.add(t, values)
+
+    def query(self, start, end, metric='speed', resolution=0):
+        """查询时间窗口内的序列，返回 (桶秒数, [(桶起始时间, min, avg, max, count), ...])
+
+        选择覆盖窗口起点、且粒度不小于 resolution 的最细一级；都不覆盖时使用最粗的一级。
+        """
+        m = self.METRICS.index(metric)
+        candidates = [tier for tier in self.tiers if tier.width >= resolution] or self.tiers[-1:]
+        chosen = candidates[-1]
+        for tier in candidates:
+            if tier.last_bid >= 0 and tier.oldest_time() <= start:
+                chosen = tier
+                break
+        return chosen.width, chosen.points(m, start, end)
+
+
+def session_baseline(values):
+    """会话基线：取中位数和MAD（中位数绝对偏差）；样本太少时返回None"""
+    if len(values) < LAG_BASELINE_MIN_PEERS:
+        return None
+    ordered = sorted(values)
+    n = len(ordered)
+    median = (ordered[(n - 1) // 2] + ordered[n // 2]) / 2
+    deviations = sorted(abs(v - median) for v in ordered)
+    mad = (deviations[(n - 1) // 2] + deviations[n // 2]) / 2
+    return median, mad
+
+
+class LagDetector:
+    """单个远端的流式异常检测，每个采样 O(1) 更新
+
+    用EWMA跟踪该远端自己的速度/包速/延迟均值与方差，结合会话内所有远端的稳健基线
+    （中位数/MAD）判断三类异常：流量明显高于会话基线、包速骤降或断流后恢复、延迟突增。
+    连续 LAG_ENTER 个异常样本才标记，连续 LAG_EXIT 个正常样本才解除，避免来回闪烁。
+    """
+
+    __slots__ = ('samples', 'speed_mean', 'pps_mean', 'lat_mean', 'lat_var',
+                 'hits', 'clean', 'flagged', 'confidence', 'reason')
+
+    def __init__(self):
+        self.samples = 0
+        self.speed_mean = 0.0
+        self.pps_mean = 0.0
+        self.lat_mean = None
+        self.lat_var = 0.0
+        self.hits = 0  # 连续异常样本数
+        self.clean = 0  # 连续正常样本数
+        self.flagged = False
+        self.confidence = 0.0
+        self.reason = ""
+
+    def update(self, sample, baseline=None, eligible=True):
+        """输入一个采样 (speed, pps, latency, jitter, max_gap)，baseline 为 session_baseline() 结果
+
+        eligible 为False（官方服务器/局域网）时只学习不标记。返回当前是否标记。
+        """
+        speed, pps, latency, _, max_gap = sample
+        strength, reason = 0.0, ""
+        if eligible and self.samples >= LAG_WARMUP:
+            strength, reason = self._check(speed, pps, latency, max_gap, baseline)
+        # 异常样本只以较小的权重计入均值，避免基线被异常本身拉高
+        self._learn(speed, pps, latency, LAG_EWMA_ALPHA * (0.25 if strength > 0 else 1.0))
+
+        if strength > 0:
+            self.hits += 1
+            self.clean = 0
+            self.reason = reason
+            if self.hits >= LAG_ENTER or strength >= 1.0:
+                self.flagged = True
+        else:
+            self.clean += 1
+            self.hits = 0
+            if self.clean >= LAG_EXIT:
+                self.flagged = False
+                self.reason = ""
+
+        # 置信度取当前异常强度，异常消失后逐渐回落
+        if strength >= self.confidence:
+            self.confidence = strength
+        else:
+            self.confidence = self.confidence * 0.7 + strength * 0.3
+        return self.flagged
+
+    def _check(self, speed, pps, latency, max_gap, baseline):
+        """返回 (异常强度 0~1, 原因)，取最强的一项"""
+        checks = []
+
+        if baseline is not None:
+            median, mad = baseline
+            threshold = max(median + LAG_DEVIATION_Z * 1.4826 * mad, median * LAG_DEVIATION_RATIO, LAG_MIN_SPEED)
+            if speed > threshold:
+                checks.append((min(1.0, 0.5 * speed / threshold), "流量异常"))
+
+        if self.pps_mean >= LAG_MIN_PPS:
+            if max_gap >= LAG_GAP_MS and pps > 0:
+                # 同一周期内出现长时间断流随后又恢复，典型的卡网行为
+                checks.append((min(1.0, max_gap / (2 * LAG_GAP_MS) + 0.5), "断流后恢复"))
+            elif 0 < pps < self.pps_mean * LAG_COLLAPSE_RATIO:
+                # 强度上限0.9：离开战局的远端最后一个周期也会骤降，需要连续两次才标记
+                checks.append((0.9 - pps / (self.pps_mean * LAG_COLLAPSE_RATIO) * 0.4, "包速骤降"))
+
+        if latency is not None and self.lat_mean is not None:
+            limit = self.lat_mean + max(LAG_LATENCY_MIN_MS, 4 * self.lat_var ** 0.5)
+            if latency > limit:
+                checks.append((min(1.0, 0.5 * latency / limit), "延迟突增"))
+
+        if not checks:
+            return 0.0, ""
+        return max(checks)
+
+    def _learn(self, speed, pps, latency, alpha):
+        if self.samples == 0:
+            self.speed_mean = speed
+            self.pps_mean = pps
+        else:
+            self.speed_mean += alpha * (speed - self.speed_mean)
+            self.pps_mean += alpha * (pps - self.pps_mean)
+        if latency is not None:
+            if self.lat_mean is None:
+                self.lat_mean = float(latency)
+            else:
+                diff = latency - self.lat_mean
+                incr = alpha * diff
+                self.lat_mean += incr
+                self.lat_var = (1 - alpha) * (self.lat_var + diff * incr)
+        self.samples += 1
+
+
 class Peer:
     def __init__(self, ip):
         self.ip = ip
@@ -395,11 +2353,16 @@ class Peer:
         self.asn_info = "-"
         self.is_chinese = False
         self.server_type = None
-        self.last_total_bytes = 0
-        self.last_seen = time.time()
+        self.domain = None  # 反向DNS结果
+        self.geo_data = None  # 地理位置查询的原始结果（域名晚到时重新分类用）
+        self.first_seen = self.last_seen = time.time()
         self.last_geo_update = 0
-        self.history = deque(maxlen=HISTORY_SIZE)
-        threading.Thread(target=self._fetch_geo, daemon=True).start()
+        self.geo_retry_at = None  # 地理位置查询失败后，到这个时间（负缓存过期）重新查询
+        self.last_rtt = None
+        self.slot = history_store.allocate()
+        self.timeline = TieredSeries()
+        self.lag = LagDetector()
+        self._fetch_geo()  # 只查缓存和离线库，联网查询交给查询队列，不阻塞
 
     def _fetch_geo(self):
         """获取地理位置和ASN信息（带缓存）"""
@@ -414,6 +2377,13 @@ class Peer:
             self.last_geo_update = current_time
             return
 
+        self._lookup_geo(current_time)
+        # 反向DNS与地理位置来自缓存、离线库还是联网查询无关，每个公网远端都查询；
+        # 两者互不等待，谁后返回谁用已有的全部信息重新分类
+        dns_resolver.resolve(self.ip, self._on_domain)
+
+    def _lookup_geo(self, current_time):
+        """依次查缓存、离线库，都没有时提交联网查询"""
         with geo_lock:
             if self.ip in geo_cache:
                 cache_time, location, isp, asn_info, is_chinese, server_type = geo_cache[self.ip]
@@ -426,222 +2396,1549 @@ class Peer:
                     self.last_geo_update = current_time
                     return
 
-        try:
-            domain = reverse_dns_lookup(self.ip)
-
-            url = f"http://ip-api.com/json/{self.ip}?lang=zh-CN&fields=status,country,regionName,city,isp,org,as"
-            r = requests.get(url, timeout=10)
-            if r.status_code == 200:
-                d = r.json()
-                if d.get('status') == 'success':
-                    country = d.get('country', '')
-                    region = d.get('regionName', '')
-                    city = d.get('city', '')
-
-                    self.is_chinese = country == '中国'
-
-                    if self.is_chinese:
-                        location = f"{region}{city}" if city else region
-                    else:
-                        location_parts = []
-                        if country:
-                            location_parts.append(country)
-                        if region and region != city:
-                            location_parts.append(region)
-                        if city:
-                            location_parts.append(city)
-                        location = " ".join(location_parts[:2])
+        # 离线库命中则不再联网查询
+        d = offline_geo.lookup(self.ip)
+        if d:
+            self._apply_geo(d, None, cache=False)
+            return
 
-                    isp_raw = d.get('isp', '')
-                    org_raw = d.get('org', '')
-                    as_raw = d.get('as', '')
+        geo_lookup.submit(self.ip, self._apply_geo, self.geo_priority(0))
 
-                    friendly_name = get_friendly_isp_name(isp_raw, org_raw, as_raw)
+    def _on_domain(self, ip, domain):
+        """反向DNS回调：按域名分类；地理位置结果已缓存时一并更新"""
+        if not domain:
+            return
+        with geo_lock:
+            self.domain = domain
+            self._classify()
 
-                    self.location = location.strip() or "未知"
-                    self.isp = friendly_name
-                    self.asn_info = as_raw if as_raw else org_raw if org_raw else isp_raw
+    def reclassify(self):
+        """识别规则重新加载后按新规则分类"""
+        if self.isp is None:  # 局域网
+            return
+        with geo_lock:
+            self._classify()
+
+    def _classify(self):
+        """用已有的域名和ASN信息分类（持有 geo_lock 时调用）"""
+        d = self.geo_data or {}
+        asn_info = d.get('as') or d.get('org') or d.get('isp')
+        if asn_info is None and self.asn_info != "-":
+            asn_info = self.asn_info  # 来自缓存
+        server_type = get_rockstar_server_type(self.ip, self.domain, asn_info)
+        if server_type != self.server_type:
+            self.server_type = server_type
+            cached = geo_cache.get(self.ip)
+            if cached:
+                geo_cache[self.ip] = cached[:5] + (server_type,)
+
+    def retry_geo(self, traffic=0):
+        """上次查询失败且负缓存已过期时重新查询（由采样线程调用）"""
+        self.geo_retry_at = None
+        geo_lookup.submit(self.ip, self._apply_geo, self.geo_priority(traffic))
+
+    def geo_priority(self, traffic):
+        """地理位置查询的优先级：流量大的优先，其次是新出现的"""
+        return (-traffic, -self.first_seen)
+
+    def _apply_geo(self, d, error, cache=True):
+        """处理查询结果（由查询队列线程回调；重试已由查询队列完成，这里只显示最终结果）"""
+        current_time = time.time()
 
-                    server_type = get_rockstar_server_type(self.ip, domain, as_raw or org_raw or isp_raw)
-                    if server_type:
-                        self.server_type = server_type
+        if d and d.get('status') == 'success':
+            # 与 _on_domain 互斥，保证分类总是用到已返回的域名
+            with geo_lock:
+                location, isp, asn_info, is_chinese, server_type = build_geo_entry(self.ip, d, self.domain)
+                self.geo_data = d
+                self.location = location
+                self.isp = isp
+                self.asn_info = asn_info
+                self.is_chinese = is_chinese
+                if server_type:
+                    self.server_type = server_type
 
-                    with geo_lock:
-                        geo_cache[self.ip] = (current_time, self.location, self.isp, self.asn_info,
-                                              self.is_chinese, self.server_type)
+                if cache:
+                    geo_cache[self.ip] = (current_time, self.location, self.isp, self.asn_info,
+                                          self.is_chinese, self.server_type)
 
-                    self.last_geo_update = current_time
-                    return
+            self.last_geo_update = current_time
+            return
 
-        except requests.exceptions.Timeout:
+        # 与查询队列的负缓存同时过期，之后由采样线程重新提交
+        self.geo_retry_at = current_time + (GEO_FAILURE_TTL if error is not None else GEO_NEGATIVE_TTL)
+        if isinstance(error, requests.exceptions.Timeout):
             self.location = "查询超时"
             self.isp = "网络错误"
-        except Exception as e:
+        elif error is not None:
             self.location = "查询失败"
-            self.isp = f"错误: {str(e)[:20]}"
-
-        time.sleep(2)
-        self.location = "查询重试中..."
-        self.isp = "查询重试中..."
-        threading.Thread(target=self._fetch_geo, daemon=True).start()
-        #with geo_lock:
-        #    geo_cache[self.ip] = (current_time, self.location, self.isp, self.asn_info,
-        #                          self.is_chinese, self.server_type)
-
-    def record_sample(self, current_total_bytes):
-        """记录网络采样数据"""
-        if self.last_total_bytes == 0:
-            delta = 0
+            self.isp = f"错误: {str(error)[:20]}"
         else:
-            delta = current_total_bytes - self.last_total_bytes
+            self.location = "查询失败"
+            self.isp = (d or {}).get('message') or "-"
+        self.last_geo_update = current_time
 
-        if delta < 0:
-            delta = 0
+    def record_sample(self, delta_bytes, delta_packets=0, jitter=0.0, max_gap=0.0, elapsed=SAMPLE_INTERVAL, burst=0.0,
+                      direction=None):
+        """记录网络采样数据，返回按 RECORD_COLUMNS 排列的本周期数值
 
-        self.last_total_bytes = current_total_bytes
-        if delta > 0:
+        增量均为本周期值，elapsed 为本周期实际经过的秒数，抖动/间隔单位为秒，burst 为周期内的突发峰值 (KB/s)，
+        direction 为流表给出的 (发送字节, 接收字节, 发送包数, 接收包数)。
+        """
+        if delta_bytes > 0:
             self.last_seen = time.time()
 
-        speed = (delta / SAMPLE_INTERVAL) / 1024.0
+        speed = (delta_bytes / elapsed) / 1024.0
 
+        # 延迟取上一轮异步探测的结果，并为下一轮发出新的探测（不阻塞采样）
         latency = None
         if speed > 0.1:
-            try:
-                rtt = ping(self.ip, unit='ms', timeout=0.5)
-                latency = int(rtt) if rtt is not None else None
-            except:
-                latency = None
-
-        self.history.append((speed, latency))
+            latency = self.last_rtt
+            self.last_rtt = None
+            latency_prober.probe(self.ip, self._on_rtt)
+
+        pps = delta_packets / elapsed
+        up = down = 0.0
+        if direction:
+            up = direction[0] / elapsed / 1024.0
+            down = direction[1] / elapsed / 1024.0
+        history_store.append(self.slot, speed, latency, pps, jitter * 1000, max_gap * 1000, max(burst, speed), up, down)
+        self.timeline.add(time.time(), speed, latency)
+        return speed, pps, latency, jitter * 1000, max_gap * 1000
+
+    def release(self):
+        """连接移除时归还历史数据槽位"""
+        if self.slot is not None:
+            history_store.release(self.slot)
+            self.slot = None
+
+    def _on_rtt(self, ip, rtt):
+        """延迟探测回调（由探测线程调用）"""
+        self.last_rtt = int(rtt) if rtt is not None else None
 
     def get_summary(self):
-        """获取统计摘要"""
-        if not self.history:
+        """获取统计摘要（数值部分来自历史矩阵的批量计算缓存）"""
+        if self.slot is None:
+            return None
+        cached = history_store.summary(self.slot)
+        if not cached:
             return None
 
-        speeds = [x[0] for x in self.history]
-        latencies = [x[1] for x in self.history if x[1] is not None]
+        time_since_seen = time.time() - self.last_seen
+        is_alive = time_since_seen < PEER_IDLE_TIMEOUT
 
-        avg_speed = sum(speeds) / len(speeds) if speeds else 0
-        max_speed = max(speeds) if speeds else 0
-        avg_lat = sum(latencies) / len(latencies) if latencies else None
+        summary = dict(cached)
+        summary['is_alive'] = is_alive
+        summary['last_seen_sec'] = int(time_since_seen)
+        summary['is_lagger'] = self.lag.flagged
+        summary['lag_confidence'] = self.lag.confidence
+        summary['lag_reason'] = self.lag.reason
+        return summary
 
-        time_since_seen = time.time() - self.last_seen
-        is_alive = time_since_seen < (SAMPLE_INTERVAL * HISTORY_SIZE * 1.5)
 
-        is_lagger = avg_speed > 100 or max_speed > 100
+# === 核心逻辑 ===
+peers_map = {}  # 只由采样线程增删（持有 data_lock），其他线程读取 peer_snapshot
+peer_expiry = TimerWheel(1.0, 64, now=time.time())  # (远端, Peer) 按最后活动时间到期
+departed_timelines = OrderedDict()  # 已断开远端的长时间历史（按断开顺序，数量有限）
 
-        return {
-            'avg_speed': avg_speed,
-            'max_speed': max_speed,
-            'avg_lat': avg_lat,
-            'is_alive': is_alive,
-            'last_seen_sec': int(time_since_seen),
-            'is_lagger': is_lagger
-        }
 
+class PeerSnapshot:
+    """采样线程每个周期发布一次的只读快照，界面和导出直接读取，不需要加锁
 
-# === 核心逻辑 ===
-peers_map = {}
+    rows 为按均速降序的 (peer, stats) 元组，stats 在发布后不再修改（地区/运营商仍从 Peer 读取，由查询线程更新）；
+    version 每次发布递增。
+    """
 
+    __slots__ = ('version', 'time', 'rows', 'peer_count')
 
-def sniffer():
-    """网络数据包嗅探 - 仅UDP"""
-    try:
-        if ":" in LOCAL_IP:
-            local_ip, local_port = LOCAL_IP.split(":")
-            local_port = int(local_port)
+    def __init__(self, version=0, ts=0.0, rows=(), peer_count=0):
+        self.version = version
+        self.time = ts
+        self.rows = rows
+        self.peer_count = peer_count
+
+
+peer_snapshot = PeerSnapshot()
+
+
+def query_peer_history(ip, start, end, metric='speed', resolution=0):
+    """查询任意远端（含已断开的）在时间窗口内的历史序列，ip 为点分字符串"""
+    key = ip_to_int(ip)
+    peer = peers_map.get(key)
+    timeline = peer.timeline if peer else departed_timelines.get(key)
+    if timeline is None:
+        return None
+    return timeline.query(start, end, metric, resolution)
+
+
+def parse_local_ip():
+    """拆分 LOCAL_IP 配置为 (ip, port)（多个IP时取第一个）"""
+    return parse_local_ips()[0]
+
+
+def parse_local_ips():
+    """拆分 LOCAL_IP 配置为 [(ip, port), ...]，多个IP用逗号分隔，all 表示所有非回环网卡"""
+    if LOCAL_IP.strip().lower() == "all":
+        ips = [ip for _, ip in list_interface_ips()]
+        return [(ip, 0) for ip in ips] or [("127.0.0.1", 0)]
+
+    result = []
+    for item in LOCAL_IP.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        if ":" in item:
+            local_ip, local_port = item.split(":")
+            result.append((local_ip, int(local_port)))
         else:
-            local_ip = LOCAL_IP
-            local_port = 0
+            result.append((item, 0))
+    return result or [("", 0)]
+
+
+def list_interface_ips():
+    """所有非回环网卡的 (名称, IPv4地址)"""
+    result = []
+    for name, addrs in psutil.net_if_addrs().items():
+        for addr in addrs:
+            if addr.family == socket.AF_INET and not addr.address.startswith("127."):
+                result.append((name, addr.address))
+    return result
+
+
+class PacketDeduplicator:
+    """多网卡抓包去重：同一个包经过虚拟网卡和物理网卡会被抓到两次，只统计先到的那份
+
+    以 (远端IP, 远端端口, UDP长度, 载荷前32字节) 为键，NAT改写本地地址/端口后仍能匹配；
+    两代字典轮换，键最多保留 2*window 秒。setdefault 在GIL下是原子的，多个抓包线程可以共用。
+    """
+
+    def __init__(self, window=0.5):
+        self.window = window
+        self.current = {}
+        self.previous = {}
+        self.rotated = time.monotonic()
+
+    def is_duplicate(self, key, source, now):
+        if now - self.rotated > self.window:
+            self.previous, self.current = self.current, {}
+            self.rotated = now
+        first = self.current.setdefault(key, source)
+        if first != source:
+            return True
+        return self.previous.get(key, source) != source
+
+
+packet_dedup = None  # 多网卡抓包时的 PacketDeduplicator
+peer_interfaces = {}  # 远端IP整数 -> 抓到它的网卡名称集合
+capture_interfaces = []  # 正在抓包的网卡名称
+
 
+# IPv4首部只取需要的字段：版本/首部长度、协议、源地址、目的地址（地址保持为32位整数）
+IPV4_HEADER = struct.Struct('!B8xB2xII')
+UDP_PORTS = struct.Struct('!HH')
+MULTICAST_MASK = 0xF0000000
+MULTICAST_NET = 0xE0000000  # 224.0.0.0/4
+BROADCAST_NET = 0xFF  # 255.0.0.0/8（高8位）
+
+
+def int_to_ip(value):
+    """32位整数转点分IPv4"""
+    return socket.inet_ntoa(struct.pack('!I', value))
+
+
+def account_packet(buf, length, local_ip, now, iface=None, table=None):
+    """解析IPv4/UDP数据包，按端口过滤后累计远端IP流量（并按流区分收发方向），返回是否计入
+
+    buf 可以是预分配缓冲区的 memoryview，只按偏移读取需要的字段，不做切片拷贝；
+    local_ip 与远端地址均为32位整数；now 为包的到达时间（秒）；
+    iface 为抓到该包的网卡名称（多网卡抓包时用于去重和标注来源）；
+    table 为调用线程的计数分片（抓包线程启动时取一次，省略时按当前线程查找）。
+    """
+    if length < 20:
+        return False
+    vihl, proto, src, dst = IPV4_HEADER.unpack_from(buf)
+    if proto != 17:
+        return False
+
+    ihl = (vihl & 0xF) * 4
+    if length < ihl + 4:
+        return False
+    src_port, dst_port = UDP_PORTS.unpack_from(buf, ihl)
+    if src_port not in gta_ports and dst_port not in gta_ports:
+        return False
+
+    outbound = src == local_ip
+    if outbound:
+        remote, local_port, remote_port = dst, src_port, dst_port
+    else:
+        remote, local_port, remote_port = src, dst_port, src_port
+    if remote == local_ip or remote & MULTICAST_MASK == MULTICAST_NET or remote >> 24 == BROADCAST_NET:
+        return False
+
+    if iface is not None:
+        if packet_dedup is not None:
+            key = (remote, remote_port, length - ihl, bytes(buf[ihl + 8:min(length, ihl + 40)]))
+            if packet_dedup.is_duplicate(key, iface, now):
+                return False
+        names = peer_interfaces.get(remote)
+        if names is None or iface not in names:
+            peer_interfaces.setdefault(remote, set()).add(iface)
+
+    if table is None:
+        table = flow_table.shard()
+    table.account(remote, local_port, remote_port, length, outbound, now)
+    return True
+
+
+def sniffer(local_ip, local_port=0):
+    """网络数据包嗅探 - 仅UDP（每个本地IP一个线程）"""
+    iface = find_interface_name(local_ip) or local_ip
+    try:
         s = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_UDP)
         s.bind((local_ip, local_port))
         s.setsockopt(socket.IPPROTO_IP, socket.IP_HDRINCL, 1)
         if hasattr(socket, 'SIO_RCVALL') and psutil.WINDOWS:
             s.ioctl(socket.SIO_RCVALL, socket.RCVALL_ON)
     except Exception as e:
-        print(f"{Fore.RED}嗅探器初始化失败: {e}{Style.RESET_ALL}")
-        print(f"{Fore.YELLOW}请确保以管理员权限运行{Style.RESET_ALL}")
+        log_event(f"{Fore.RED}嗅探器初始化失败 ({iface}): {e}{Style.RESET_ALL}")
+        log_event(f"{Fore.YELLOW}请确保以管理员权限运行{Style.RESET_ALL}")
         return
 
+    # 预分配接收缓冲区，循环内不再为每个包分配bytes对象
+    local_ip_int = ip_to_int(local_ip)
+    table = flow_table.shard()
+    buf = bytearray(65535)
+    view = memoryview(buf)
+    recv_into = s.recv_into
+    monotonic = time.monotonic
+
     while running:
         try:
-            raw = s.recvfrom(65535)[0]
-            iph = struct.unpack('!BBHHHBBH4s4s', raw[0:20])
-            if iph[6] != 17:
-                continue
+            account_packet(view, recv_into(buf), local_ip_int, monotonic(), iface, table)
+        except struct.error:
+            pass
+        except Exception as e:
+            if running:
+                pass
 
-            ihl = (iph[0] & 0xF) * 4
-            udph = struct.unpack('!HHHH', raw[ihl:ihl + 8])
 
-            src_port = udph[0]
-            dst_port = udph[1]
-            if not (src_port in gta_ports or dst_port in gta_ports):
-                continue
+# === Linux AF_PACKET 抓包 ===
+ETH_P_IP = 0x0800
+PACKET_OUTGOING = 4
+SO_ATTACH_FILTER = getattr(socket, 'SO_ATTACH_FILTER', 26)
+BPF_INSN = struct.Struct('HBBI')  # struct sock_filter
+BPF_MAX_PORTS = 120  # 条件跳转偏移只有8位，端口太多时不在内核过滤
+
+
+def build_udp_port_filter(ports):
+    """生成经典BPF程序：只放行源或目的端口在 ports 中的IPv4/UDP包（偏移从IP首部算起）"""
+    ports = sorted(ports)
+    n = len(ports)
+    # 指令布局: 0 ldb[9] | 1 jeq17 | 2 ldh[6] | 3 jset分片 | 4 ldxb首部长度 | 5 ldh[x+0] | 源端口比较*n
+    #           | ldh[x+2] | 目的端口比较*n | 丢弃 | 放行
+    drop = 7 + 2 * n
+    accept = drop + 1
+    prog = [
+        (0x30, 0, 0, 9),  # ldb [9]        协议号
+        (0x15, 0, drop - 2, 17),  # jeq #17
+        (0x28, 0, 0, 6),  # ldh [6]        标志位/分片偏移
+        (0x45, drop - 4, 0, 0x1FFF),  # jset #0x1fff  非首个分片没有UDP头
+        (0xB1, 0, 0, 0),  # ldxb 4*([0]&0xf)
+        (0x48, 0, 0, 0),  # ldh [x+0]      源端口
+    ]
+    for i, port in enumerate(ports):
+        pc = 6 + i
+        prog.append((0x15, accept - pc - 1, 0, port))
+    prog.append((0x48, 0, 0, 2))  # ldh [x+2]  目的端口
+    for i, port in enumerate(ports):
+        pc = 7 + n + i
+        prog.append((0x15, accept - pc - 1, 0, port))
+    prog.append((0x06, 0, 0, 0))  # ret #0      丢弃
+    prog.append((0x06, 0, 0, 0x40000))  # ret #262144 放行
+    return prog
+
+
+def attach_bpf_filter(sock, prog):
+    """把BPF程序挂到套接字上（重复调用会原子替换旧的过滤器）"""
+    code = b''.join(BPF_INSN.pack(*insn) for insn in prog)
+    buf = ctypes.create_string_buffer(code, len(code))
+    fprog = struct.pack('HP', len(prog), ctypes.addressof(buf))
+    sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+
+
+def update_port_filter(sock, ports):
+    """按端口集合重新生成并挂载过滤器"""
+    if 0 < len(ports) <= BPF_MAX_PORTS:
+        attach_bpf_filter(sock, build_udp_port_filter(ports))
+    else:
+        attach_bpf_filter(sock, [(0x06, 0, 0, 0x40000)])
+
+
+def find_interface_name(ip):
+    """根据IP地址找到所属的网卡名称"""
+    for name, addrs in psutil.net_if_addrs().items():
+        for addr in addrs:
+            if addr.family == socket.AF_INET and addr.address == ip:
+                return name
+    return None
 
-            s_ip = socket.inet_ntoa(iph[8])
-            d_ip = socket.inet_ntoa(iph[9])
-            remote = d_ip if s_ip == local_ip else s_ip
 
-            if remote.startswith(("224.", "239.", "255.")) or remote == local_ip:
-                continue
+def open_af_packet_socket(ifname, ports):
+    """打开绑定到网卡的 AF_PACKET/SOCK_DGRAM 套接字（收到的数据从IP首部开始）并挂载端口过滤器"""
+    s = socket.socket(socket.AF_PACKET, socket.SOCK_DGRAM, socket.htons(ETH_P_IP))
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 << 20)
+    update_port_filter(s, ports)
+    s.bind((ifname, 0))
+    return s
 
-            with data_lock:
-                raw_bytes_map[remote] += len(raw)
 
-        except struct.error:
+def sniffer_af_packet(local_ip, local_port=0):
+    """Linux AF_PACKET 抓包：内核中用BPF丢弃非GTA端口的流量（每个网卡一个线程）"""
+    ifname = None
+    try:
+        ifname = find_interface_name(local_ip)
+        if not ifname:
+            raise OSError(f"找不到IP {local_ip} 对应的网卡")
+        s = open_af_packet_socket(ifname, gta_ports)
+    except Exception as e:
+        log_event(f"{Fore.RED}AF_PACKET 抓包初始化失败 ({ifname or local_ip}): {e}{Style.RESET_ALL}")
+        log_event(f"{Fore.YELLOW}请确保以root权限或CAP_NET_RAW运行{Style.RESET_ALL}")
+        return
+
+    def on_ports_changed(ports):
+        try:
+            update_port_filter(s, ports)
+        except OSError:
             pass
-        except Exception as e:
-            if running:
+
+    port_listeners.append(on_ports_changed)
+
+    # 回环网卡上每个包会以发出和收到各出现一次，只统计收到的那份
+    skip_outgoing = ifname == 'lo' or local_ip.startswith("127.")
+    local_ip_int = ip_to_int(local_ip)
+    table = flow_table.shard()
+    buf = bytearray(65535)
+    view = memoryview(buf)
+    recvfrom_into = s.recvfrom_into
+    monotonic = time.monotonic
+
+    try:
+        while running:
+            try:
+                n, addr = recvfrom_into(buf)
+                if skip_outgoing and addr[2] == PACKET_OUTGOING:
+                    continue
+                account_packet(view, n, local_ip_int, monotonic(), ifname, table)
+            except struct.error:
                 pass
+            except Exception as e:
+                if running:
+                    pass
+    finally:
+        port_listeners.remove(on_ports_changed)
+        s.close()
+
+
+def use_af_packet():
+    """判断是否使用 AF_PACKET 后端"""
+    if CAPTURE_BACKEND == "afpacket":
+        return True
+    return CAPTURE_BACKEND == "auto" and psutil.LINUX and hasattr(socket, 'AF_PACKET')
+
+
+# === 多进程抓包 ===
+SHM_MAGIC = b'GTAOSHM1'
+SHM_HEADER_SIZE = 64
+SHM_CAPACITY, SHM_COUNT, SHM_EPOCH = 2, 3, 4  # 头部按uint32读取的下标（0-1为魔数）
+SHM_COLUMNS = [  # (列名, 类型)，8字节列在前保证对齐
+    ('bytes', 'Q'), ('packets', 'Q'), ('tx_bytes', 'Q'), ('tx_packets', 'Q'), ('last_arrival', 'd'), ('last_gap', 'd'), ('jitter', 'd'), ('max_gap', 'd'),
+    ('keys', 'I'), ('order', 'I'), ('ifmask', 'I'),
+]
+
+
+class SharedCounterTable:
+    """跨进程的远端计数表，放在固定布局的 multiprocessing.shared_memory 中
+
+    写端（抓包进程）: keys 列是开放寻址的 IP -> 槽位 哈希表，新槽位同时追加到 order 列；
+    逐包累加字节/包数并更新到达间隔统计（与 PacketStats 相同）；已用超过 3/4 时整体清空并递增代数。
+    读端（主进程）: 按 order 列发现新槽位，经 memoryview 直接读取累计值求本周期增量，不拷贝整张表。
+    读端提供与 PacketStats 相同的 swap/collect/release/clear 接口，可直接替换；
+    也可替换 FlowTable（写端的 account 与之相同），但只按远端记录发送方向（接收 = 总量 - 发送），不保留端口。
+    每张表只有一个抓包线程写入：多个网卡时每个网卡一张表，由 CaptureCounters 合并读取。
+    """
+
+    def __init__(self, name=None, capacity=None):
+        capacity = capacity or SHARED_TABLE_SLOTS
+        if name is None:
+            if capacity & (capacity - 1):
+                raise ValueError("共享计数表容量必须是2的幂")
+            size = SHM_HEADER_SIZE + capacity * sum(array(code).itemsize for _, code in SHM_COLUMNS)
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+            self.shm.buf[:8] = SHM_MAGIC
+            self.shm.buf[8:SHM_HEADER_SIZE] = bytes(SHM_HEADER_SIZE - 8)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            if bytes(self.shm.buf[:8]) != SHM_MAGIC:
+                raise ValueError("共享计数表格式错误")
+
+        self.views = []
+        self.header = self._view(0, SHM_HEADER_SIZE, 'I')
+        if name is None:
+            self.header[SHM_CAPACITY] = capacity
+        self.capacity = self.header[SHM_CAPACITY]
+        self.mask = self.capacity - 1
+
+        offset = SHM_HEADER_SIZE
+        for column, code in SHM_COLUMNS:
+            size = self.capacity * array(code).itemsize
+            setattr(self, column, self._view(offset, offset + size, code))
+            offset += size
+
+        # 写端状态
+        self.slots = {}  # remote -> 槽位
+        # 读端状态
+        self.epoch = self.header[SHM_EPOCH]
+        self.known = 0  # 已读取的 order 项数
+        self.reader_slots = {}  # remote -> 槽位
+        self.last_bytes = {}
+        self.last_packets = {}
+        self.masks = {}  # remote -> 上次读到的网卡掩码
+        self.flow_seen = {}  # remote -> 上次读到的 (字节, 发送字节, 包数, 发送包数)
+        self.interface_names = []
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def _view(self, start, end, code):
+        view = self.shm.buf[start:end].cast(code)
+        self.views.append(view)
+        return view
+
+    def close(self):
+        for view in self.views:
+            view.release()
+        self.views = []
+        self.shm.close()
+
+    def unlink(self):
+        try:
+            self.shm.unlink()
+        except FileNotFoundError:
+            pass
+
+    # --- 写端（抓包进程）---
+    def _slot(self, remote):
+        slot = self.slots.get(remote)
+        if slot is not None or not remote:  # 0 表示空槽位
+            return slot
+
+        count = self.header[SHM_COUNT]
+        if count >= self.capacity * 3 // 4:
+            self._reset()
+            count = 0
+        slot = (remote * 2654435761) & self.mask
+        while self.keys[slot]:
+            if self.keys[slot] == remote:
+                self.slots[remote] = slot
+                return slot
+            slot = (slot + 1) & self.mask
+        self.keys[slot] = remote
+        self.order[count] = slot
+        self.header[SHM_COUNT] = count + 1  # 先写槽位再发布数量，读端不会看到未初始化的项
+        self.slots[remote] = slot
+        return slot
+
+    def _reset(self):
+        """槽位用尽时清空整张表，读端通过代数变化重新建立基线"""
+        for column, code in SHM_COLUMNS:
+            view = getattr(self, column)
+            zero = 0.0 if code == 'd' else 0
+            for slot in self.slots.values():
+                view[slot] = zero
+        self.slots = {}
+        self.header[SHM_COUNT] = 0
+        self.header[SHM_EPOCH] += 1
+
+    def account(self, remote, local_port, remote_port, length, outbound, now):
+        """兼容 FlowTable.account：一次查找槽位，累加字节/包数、到达统计（与 PacketStats.update 相同）和发送方向"""
+        slot = self.slots.get(remote)
+        if slot is None:
+            slot = self._slot(remote)
+            if slot is None:
+                return
+        self.bytes[slot] += length
+        self.packets[slot] += 1
+        if outbound:
+            self.tx_bytes[slot] += length
+            self.tx_packets[slot] += 1
+        last = self.last_arrival[slot]
+        self.last_arrival[slot] = now
+        if last:
+            gap = now - last
+            if gap > self.max_gap[slot]:
+                self.max_gap[slot] = gap
+            prev_gap = self.last_gap[slot]
+            if prev_gap:
+                self.jitter[slot] += (abs(gap - prev_gap) - self.jitter[slot]) / 16
+            self.last_gap[slot] = gap
+
+    def sync_interfaces(self, interfaces, names):
+        """把 {远端: 网卡名称集合} 写成每个槽位的网卡掩码"""
+        for remote, seen in list(interfaces.items()):
+            slot = self.slots.get(remote)
+            if slot is not None:
+                mask = 0
+                for name in seen:
+                    if name in names:
+                        mask |= 1 << names.index(name)
+                self.ifmask[slot] = mask
+
+    # --- 读端（主进程）---
+    def _refresh(self):
+        epoch = self.header[SHM_EPOCH]
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self.known = 0
+            self.reader_slots = {}
+            self.last_bytes = {}
+            self.last_packets = {}
+            self.masks = {}
+            self.flow_seen = {}
+
+        count = self.header[SHM_COUNT]
+        for i in range(self.known, count):
+            slot = self.order[i]
+            remote = self.keys[slot]
+            self.reader_slots[remote] = slot
+            self.last_bytes.setdefault(remote, 0)
+            self.last_packets.setdefault(remote, 0)
+        self.known = max(self.known, count)
+
+    def swap(self):
+        """返回本周期每个远端的字节增量，并把网卡掩码同步到 peer_interfaces"""
+        if not self.views:  # 已关闭
+            return {}
+        self._refresh()
+        deltas = {}
+        for remote, slot in self.reader_slots.items():
+            total = self.bytes[slot]
+            delta = total - self.last_bytes[remote]
+            if delta:
+                deltas[remote] = delta
+                self.last_bytes[remote] = total
+
+            mask = self.ifmask[slot]
+            if mask and mask != self.masks.get(remote):
+                self.masks[remote] = mask
+                peer_interfaces[remote] = {name for i, name in enumerate(self.interface_names) if mask >> i & 1}
+        return deltas
+
+    def collect(self, remote):
+        """读取本周期的 (包数, 抖动秒, 最大间隔秒)"""
+        if not self.views:
+            return 0, 0.0, 0.0
+        slot = self.reader_slots.get(remote)
+        if slot is None:
+            self._refresh()
+            slot = self.reader_slots.get(remote)
+            if slot is None:
+                return 0, 0.0, 0.0
+        total = self.packets[slot]
+        delta = total - self.last_packets[remote]
+        self.last_packets[remote] = total
+        max_gap = self.max_gap[slot]
+        self.max_gap[slot] = 0.0
+        return delta, self.jitter[slot], max_gap
+
+    def directions(self, now):
+        """兼容 FlowTable.directions：本周期每个远端的 (发送字节, 接收字节, 发送包数, 接收包数) 增量"""
+        self._refresh()
+        result = {}
+        for remote, slot in self.reader_slots.items():
+            current = (self.bytes[slot], self.tx_bytes[slot], self.packets[slot], self.tx_packets[slot])
+            last = self.flow_seen.get(remote, (0, 0, 0, 0))
+            if current != last:
+                self.flow_seen[remote] = current
+                total, tx, packets, tx_packets = (c - l for c, l in zip(current, last))
+                result[remote] = (tx, total - tx, tx_packets, packets - tx_packets)
+        return result
+
+    def expire(self, now):
+        """共享表没有按流的条目，无需淘汰"""
+        return 0
+
+    def flows(self, remote):
+        return []
+
+    def release(self, remote):
+        """槽位由写端在清空整表时统一回收，读端保留基线以免远端回来时把旧累计值算作增量"""
+
+    def clear(self):
+        """以当前累计值作为新的基线"""
+        if not self.views:
+            return
+        self._refresh()
+        for remote, slot in self.reader_slots.items():
+            self.last_bytes[remote] = self.bytes[slot]
+            self.last_packets[remote] = self.packets[slot]
+            self.flow_seen[remote] = (self.bytes[slot], self.tx_bytes[slot], self.packets[slot], self.tx_packets[slot])
+
+
+def capture_process_main(shm_names, targets, ports, backend, port_queue, event_queue, stop_event):
+    """抓包子进程入口：独立的解释器（独立的GIL）中为每个网卡运行抓包线程，每个线程写自己的共享表"""
+    global byte_counters, packet_stats, flow_table, gta_ports, packet_dedup, CAPTURE_BACKEND, running, ui_active
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C 由主进程处理
+    ui_active = True  # 事件转发给主进程显示，不直接打印
+    tables = [SharedCounterTable(name) for name in shm_names]
+    # 抓包线程第一次取分片时依次领取一张表
+    byte_counters = packet_stats = flow_table = CaptureCounters(factory=iter(tables).__next__)
+    gta_ports = set(ports)
+    CAPTURE_BACKEND = backend
+
+    names = [find_interface_name(ip) or ip for ip, _ in targets]
+    if len(targets) > 1:
+        packet_dedup = PacketDeduplicator()
+    capture = sniffer_af_packet if use_af_packet() else sniffer
+    for target in targets:
+        threading.Thread(target=capture, args=target, daemon=True).start()
+
+    # 主线程：接收端口变化、转发事件、同步网卡归属
+    while not stop_event.is_set():
+        try:
+            ports = port_queue.get(timeout=0.5)
+        except queue.Empty:
+            pass
+        else:
+            gta_ports = ports
+            for listener in list(port_listeners):
+                listener(ports)
+        while event_log:
+            event_queue.put(event_log.popleft())
+        for table in tables:
+            table.sync_interfaces(peer_interfaces, names)
+
+    running = False
+    for table in tables:
+        table.close()
+
+
+class CaptureProcess:
+    """抓包子进程的启动与关闭（主进程侧）"""
+
+    def __init__(self, targets, capacity=None):
+        # 每个网卡一张共享表（各自只有一个写端），读端合并
+        names = [find_interface_name(ip) or ip for ip, _ in targets]
+        self.tables = [SharedCounterTable(capacity=capacity) for _ in targets]
+        for table in self.tables:
+            table.interface_names = names
+        self.table = CaptureCounters(self.tables)
+        # 各平台统一用spawn，避免fork复制主进程中其他线程持有的锁
+        ctx = multiprocessing.get_context('spawn')
+        self.port_queue = ctx.Queue()
+        self.event_queue = ctx.Queue()
+        self.stop_event = ctx.Event()
+        self.process = ctx.Process(
+            target=capture_process_main,
+            args=([table.name for table in self.tables], targets, sorted(gta_ports), CAPTURE_BACKEND,
+                  self.port_queue, self.event_queue, self.stop_event),
+            daemon=True,
+        )
+
+    def start(self):
+        self.process.start()
+        port_listeners.append(self._on_ports_changed)
+        threading.Thread(target=self._forward_events, daemon=True).start()
+
+    def _on_ports_changed(self, ports):
+        self.port_queue.put(set(ports))
+
+    def _forward_events(self):
+        while not self.stop_event.is_set():
+            try:
+                message = self.event_queue.get(timeout=0.5)
+            except (queue.Empty, OSError, EOFError):
+                continue
+            # 子进程的消息已带时间戳
+            event_log.append(message)
+            if not ui_active:
+                print(message.split(" ", 1)[-1])
+
+    def stop(self):
+        """通知子进程退出，超时则强制结束，然后释放共享内存"""
+        if self._on_ports_changed in port_listeners:
+            port_listeners.remove(self._on_ports_changed)
+        self.stop_event.set()
+        self.process.join(2)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join(1)
+        for table in self.tables:
+            table.close()
+            table.unlink()
+
+
+capture_process = None  # --capture-process 启用时的 CaptureProcess
+
+
+# === 抓包文件回放 ===
+PCAP_READ_BUFFER = 1 << 20
+REPLAY_SCAN_PACKETS = 10000  # 推断抓包文件的本机地址时最多读取的包数
+PCAPNG_MAGIC = b'\x0a\x0d\x0d\x0a'
+# 链路层类型 -> 链路层头长度（以太网单独处理VLAN）
+LINK_HEADER_SIZES = {0: 4, 1: 14, 12: 0, 101: 0, 108: 4, 113: 16, 228: 0, 276: 20}
+
+
+def strip_link_header(linktype, data):
+    """去掉链路层头，返回IPv4数据；非IPv4返回None"""
+    if linktype == 1:
+        offset = 14
+        ethertype = data[12:14]
+        while ethertype in (b'\x81\x00', b'\x88\xa8') and len(data) >= offset + 4:
+            ethertype = data[offset + 2:offset + 4]
+            offset += 4
+        if ethertype != b'\x08\x00':
+            return None
+    else:
+        offset = LINK_HEADER_SIZES.get(linktype)
+        if offset is None:
+            return None
+
+    if len(data) < offset + 20 or data[offset] >> 4 != 4:
+        return None
+    return data[offset:]
+
+
+def _iter_pcap(f, magic):
+    """读取经典pcap格式"""
+    if magic in (b'\xd4\xc3\xb2\xa1', b'\x4d\x3c\xb2\xa1'):
+        endian = '<'
+    elif magic in (b'\xa1\xb2\xc3\xd4', b'\xa1\xb2\x3c\x4d'):
+        endian = '>'
+    else:
+        raise ValueError("不是有效的pcap/pcapng文件")
+    ts_div = 1e9 if magic in (b'\x4d\x3c\xb2\xa1', b'\xa1\xb2\x3c\x4d') else 1e6
+
+    header = f.read(20)
+    if len(header) < 20:
+        return
+    linktype = struct.unpack(endian + 'HHiIII', header)[5] & 0xFFFF
+    record = struct.Struct(endian + 'IIII')
+
+    while True:
+        rh = f.read(16)
+        if len(rh) < 16:
+            return
+        ts_sec, ts_frac, incl_len, _ = record.unpack(rh)
+        data = f.read(incl_len)
+        if len(data) < incl_len:
+            return
+        ip_data = strip_link_header(linktype, data)
+        if ip_data is not None:
+            yield ts_sec + ts_frac / ts_div, ip_data
+
+
+def _iter_pcapng(f):
+    """读取pcapng格式（SHB/IDB/EPB/SPB）"""
+    endian = '<'
+    interfaces = []  # [(linktype, 时间戳单位)]
+    last_ts = None
+
+    while True:
+        head = f.read(8)
+        if len(head) < 8:
+            return
+        if head[:4] == PCAPNG_MAGIC:
+            # 节头块决定后续字节序，接口编号重新开始
+            bom = f.read(4)
+            endian = '<' if bom == b'\x4d\x3c\x2b\x1a' else '>'
+            block_len = struct.unpack(endian + 'I', head[4:8])[0]
+            f.read(block_len - 12)
+            interfaces = []
+            continue
+
+        block_type, block_len = struct.unpack(endian + 'II', head)
+        if block_len < 12:
+            return
+        body = f.read(block_len - 8)
+        if len(body) < block_len - 8:
+            return
+        body = body[:-4]
+
+        if block_type == 1:  # 接口描述块
+            linktype = struct.unpack_from(endian + 'H', body, 0)[0]
+            ts_unit = 1e-6
+            pos = 8
+            while pos + 4 <= len(body):
+                code, length = struct.unpack_from(endian + 'HH', body, pos)
+                if code == 0:
+                    break
+                if code == 9 and length >= 1:
+                    v = body[pos + 4]
+                    ts_unit = 2.0 ** -(v & 0x7F) if v & 0x80 else 10.0 ** -v
+                pos += 4 + ((length + 3) & ~3)
+            interfaces.append((linktype, ts_unit))
+        elif block_type == 6:  # 增强分组块
+            if_id, ts_high, ts_low, cap_len, _ = struct.unpack_from(endian + 'IIIII', body, 0)
+            if if_id >= len(interfaces):
+                continue
+            linktype, ts_unit = interfaces[if_id]
+            last_ts = ((ts_high << 32) | ts_low) * ts_unit
+            ip_data = strip_link_header(linktype, body[20:20 + cap_len])
+            if ip_data is not None:
+                yield last_ts, ip_data
+        elif block_type == 3 and interfaces:  # 简单分组块（无时间戳）
+            orig_len = struct.unpack_from(endian + 'I', body, 0)[0]
+            ip_data = strip_link_header(interfaces[0][0], body[4:4 + orig_len])
+            if ip_data is not None:
+                yield last_ts, ip_data
+
+
+def iter_capture_file(path):
+    """流式读取pcap/pcapng文件，逐个返回 (时间戳, IPv4数据)"""
+    with open(path, 'rb', buffering=PCAP_READ_BUFFER) as f:
+        magic = f.read(4)
+        if magic == PCAPNG_MAGIC:
+            f.seek(0)
+            yield from _iter_pcapng(f)
+        else:
+            yield from _iter_pcap(f, magic)
+
+
+def capture_local_ips(path, limit=REPLAY_SCAN_PACKETS):
+    """统计抓包文件前 limit 个包中监控端口上的端点，最可能是本机的排在前面，返回 [(地址整数, 包数)]
+
+    抓包文件里的每个包都经过录制它的那台机器，所以本机是通信对象最多、出现次数最多的端点；
+    只有一个远端时两者相同，再优先内网地址。
+    """
+    partners = defaultdict(set)
+    counts = defaultdict(int)
+    for i, (_, raw) in enumerate(iter_capture_file(path)):
+        if i >= limit:
+            break
+        if len(raw) < 28:
+            continue
+        vihl, proto, src, dst = IPV4_HEADER.unpack_from(raw)
+        ihl = (vihl & 0xF) * 4
+        if proto != 17 or len(raw) < ihl + 4:
+            continue
+        src_port, dst_port = UDP_PORTS.unpack_from(raw, ihl)
+        if src_port in gta_ports or dst_port in gta_ports:
+            counts[src] += 1
+            counts[dst] += 1
+            partners[src].add(dst)
+            partners[dst].add(src)
+    ranked = sorted(counts, key=lambda ip: (len(partners[ip]), counts[ip], ipaddress.IPv4Address(ip).is_private),
+                    reverse=True)
+    return [(ip, counts[ip]) for ip in ranked]
+
+
+def replay_local_ip(path):
+    """回放时的本机地址：指定了单个IP时直接使用；all 或多个IP时从抓包文件推断（不能用当前机器的网卡地址）"""
+    if LOCAL_IP.strip().lower() != "all":
+        configured = [ip_to_int(ip) for ip, _ in parse_local_ips() if ip]
+        if len(configured) == 1:
+            return configured[0]
+    else:
+        configured = []
+
+    counts = capture_local_ips(path)
+    # 配置了多个IP时只在其中选择
+    candidates = [ip for ip, _ in counts if ip in configured] or [ip for ip, _ in counts]
+    if not candidates:
+        return configured[0] if configured else 0
+    log_event(f"{Fore.YELLOW}抓包文件的本机地址: {int_to_ip(candidates[0])}（按出现次数推断）{Style.RESET_ALL}")
+    return candidates[0]
+
+
+def replay_capture(path, realtime=True):
+    """回放抓包文件，走与实时抓包相同的过滤和计数逻辑；realtime为False时全速回放"""
+    try:
+        local_ip = replay_local_ip(path)
+    except (OSError, ValueError) as e:
+        log_event(f"{Fore.RED}抓包文件回放失败: {e}{Style.RESET_ALL}")
+        return 0, 0, 0.0
+    table = flow_table.shard()
+    total = accepted = 0
+    first_ts = None
+    start = time.perf_counter()
+
+    try:
+        for ts, raw in iter_capture_file(path):
+            if not running:
+                break
+            if realtime and ts is not None:
+                if first_ts is None:
+                    first_ts = ts
+                delay = (ts - first_ts) - (time.perf_counter() - start)
+                if delay > 0:
+                    time.sleep(delay)
+
+            total += 1
+            try:
+                if account_packet(raw, len(raw), local_ip, ts if ts is not None else time.monotonic(), None, table):
+                    accepted += 1
+            except struct.error:
+                pass
+    except Exception as e:
+        log_event(f"{Fore.RED}抓包文件回放失败: {e}{Style.RESET_ALL}")
+
+    return total, accepted, time.perf_counter() - start
+
+
+# === 会话录制 ===
+# 文件结构: 文件头 | 块... | 完整IP字典块 | 文件尾
+# 每个块以 RECORD_BLOCK 开头，采样块按列存放: IP编号(uint32) + RECORD_COLUMNS 各一列(float32)
+RECORD_MAGIC = b'GTAOREC1'
+RECORD_END_MAGIC = b'GTAOEND1'
+RECORD_HEADER = struct.Struct('<8sdd')  # 魔数, 开始时间, 采样间隔
+RECORD_BLOCK = struct.Struct('<B3xdI')  # 块类型, 时间戳, 条目数
+RECORD_INDEX_PREV = struct.Struct('<Q')  # 上一个索引块的偏移（0表示没有）
+RECORD_FOOTER = struct.Struct('<QQ8s')  # 最后一个索引块偏移, 完整IP字典偏移, 结束魔数
+BLOCK_FRAME, BLOCK_IPS, BLOCK_INDEX = 1, 2, 3
+RECORD_COLUMNS = ('speed', 'pps', 'latency', 'jitter', 'max_gap')  # 单位同表格: KB/s, 包/s, ms
+RECORD_INDEX_EVERY = 30  # 每多少个采样块写一个索引块
+RECORD_FLUSH_INTERVAL = 5  # 写入线程最长多久落盘一次（秒）
+
+
+def _le_bytes(values):
+    """array 转小端字节"""
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values.tobytes()
+
+
+class SessionRecorder:
+    """会话录制：采样线程只负责打包字节，写文件由后台线程批量完成，不会阻塞采样
+
+    record 与 close 持有同一把锁：close 开始后 record 不再写入，完整IP字典之后不会再出现新的块。
+    """
+
+    def __init__(self, path, interval=SAMPLE_INTERVAL):
+        self.path = path
+        self.file = open(path, 'wb')
+        self.lock = threading.Lock()
+        self.finished = False  # close 已开始，之后的 record 直接忽略
+        self.cond = threading.Condition()
+        self.pending = []
+        self.closed = False
+        self.ids = {}  # IP整数 -> 编号
+        self.index = []  # 上一个索引块之后的 (时间戳, 偏移)
+        self.last_index = 0
+        self.offset = 0  # 已交给写入线程的字节数，即下一个块的偏移
+        self._emit(RECORD_HEADER.pack(RECORD_MAGIC, time.time(), interval))
+        self.thread = threading.Thread(target=self._writer, daemon=True)
+        self.thread.start()
+
+    def record(self, ts, ips, samples):
+        """记录一个采样周期：ips 为IP整数列表，samples 为对应的 RECORD_COLUMNS 数值元组"""
+        with self.lock:
+            if self.finished:
+                return
+            new_ips = [ip for ip in ips if ip not in self.ids]
+            if new_ips:
+                for ip in new_ips:
+                    self.ids[ip] = len(self.ids)
+                self._emit(self._ips_block(ts, new_ips))
+
+            parts = [RECORD_BLOCK.pack(BLOCK_FRAME, ts, len(ips)),
+                     _le_bytes(array('I', [self.ids[ip] for ip in ips]))]
+            for column in zip(*samples) if samples else ():
+                parts.append(_le_bytes(array('f', [NAN if v is None else v for v in column])))
+            self.index.append((ts, self.offset))
+            self._emit(b"".join(parts))
+
+            if len(self.index) >= RECORD_INDEX_EVERY:
+                self._write_index(ts)
+
+    def _ips_block(self, ts, ips):
+        return (RECORD_BLOCK.pack(BLOCK_IPS, ts, len(ips))
+                + _le_bytes(array('I', [self.ids[ip] for ip in ips]))
+                + _le_bytes(array('I', ips)))
+
+    def _write_index(self, ts):
+        """索引块记录最近一批采样块的时间和偏移，并指向上一个索引块"""
+        offset = self.offset
+        self._emit(RECORD_BLOCK.pack(BLOCK_INDEX, ts, len(self.index))
+                   + RECORD_INDEX_PREV.pack(self.last_index)
+                   + _le_bytes(array('d', [t for t, _ in self.index]))
+                   + _le_bytes(array('Q', [o for _, o in self.index])))
+        self.last_index = offset
+        self.index = []
+
+    def _emit(self, data):
+        with self.cond:
+            self.pending.append(data)
+            self.offset += len(data)
+
+    def _writer(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.closed, RECORD_FLUSH_INTERVAL)
+                chunks, self.pending = self.pending, []
+                closed = self.closed
+            if chunks:
+                self.file.write(b"".join(chunks))
+                self.file.flush()
+            if closed:
+                return
+
+    def close(self):
+        """写入剩余索引、完整IP字典和文件尾"""
+        with self.lock:
+            if self.finished:
+                return
+            self.finished = True
+            now = time.time()
+            if self.index:
+                self._write_index(now)
+            dict_offset = self.offset
+            self._emit(self._ips_block(now, list(self.ids)))
+            self._emit(RECORD_FOOTER.pack(self.last_index, dict_offset, RECORD_END_MAGIC))
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join()
+        self.file.close()
+
+
+session_recorder = None  # --record 启用时的 SessionRecorder
+
+
+class SessionRecording:
+    """离线分析录制文件：mmap打开，只读取问题涉及的块和列"""
+
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.mm) < RECORD_HEADER.size:
+            raise ValueError("录制文件不完整")
+        magic, self.start_time, self.interval = RECORD_HEADER.unpack_from(self.mm, 0)
+        if magic != RECORD_MAGIC:
+            raise ValueError("不是有效的录制文件")
+        self.frames = []  # 按时间排序的 (时间戳, 偏移)
+        self.ips = {}  # 编号 -> IP整数
+        try:
+            loaded = self._load_index()
+        except (ValueError, TypeError, struct.error):
+            loaded = False  # 索引损坏：与文件不完整一样逐块扫描
+        if not loaded:
+            self.frames = []
+            self.ips = {}
+            self._scan()
+        self.frame_times = [ts for ts, _ in self.frames]
+
+    def close(self):
+        self.mm.close()
+        self.file.close()
+
+    def _column(self, offset, count, code, skip):
+        """读取块内的一列（skip 为该列之前的字节数）"""
+        start = offset + RECORD_BLOCK.size + skip
+        data = self.mm[start:start + count * array(code).itemsize]
+        if sys.byteorder == 'big':
+            values = array(code, data)
+            values.byteswap()
+            return values
+        return memoryview(data).cast(code)
+
+    def _read_ips(self, offset, count):
+        ids = self._column(offset, count, 'I', 0)
+        ips = self._column(offset, count, 'I', count * 4)
+        self.ips.update(zip(ids, ips))
+
+    def _load_index(self):
+        """文件正常结束时沿索引块链表定位所有采样块，不扫描采样数据"""
+        if len(self.mm) < RECORD_HEADER.size + RECORD_FOOTER.size:
+            return False
+        last_index, dict_offset, magic = RECORD_FOOTER.unpack_from(self.mm, len(self.mm) - RECORD_FOOTER.size)
+        if magic != RECORD_END_MAGIC:
+            return False
+
+        offset = last_index
+        while offset:
+            kind, _, count = RECORD_BLOCK.unpack_from(self.mm, offset)
+            prev, = RECORD_INDEX_PREV.unpack_from(self.mm, offset + RECORD_BLOCK.size)
+            # 链表只能指向更早的位置，否则可能死循环
+            if kind != BLOCK_INDEX or prev >= offset:
+                raise ValueError("索引块损坏")
+            skip = RECORD_INDEX_PREV.size
+            times = self._column(offset, count, 'd', skip)
+            offsets = self._column(offset, count, 'Q', skip + count * 8)
+            for frame_offset in offsets:
+                if RECORD_BLOCK.unpack_from(self.mm, frame_offset)[0] != BLOCK_FRAME:
+                    raise ValueError("索引指向的采样块损坏")
+            self.frames[:0] = zip(times, offsets)
+            offset = prev
+
+        kind, _, count = RECORD_BLOCK.unpack_from(self.mm, dict_offset)
+        if kind != BLOCK_IPS:
+            raise ValueError("IP字典块损坏")
+        self._read_ips(dict_offset, count)
+        return True
+
+    def _scan(self):
+        """文件没有正常结束（程序崩溃）时逐块扫描块头恢复"""
+        offset = RECORD_HEADER.size
+        end = len(self.mm)
+        while offset + RECORD_BLOCK.size <= end:
+            kind, ts, count = RECORD_BLOCK.unpack_from(self.mm, offset)
+            if kind == BLOCK_FRAME:
+                size = count * 4 * (1 + len(RECORD_COLUMNS))
+            elif kind == BLOCK_IPS:
+                size = count * 8
+            elif kind == BLOCK_INDEX:
+                size = RECORD_INDEX_PREV.size + count * 16
+            else:
+                break
+            if offset + RECORD_BLOCK.size + size > end:
+                break
+            if kind == BLOCK_FRAME:
+                self.frames.append((ts, offset))
+            elif kind == BLOCK_IPS:
+                self._read_ips(offset, count)
+            offset += RECORD_BLOCK.size + size
+
+    def frame(self, offset, *columns):
+        """读取一个采样块的IP编号和指定列"""
+        _, _, count = RECORD_BLOCK.unpack_from(self.mm, offset)
+        result = [self._column(offset, count, 'I', 0)]
+        for name in columns:
+            skip = count * 4 * (1 + RECORD_COLUMNS.index(name))
+            result.append(self._column(offset, count, 'f', skip))
+        return result
+
+    def frames_between(self, start, end):
+        """时间窗口 [start, end) 内的采样块（二分定位）"""
+        lo = bisect.bisect_left(self.frame_times, start)
+        hi = bisect.bisect_left(self.frame_times, end)
+        return self.frames[lo:hi]
+
+    def top_talkers(self, limit=10):
+        """整个会话流量最大的远端，返回 [(IP, KB)]"""
+        totals = defaultdict(float)
+        for _, offset in self.frames:
+            ids, speeds = self.frame(offset, 'speed')
+            for peer_id, speed in zip(ids, speeds):
+                totals[peer_id] += speed
+        top = sorted(totals.items(), key=lambda x: x[1], reverse=True)[:limit]
+        return [(int_to_ip(self.ips[peer_id]), kb * self.interval) for peer_id, kb in top]
+
+    def exceed_periods(self, ip, threshold=100):
+        """某个远端速度超过阈值 (KB/s) 的时间段，返回 [(开始, 结束, 峰值)]"""
+        target = ip_to_int(ip)
+        peer_id = next((k for k, v in self.ips.items() if v == target), None)
+        if peer_id is None:
+            return []
+
+        periods = []
+        current = None
+        for ts, offset in self.frames:
+            ids, speeds = self.frame(offset, 'speed')
+            speed = next((s for i, s in zip(ids, speeds) if i == peer_id), 0.0)
+            if speed > threshold:
+                if current is None:
+                    current = [ts - self.interval, ts, speed]
+                else:
+                    current[1] = ts
+                    current[2] = max(current[2], speed)
+            elif current is not None:
+                periods.append(tuple(current))
+                current = None
+        if current is not None:
+            periods.append(tuple(current))
+        return periods
+
+    def peers_in_minute(self, minute):
+        """会话第 minute 分钟（从0开始）内有流量的远端，返回 [(IP, KB)]"""
+        start = self.start_time + minute * 60
+        totals = defaultdict(float)
+        for _, offset in self.frames_between(start, start + 60):
+            ids, speeds = self.frame(offset, 'speed')
+            for peer_id, speed in zip(ids, speeds):
+                if speed > 0:
+                    totals[peer_id] += speed
+        ranked = sorted(totals.items(), key=lambda x: x[1], reverse=True)
+        return [(int_to_ip(self.ips[peer_id]), kb * self.interval) for peer_id, kb in ranked]
+
+
+def run_analysis(args):
+    """离线分析录制文件并输出结果"""
+    try:
+        recording = SessionRecording(args.analyze)
+    except (OSError, ValueError) as e:
+        print(f"{Fore.RED}无法打开录制文件: {e}{Style.RESET_ALL}")
+        return
+
+    duration = recording.frame_times[-1] - recording.start_time if recording.frames else 0
+    print(f"{Fore.CYAN}录制开始: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(recording.start_time))} | "
+          f"时长: {duration / 60:.1f} 分钟 | 采样: {len(recording.frames)} 次 | "
+          f"远端: {len(recording.ips)} 个{Style.RESET_ALL}")
+
+    if args.peer:
+        periods = recording.exceed_periods(args.peer, args.threshold)
+        print(f"{Fore.YELLOW}{args.peer} 超过 {args.threshold:g} KB/s 的时间段:{Style.RESET_ALL}")
+        for start, end, peak in periods:
+            print(f"  {time.strftime('%H:%M:%S', time.localtime(start))} - "
+                  f"{time.strftime('%H:%M:%S', time.localtime(end))}  峰值 {peak:.1f} KB/s")
+        if not periods:
+            print("  无")
+    elif args.minute is not None:
+        peers = recording.peers_in_minute(args.minute)
+        print(f"{Fore.YELLOW}第 {args.minute} 分钟内的远端 ({len(peers)} 个):{Style.RESET_ALL}")
+        for ip, kb in peers:
+            print(f"  {pad_text(ip, 15)} {kb:>10.1f} KB")
+    else:
+        print(f"{Fore.YELLOW}流量最大的 {args.top} 个远端:{Style.RESET_ALL}")
+        for ip, kb in recording.top_talkers(args.top):
+            print(f"  {pad_text(ip, 15)} {kb:>10.1f} KB")
+
+    recording.close()
+
+
+def sample_once(deltas, elapsed=SAMPLE_INTERVAL, bursts=None):
+    """处理一个采样周期：deltas 为本周期各远端的字节增量，elapsed 为周期实际秒数，bursts 为各远端的突发峰值 (KB/s)"""
+    bursts = bursts or {}
+    flow_now = time.monotonic()
+    directions = flow_table.directions(flow_now)
+    flow_table.expire(flow_now)
+    # 远端地址以整数为键，只在创建Peer时转换为文本
+    for ip in deltas:
+        if ip not in peers_map:
+            peer = Peer(int_to_ip(ip))
+            with data_lock:
+                peers_map[ip] = peer
+            peer_expiry.schedule((ip, peer), peer.last_seen + PEER_IDLE_TIMEOUT)
+            log_event(f"{Fore.GREEN}检测到新连接: {peer.ip}{Style.RESET_ALL}")
+
+    peers = list(peers_map.items())
+    samples = []
+    for ip, peer in peers:
+        delta_packets, jitter, max_gap = packet_stats.collect(ip)
+        samples.append(peer.record_sample(deltas.get(ip, 0), delta_packets, jitter, max_gap,
+                                          elapsed, bursts.get(ip, 0.0), directions.get(ip)))
+
+    if session_recorder:
+        session_recorder.record(time.time(), [ip for ip, _ in peers], samples)
+
+    # 所有远端写入后一次性批量计算摘要
+    history_store.summarize()
+
+    # 异常检测：先用更新前的均值算出会话基线，再逐个远端更新
+    def eligible(peer):
+        return not peer.server_type and peer.location != "区域网"
+
+    baseline = session_baseline([peer.lag.speed_mean for _, peer in peers
+                                 if peer.lag.samples >= LAG_WARMUP and eligible(peer)])
+    for (ip, peer), sample in zip(peers, samples):
+        peer.lag.update(sample, baseline, eligible(peer))
+
+    # 还在排队的地理位置查询按本周期流量调整先后；查询失败的在负缓存过期后重新提交
+    geo_lookup.reprioritize({peer.ip: peer.geo_priority(deltas.get(ip, 0)) for ip, peer in peers})
+    now = time.time()
+    for ip, peer in peers:
+        if peer.geo_retry_at is not None and peer.geo_retry_at <= now:
+            peer.retry_geo(deltas.get(ip, 0))
+
+    # 只检查时间轮中到期的远端；期间有过流量的按最后活动时间重新排期
+    for ip, peer in peer_expiry.advance(now):
+        if peers_map.get(ip) is not peer:
+            continue
+        deadline = peer.last_seen + PEER_IDLE_TIMEOUT
+        if deadline > now:
+            peer_expiry.schedule((ip, peer), deadline)
+            continue
+        with data_lock:
+            del peers_map[ip]
+        log_event(f"{Fore.YELLOW}连接超时移除: {peer.ip}{Style.RESET_ALL}")
+        packet_stats.release(ip)
+        peer_interfaces.pop(ip, None)
+        peer.release()
+        departed_timelines[ip] = peer.timeline
+        departed_timelines.move_to_end(ip)
+        while len(departed_timelines) > DEPARTED_HISTORY_LIMIT:
+            departed_timelines.popitem(last=False)
 
 
 def sampler():
-    """定期采样数据"""
+    """按单调时钟定时采样，不随处理耗时漂移
+
+    每 SAMPLE_RESOLUTION 秒读取一次计数器，按实际间隔算出各远端的瞬时速度并保留最大值（突发峰值）；
+    累计满 SAMPLE_INTERVAL 后按实际经过的时间汇总一次。每次读取只处理本次有流量的远端。
+    """
+    resolution = min(max(SAMPLE_RESOLUTION, MIN_SAMPLE_RESOLUTION), SAMPLE_INTERVAL)
+    window_start = last_tick = time.monotonic()
+    next_tick = window_start + resolution
+    next_sample = window_start + SAMPLE_INTERVAL
+    totals = defaultdict(int)
+    bursts = {}
     while running:
-        time.sleep(SAMPLE_INTERVAL)
+        delay = next_tick - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        now = time.monotonic()
+        # 按固定时刻推进；处理太慢错过的时刻直接跳过，不连续补采
+        next_tick += resolution
+        if next_tick <= now:
+            next_tick += (int((now - next_tick) / resolution) + 1) * resolution
+
+        elapsed = now - last_tick
+        last_tick = now
+        deltas = byte_counters.swap()
+        if elapsed > 0:
+            for ip, delta in deltas.items():
+                totals[ip] += delta
+                rate = delta / elapsed / 1024.0
+                if rate > bursts.get(ip, 0.0):
+                    bursts[ip] = rate
+        else:
+            for ip, delta in deltas.items():
+                totals[ip] += delta
+
+        if now >= next_sample:
+            sample_once(totals, now - window_start, bursts)
+            snapshot = publish_peer_snapshot()
+            window_start = now
+            totals = defaultdict(int)
+            bursts = {}
+            next_sample += SAMPLE_INTERVAL
+            if next_sample <= now:
+                next_sample = now + SAMPLE_INTERVAL
+            if metrics_exporter:
+                metrics_exporter.publish(snapshot.rows)
+
+
+def collect_peer_rows():
+    """取出所有有摘要的连接，返回按均速降序的 (peer, stats) 列表"""
+    rows = []
+    with data_lock:
+        peers = list(peers_map.values())
+    for peer in peers:
+        stats = peer.get_summary()
+        if stats:
+            rows.append((peer, stats))
+    rows.sort(key=lambda x: x[1]['avg_speed'], reverse=True)
+    return rows
+
+
+def publish_peer_snapshot():
+    """由采样线程调用：每个周期只计算一次摘要，整体替换 peer_snapshot"""
+    global peer_snapshot
+    rows = collect_peer_rows()
+    peer_snapshot = PeerSnapshot(peer_snapshot.version + 1, time.time(), tuple(rows), len(peers_map))
+    return peer_snapshot
+
+
+class GamePortWatcher:
+    """缓存已发现的游戏进程，只有进程全部退出后才重新全量扫描进程列表
+
+    Linux 上直接读取 /proc/<pid>/fd 的套接字inode，再到 /proc/net/udp 中按inode匹配本地端口；
+    只有出现既不在UDP表、也不是已知非UDP（TCP/unix等）的新inode时才重新解析 /proc/net/udp。
+    """
+
+    OTHER_INODES_LIMIT = 4096
+
+    def __init__(self, keywords):
+        self.keywords = keywords
+        self.processes = []
+        self.inode_ports = {}  # 套接字inode -> 本地UDP端口
+        self.other_inodes = set()  # 上次解析后确认不在UDP表中的套接字inode
+        self.use_proc = os.path.isdir('/proc/self/fd')
+
+    def refresh(self):
+        """检查缓存的进程是否还在运行，全部退出时全量扫描；返回新发现的进程列表"""
+        self.processes = [p for p in self.processes if p.is_running()]
+        if self.processes:
+            return []
+
+        found = []
+        for p in psutil.process_iter(['name']):
+            name = p.info['name']
+            if name and any(x in name for x in self.keywords):
+                found.append(p)
+        self.processes = found
+        return found
+
+    def ports(self):
+        """所有游戏进程当前绑定的本地UDP端口"""
+        ports = set()
+        for p in list(self.processes):
+            try:
+                ports |= self._process_ports(p)
+            except (psutil.NoSuchProcess, psutil.ZombieProcess):
+                self.processes.remove(p)
+            except psutil.AccessDenied:
+                pass
+        return ports
 
-        with data_lock:
-            current_ips = list(raw_bytes_map.keys())
+    def _process_ports(self, p):
+        if self.use_proc:
+            try:
+                return self._proc_ports(p.pid)
+            except FileNotFoundError:
+                raise psutil.NoSuchProcess(p.pid)
+            except PermissionError:
+                pass
+        return {conn.laddr.port for conn in p.net_connections(kind='udp') if conn.laddr}
 
-        for ip in current_ips:
-            if ip not in peers_map:
-                peers_map[ip] = Peer(ip)
-                print(f"{Fore.GREEN}检测到新连接: {ip}{Style.RESET_ALL}")
+    def _proc_ports(self, pid):
+        fd_dir = f"/proc/{pid}/fd"
+        inodes = set()
+        for fd in os.listdir(fd_dir):
+            try:
+                target = os.readlink(f"{fd_dir}/{fd}")
+            except OSError:
+                continue
+            if target.startswith('socket:['):
+                inodes.add(int(target[8:-1]))
+
+        unknown = [inode for inode in inodes if inode not in self.inode_ports and inode not in self.other_inodes]
+        if unknown:
+            self.inode_ports = read_proc_udp_inodes()
+            if len(self.other_inodes) > self.OTHER_INODES_LIMIT:
+                self.other_inodes = {inode for inode in self.other_inodes if inode in inodes}
+            self.other_inodes.update(inode for inode in unknown if inode not in self.inode_ports)
+        return {self.inode_ports[inode] for inode in inodes if inode in self.inode_ports}
+
+
+def read_proc_udp_inodes(paths=('/proc/net/udp', '/proc/net/udp6')):
+    """解析 /proc/net/udp 和 udp6，返回 {inode: 本地端口}"""
+    result = {}
+    for path in paths:
+        try:
+            with open(path) as f:
+                next(f, None)
+                for line in f:
+                    fields = line.split()
+                    if len(fields) > 9:
+                        result[int(fields[9])] = int(fields[1].rsplit(':', 1)[1], 16)
+        except OSError:
+            pass
+    return result
 
-        for ip, peer in list(peers_map.items()):
-            with data_lock:
-                current_total = raw_bytes_map.get(ip, 0)
 
-            peer.record_sample(current_total)
+def rules_watcher():
+    """规则文件修改后重新编译，并对现有连接重新分类（不影响抓包）"""
+    while running:
+        time.sleep(SERVER_RULES_CHECK_INTERVAL)
+        if server_rules.load():
+            log_event(f"{Fore.CYAN}已重新加载识别规则: {server_rules.source} "
+                      f"({server_rules.index.rule_count} 条){Style.RESET_ALL}")
+            with data_lock:
+                peers = list(peers_map.values())
+            for peer in peers:
+                peer.reclassify()
 
-            stats = peer.get_summary()
-            if stats and not stats['is_alive']:
-                with data_lock:
-                    if ip in peers_map:
-                        print(f"{Fore.YELLOW}连接超时移除: {ip}{Style.RESET_ALL}")
-                        del peers_map[ip]
-                    if ip in raw_bytes_map:
-                        del raw_bytes_map[ip]
 
 def port_scanner():
-    """扫描GTA5进程端口"""
+    """跟踪GTA5进程的UDP端口，变化时立即通知抓包线程"""
     global gta_ports
+    watcher = GamePortWatcher(TARGET_PROCESS_KEYWORDS)
     while running:
         tmp = set()
         try:
-            for p in psutil.process_iter(['name']):
-                try:
-                    if p.info['name'] and any(x in p.info['name'] for x in TARGET_PROCESS_KEYWORDS):
-                        connections = p.net_connections(kind='udp')
-                        for conn in connections:
-                            if conn.laddr:
-                                port = conn.laddr.port
-                                if port in UDP_PORTS_TO_MONITOR:
-                                    tmp.add(port)
-                except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
-                    pass
+            for p in watcher.refresh():
+                log_event(f"{Fore.CYAN}发现游戏进程: {p.info['name']} (PID {p.pid}){Style.RESET_ALL}")
+            tmp = {port for port in watcher.ports() if port in UDP_PORTS_TO_MONITOR}
         except Exception as e:
             if running:
                 pass
@@ -650,10 +3947,243 @@ def port_scanner():
 
         if all_ports != gta_ports:
             gta_ports = all_ports
+            for listener in list(port_listeners):
+                listener(gta_ports)
             if gta_ports:
-                print(f"{Fore.CYAN}监控UDP端口: {sorted(gta_ports)}{Style.RESET_ALL}")
+                log_event(f"{Fore.CYAN}监控UDP端口: {sorted(gta_ports)}{Style.RESET_ALL}")
+
+        # 已找到游戏进程时只读取它的套接字，开销很小，可以更频繁地检查
+        time.sleep(PORT_CHECK_INTERVAL if watcher.processes else PORT_SCAN_INTERVAL)
+
+
+# === 无界面模式 / 指标导出 ===
+# (指标名, 摘要字段, 说明)
+PEER_METRICS = [
+    ("gtao_peer_avg_speed_kbps", 'avg_speed', "最近采样的平均速度 (KB/s)"),
+    ("gtao_peer_max_speed_kbps", 'max_speed', "最近采样的峰值速度 (KB/s)"),
+    ("gtao_peer_p95_speed_kbps", 'p95_speed', "最近采样速度的95分位 (KB/s)"),
+    ("gtao_peer_burst_kbps", 'max_burst', "最近采样中按采样分辨率计算的突发峰值 (KB/s)"),
+    ("gtao_peer_upload_kbps", 'avg_up', "最近采样中本机发往该远端的平均速度 (KB/s)"),
+    ("gtao_peer_download_kbps", 'avg_down', "最近采样中该远端发往本机的平均速度 (KB/s)"),
+    ("gtao_peer_latency_ms", 'avg_lat', "平均延迟 (ms)"),
+    ("gtao_peer_packets_per_second", 'avg_pps', "平均包速 (包/s)"),
+    ("gtao_peer_jitter_ms", 'jitter', "包到达间隔抖动 (ms)"),
+    ("gtao_peer_max_gap_ms", 'max_gap', "最大包到达间隔 (ms)"),
+    ("gtao_peer_last_seen_seconds", 'last_seen_sec', "距最后一次收到流量的秒数"),
+    ("gtao_peer_alive", 'is_alive', "连接是否存活 (1/0)"),
+    ("gtao_peer_lagger", 'is_lagger', "是否疑似卡逼 (1/0)"),
+    ("gtao_peer_lag_confidence", 'lag_confidence', "卡逼检测置信度 (0~1)"),
+]
 
-        time.sleep(5)
+
+def peer_record(peer, stats):
+    """一个连接的完整导出字段（摘要 + 地理/ASN/服务器类型），裸连玩家的IP与界面一样隐藏中间2位"""
+    record = {
+        'ip': mask_ip_for_privacy(peer.ip, peer.is_chinese),
+        'location': peer.location,
+        'isp': peer.isp,
+        'asn': peer.asn_info,
+        'server_type': peer.server_type,
+        'is_chinese': peer.is_chinese,
+        'interfaces': sorted(peer_interfaces.get(ip_to_int(peer.ip), ())),
+        'flows': flow_table.flows(ip_to_int(peer.ip)),
+    }
+    record.update(stats)
+    return record
+
+
+def peer_history_record(ip, minutes, metric='speed', resolution=0):
+    """/history 的返回内容：ip 最近 minutes 分钟的历史序列；没有该远端时返回None"""
+    end = time.time()
+    result = query_peer_history(ip, end - minutes * 60, end, metric, resolution)
+    if result is None:
+        return None
+    width, points = result
+    return {
+        'ip': ip,
+        'metric': metric,
+        'bucket_seconds': width,
+        'points': [{'t': t, 'min': lo, 'avg': avg, 'max': hi, 'count': count}
+                   for t, lo, avg, hi, count in points],
+    }
+
+
+def prometheus_label(value):
+    """转义Prometheus标签值"""
+    return str(value or "").replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_prometheus(records, timestamp):
+    """生成Prometheus文本格式"""
+    lines = [
+        "# HELP gtao_peers 当前活跃连接数",
+        "# TYPE gtao_peers gauge",
+        f"gtao_peers {len(records)}",
+        "# HELP gtao_snapshot_timestamp_seconds 快照生成时间",
+        "# TYPE gtao_snapshot_timestamp_seconds gauge",
+        f"gtao_snapshot_timestamp_seconds {timestamp:.3f}",
+    ]
+    labels = [
+        'ip="{}",location="{}",asn="{}",server_type="{}"'.format(
+            r['ip'], prometheus_label(r['location']), prometheus_label(r['asn']),
+            prometheus_label(r['server_type']))
+        for r in records
+    ]
+    # 隐藏后的IP可能重复，同一组标签只输出第一个（records 按均速降序）
+    seen = set()
+    unique = []
+    for r, label in zip(records, labels):
+        if label not in seen:
+            seen.add(label)
+            unique.append((r, label))
+    for name, key, help_text in PEER_METRICS:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        for r, label in unique:
+            value = r[key]
+            if value is None:
+                continue
+            lines.append(f"{name}{{{label}}} {float(value):g}")
+    return ("\n".join(lines) + "\n").encode('utf-8')
+
+
+class MetricsExporter:
+    """无界面模式的指标服务
+
+    采样线程每个周期生成一次快照（Prometheus文本和NDJSON都预先编码好），
+    请求只读取最新快照，抓取频率再高也不会影响采样。
+    """
+
+    def __init__(self, host, port):
+        self.cond = threading.Condition()
+        self.snapshot = (0, b"", b"")  # (版本号, Prometheus文本, NDJSON)
+        self.stopped = False
+        self.server = ThreadingHTTPServer((host, port), self._make_handler())
+        self.server.daemon_threads = True
+
+    @property
+    def address(self):
+        host, port = self.server.server_address[:2]
+        return f"{host}:{port}"
+
+    def start(self):
+        self.publish([])
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def publish(self, rows):
+        """由采样线程调用：生成新版本快照并唤醒所有流式连接"""
+        now = time.time()
+        records = [peer_record(peer, stats) for peer, stats in rows]
+        metrics = format_prometheus(records, now)
+        stream = b"".join(
+            json.dumps(dict(r, ts=round(now, 3)), ensure_ascii=False).encode('utf-8') + b"\n"
+            for r in records
+        )
+        with self.cond:
+            self.snapshot = (self.snapshot[0] + 1, metrics, stream)
+            self.cond.notify_all()
+
+    def wait_snapshot(self, seen_version, timeout=None):
+        """等待比 seen_version 更新的快照；服务停止时返回None"""
+        with self.cond:
+            self.cond.wait_for(lambda: self.stopped or self.snapshot[0] > seen_version, timeout)
+            if self.stopped:
+                return None
+            return self.snapshot
+
+    def _make_handler(self):
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                path, _, query = self.path.partition('?')
+                version, metrics, stream = exporter.snapshot
+                if path == '/metrics':
+                    self._reply('text/plain; version=0.0.4; charset=utf-8', metrics)
+                elif path == '/snapshot':
+                    self._reply('application/x-ndjson; charset=utf-8', stream)
+                elif path == '/stream':
+                    self._stream(version, stream)
+                elif path == '/history':
+                    self._history(parse_qs(query))
+                else:
+                    self.send_error(404)
+
+            def _history(self, params):
+                # /history?ip=1.2.3.4&minutes=10[&metric=latency][&resolution=60]
+                try:
+                    ip = params['ip'][0]
+                    ip_to_int(ip)
+                    minutes = float(params.get('minutes', ['10'])[0])
+                    metric = params.get('metric', ['speed'])[0]
+                    resolution = float(params.get('resolution', ['0'])[0])
+                    if metric not in TieredSeries.METRICS or minutes <= 0:
+                        raise ValueError(metric)
+                except (KeyError, ValueError, OSError):
+                    self.send_error(400, explain="需要参数 ip=IPv4地址，可选 minutes>0、metric=speed|latency、resolution=秒")
+                    return
+                record = peer_history_record(ip, minutes, metric, resolution)
+                if record is None:
+                    self.send_error(404, explain="没有该远端的历史")
+                    return
+                self._reply('application/json; charset=utf-8', json.dumps(record, ensure_ascii=False).encode('utf-8'))
+
+            def _reply(self, content_type, body):
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _stream(self, version, body):
+                # HTTP/1.0 连接关闭即结束，每个采样周期追加一批JSON行
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/x-ndjson; charset=utf-8')
+                self.send_header('Cache-Control', 'no-cache')
+                self.end_headers()
+                try:
+                    while True:
+                        self.wfile.write(body)
+                        self.wfile.flush()
+                        snapshot = exporter.wait_snapshot(version)
+                        if snapshot is None:
+                            return
+                        version, _, body = snapshot
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+metrics_exporter = None  # 无界面模式下的 MetricsExporter
+
+
+def parse_listen_address(value):
+    """解析 host:port（只给端口时监听本机）"""
+    host, _, port = value.rpartition(':')
+    return host or "127.0.0.1", int(port)
+
+
+def interface_ip(name):
+    """按网卡名称取IPv4地址"""
+    for addr in psutil.net_if_addrs().get(name, []):
+        if addr.family == socket.AF_INET:
+            return addr.address
+    return None
+
+
+def _raise_interrupt(signum, frame):
+    raise KeyboardInterrupt
 
 
 def cleanup():
@@ -661,26 +4191,422 @@ def cleanup():
     global running
     running = False
 
+    # 采样/抓包线程可能还在处理当前这一轮，等它们退出后再清空，避免边清空边写入
+    deadline = time.monotonic() + CLEANUP_JOIN_TIMEOUT
+    for t in worker_threads:
+        if t is not threading.current_thread():
+            t.join(max(0.0, deadline - time.monotonic()))
+    worker_threads.clear()
+
+    if metrics_exporter:
+        metrics_exporter.stop()
+    if session_recorder:
+        session_recorder.close()
+
     with data_lock:
         peers_map.clear()
-        raw_bytes_map.clear()
+        byte_counters.clear()
+        packet_stats.clear()
+        flow_table.clear()
+        peer_interfaces.clear()
+        history_store.clear()
+        departed_timelines.clear()
         gta_ports.clear()
 
+    if capture_process:
+        capture_process.stop()
+
+    with geo_lock:
+        geo_cache.close()
+    with dns_lock:
+        dns_cache.close()
+
     print(f"{Fore.YELLOW}监控已停止{Style.RESET_ALL}")
 
 
+def format_table_header():
+    """生成表头"""
+    return (
+        f"{pad_text('状态', 4)} | "
+        f"{pad_text('IP地址', 15)} | "
+        f"{pad_text('地区', 36)} | "
+        f"{pad_text('均速', 5)} | "
+        f"{pad_text('上传', 5)} | "
+        f"{pad_text('下载', 5)} | "
+        f"{pad_text('峰值', 5)} | "
+        f"{pad_text('突发', 5)} | "
+        f"{pad_text('延迟', 4)} | "
+        f"{pad_text('包速', 5)} | "
+        f"{pad_text('抖动', 5)} | "
+        f"{pad_text('断流', 5)} | "
+        f"{pad_text('ASN/运营商', 22)}"
+    )
+
+
+def format_peer_cells(p, s):
+    """生成一行连接信息的单元格列表（p 为 Peer，s 为 get_summary() 结果）
+
+    每个单元格自带完整的颜色前缀且宽度固定，渲染器可以单独重写某个单元格。
+    """
+    location_display = p.location
+
+    if p.is_chinese:
+        location_display += " [裸连]"
+
+    if p.server_type:
+        location_display += f" [{p.server_type}]"
+
+    if len(capture_interfaces) > 1:
+        names = peer_interfaces.get(ip_to_int(p.ip))
+        if names:
+            location_display += f" [{'/'.join(sorted(names))}]"
+
+    if s['is_lagger']:
+        location_display += f" [疑似卡逼:{s['lag_reason']} {s['lag_confidence']:.0%}]"
+
+    if not s['is_alive']:
+        row_color = Fore.RED
+        status_indicator = "💀"
+    elif s['last_seen_sec'] > SAMPLE_INTERVAL * 5:
+        row_color = Fore.YELLOW
+        status_indicator = "🏁"
+    elif s['avg_speed'] > 10:
+        row_color = Fore.GREEN
+        status_indicator = "🚀"
+    elif s['avg_speed'] > 3:
+        row_color = Fore.CYAN
+        status_indicator = "📡"
+    else:
+        row_color = Fore.WHITE
+        status_indicator = "📶"
+
+    if p.server_type and "官方" in p.server_type:
+        if "交易" in p.server_type:
+            row_color = Fore.MAGENTA
+        elif "云存档" in p.server_type:
+            row_color = Fore.LIGHTMAGENTA_EX
+        elif "CDN" in p.server_type:
+            row_color = Fore.LIGHTCYAN_EX
+        elif "中转" in p.server_type:
+            row_color = Fore.LIGHTRED_EX
+        else:
+            row_color = Fore.LIGHTYELLOW_EX
+
+    if p.location == "区域网":
+        row_color = Style.DIM
+
+    spd_str = compact_number(s['avg_speed'], 5)
+    up_str = compact_number(s['avg_up'], 5)
+    down_str = compact_number(s['avg_down'], 5)
+    max_str = compact_number(s['max_speed'], 5)
+    burst_str = compact_number(s['max_burst'], 5, 0)
+    lat_str = f"{int(s['avg_lat'])}" if s['avg_lat'] else "N/A"
+    pps_str = compact_number(s['avg_pps'], 5, 0)
+    jit_str = compact_number(s['jitter'], 5, 0)
+    gap_str = compact_number(s['max_gap'], 5, 0)
+
+    if s['is_lagger']:
+        spd_str = f"{Fore.RED}{spd_str}{row_color}"
+        max_str = f"{Fore.RED}{max_str}{row_color}"
+
+    col_status = pad_text(f"{status_indicator}", 4, 'center')
+    display_ip = mask_ip_for_privacy(p.ip, p.is_chinese)
+    col_ip = pad_text(display_ip, 15)
+    col_loc = pad_text(location_display, 36)
+    col_spd = pad_text(spd_str, 5, 'right')
+    col_up = pad_text(up_str, 5, 'right')
+    col_down = pad_text(down_str, 5, 'right')
+    col_max = pad_text(max_str, 5, 'right')
+    col_burst = pad_text(burst_str, 5, 'right')
+    col_lat = pad_text(lat_str, 4, 'right')
+    col_pps = pad_text(pps_str, 5, 'right')
+    col_jit = pad_text(jit_str, 5, 'right')
+    col_gap = pad_text(gap_str, 5, 'right')
+    col_isp = pad_text(p.isp, 22)
+
+    return [
+        f"{row_color}{col_status} | ",
+        f"{row_color}{col_ip} | ",
+        f"{row_color}{col_loc} | ",
+        f"{row_color}{Style.BRIGHT}{col_spd}{Style.NORMAL} | ",
+        f"{row_color}{col_up} | ",
+        f"{row_color}{col_down} | ",
+        f"{row_color}{Style.DIM}{col_max}{Style.NORMAL} | ",
+        f"{row_color}{col_burst} | ",
+        f"{row_color}{col_lat} | ",
+        f"{row_color}{col_pps} | ",
+        f"{row_color}{col_jit} | ",
+        f"{row_color}{Style.DIM}{col_gap}{Style.NORMAL} | ",
+        f"{row_color}{Style.DIM}{col_isp}{Style.RESET_ALL}",
+    ]
+
+
+def format_peer_row(p, s):
+    """生成一行连接信息"""
+    return "".join(format_peer_cells(p, s))
+
+
+class TerminalRenderer:
+    """增量终端渲染：保存上一帧，只用ANSI光标定位重写变化的行和单元格
+
+    每帧先裁剪到终端大小（超宽的行截断，超高的帧省略末尾的行），保证光标定位不会落到屏幕外；
+    终端大小或是否需要裁剪变化时整屏重绘。
+    """
+
+    def __init__(self, out=None, full_redraw_interval=UI_FULL_REDRAW_INTERVAL, incremental=None, size=None):
+        self.out = out or sys.stdout
+        self.fixed_size = size  # 固定的 os.terminal_size（输出不是真实终端时使用），None 表示每帧查询
+        self.full_redraw_interval = full_redraw_interval
+        # 输出不是终端时（重定向到文件/管道）光标控制无意义，逐帧完整输出
+        if incremental is None:
+            incremental = hasattr(self.out, 'isatty') and self.out.isatty()
+        self.incremental = incremental
+        self.prev = []  # 上一帧：每行是单元格列表
+        self.last_full = 0
+        self.size = None
+        self.clipped = False
+
+    def invalidate(self):
+        """下次渲染时整屏重绘"""
+        self.prev = []
+        self.last_full = 0
+
+    def render(self, frame):
+        """frame 为行列表，每行是单元格字符串列表；返回写出的字符数"""
+        if not self.incremental:
+            data = "\n".join("".join(row) for row in frame) + "\n\n"
+            self.out.write(data)
+            self.out.flush()
+            return len(data)
+
+        now = time.monotonic()
+        size = self.fixed_size or shutil.get_terminal_size()
+        frame, clipped = self.clip(frame, size.columns, size.lines)
+        parts = []
+        if size != self.size or clipped != self.clipped or now - self.last_full >= self.full_redraw_interval:
+            parts.append("\x1b[H\x1b[2J")
+            self.prev = []
+            self.size = size
+            self.clipped = clipped
+            self.last_full = now
+
+        prev = self.prev
+        for y, row in enumerate(frame):
+            old = prev[y] if y < len(prev) else None
+            if old == row:
+                continue
+            if old is None or len(old) != len(row):
+                parts.append(f"\x1b[{y + 1};1H{Style.RESET_ALL}{''.join(row)}{Style.RESET_ALL}\x1b[K")
+                continue
+
+            col = 0
+            for i, cell in enumerate(row):
+                width = get_str_width(cell)
+                if cell != old[i]:
+                    if width != get_str_width(old[i]):
+                        # 宽度变化会影响后面的单元格，从这里重写到行尾
+                        parts.append(f"\x1b[{y + 1};{col + 1}H{Style.RESET_ALL}{''.join(row[i:])}"
+                                     f"{Style.RESET_ALL}\x1b[K")
+                        break
+                    parts.append(f"\x1b[{y + 1};{col + 1}H{Style.RESET_ALL}{cell}")
+                col += width
+
+        if len(frame) < len(prev):
+            parts.append(f"\x1b[{len(frame) + 1};1H\x1b[J")
+        parts.append(f"{Style.RESET_ALL}\x1b[{len(frame) + 1};1H")
+
+        data = "".join(parts)
+        self.out.write(data)
+        self.out.flush()
+        self.prev = frame
+        return len(data)
+
+    @staticmethod
+    def clip(frame, columns, lines):
+        """把帧裁剪到终端大小，返回 (裁剪后的帧, 是否有裁剪)
+
+        最后一列和最后一行留空：写满一行会触发自动换行，光标停在最后一行之后会滚屏。
+        """
+        width = max(columns - 1, 1)
+        height = max(lines - 1, 1)
+        clipped = False
+        if len(frame) > height:
+            hidden = len(frame) - height + 1
+            frame = frame[:height - 1] + [[f"{Fore.YELLOW}... 窗口高度不足，省略 {hidden} 行{Style.RESET_ALL}"]]
+            clipped = True
+
+        result = []
+        for row in frame:
+            col = 0
+            for i, cell in enumerate(row):
+                w = get_str_width(cell)
+                if col + w > width:
+                    # 截断跨越右边界的单元格（结尾带".."），后面的单元格丢弃
+                    remaining = width - col
+                    row = row[:i] + [truncate_mixed_string(cell, remaining - 2) + Style.RESET_ALL] \
+                        if remaining > 2 else row[:i]
+                    clipped = True
+                    break
+                col += w
+            result.append(row)
+        return result, clipped
+
+
+def build_frame(rows, refresh_count, peer_count):
+    """组装一帧画面（rows 为 (peer, stats) 列表，已排序）"""
+    frame = [
+        [f"{Fore.CYAN}=== GTA5 战局网络监控 (ASN精准识别版) ==={Style.RESET_ALL}"],
+        [f"{Fore.RED}⚠️  连接状况仅供参考，请根据实际情况自行判断{Style.RESET_ALL}"],
+        [f"{Fore.CYAN}{'=' * 60}{Style.RESET_ALL}"],
+        [f"{Fore.YELLOW}监控IP: {LOCAL_IP} | 刷新次数: {refresh_count} | {time.strftime('%H:%M:%S')}"
+         f" | 按Ctrl+C退出{Style.RESET_ALL}"],
+        [f"{Fore.YELLOW}活跃连接数: {peer_count} | "
+         f"UDP端口: {sorted(gta_ports) if gta_ports else '等待GTA5进程...'}{Style.RESET_ALL}"],
+        [f"{Fore.CYAN}{'=' * 151}{Style.RESET_ALL}"],
+        [Style.BRIGHT + format_table_header() + Style.RESET_ALL],
+        [f"{Fore.CYAN}{'-' * 151}{Style.RESET_ALL}"],
+    ]
+
+    if not rows:
+        frame.append([""])
+        frame.append([f"{Fore.YELLOW}暂无活跃连接，等待GTA5网络流量...{Style.RESET_ALL}"])
+        frame.append([f"{Fore.YELLOW}请确保GTA5正在运行且已进入在线战局{Style.RESET_ALL}"])
+    else:
+        for peer, stats in rows:
+            frame.append(format_peer_cells(peer, stats))
+
+    frame.append([""])
+    frame.append([f"{Fore.CYAN}{'=' * 151}{Style.RESET_ALL}"])
+    frame.append([f"{Style.DIM}状态: 💀断线 🏁空闲 🚀活跃 📡正常 📶低速 | 速度单位: KB/s | 包速单位: 包/s | "
+                  f"延迟/抖动/断流(最大到达间隔)单位: ms{Style.RESET_ALL}"])
+    frame.append([f"{Style.DIM}提示: [裸连]国内IP (IP隐私保护) | [官方-*]服务器类型 | [疑似卡逼:原因 置信度]流量/包速/延迟异常{Style.RESET_ALL}"])
+    frame.append([f"{Style.DIM}服务器: 紫色=交易 亮紫=云存档 亮青=CDN 亮红=中转 亮黄=其他官方{Style.RESET_ALL}"])
+    frame.append([f"{Style.DIM}地理: 国内[省份城市] 国外[国家 地区] | ASN: AS号码(运营商简名){Style.RESET_ALL}"])
+    frame.append([f"{Fore.CYAN}{'=' * 60}{Style.RESET_ALL}"])
+    frame.append([f"{Fore.RED}⚠️  连接状况仅供参考，请根据实际情况自行判断{Style.RESET_ALL}"])
+    for message in list(event_log):
+        frame.append([f"{Style.DIM}{message}{Style.RESET_ALL}"])
+    return frame
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="GTA5 战局网络监控")
+    parser.add_argument('--ip', help="要监控的本地IP（指定后跳过交互输入），多个IP用逗号分隔，all 表示所有网卡")
+    parser.add_argument('--iface', help="按网卡名称选择要监控的本地IP（代替 --ip），多个用逗号分隔，all 表示所有网卡")
+    parser.add_argument('--headless', action='store_true',
+                        help="无界面模式：不显示表格、不交互输入，通过本地端口导出指标")
+    parser.add_argument('--listen', default=METRICS_LISTEN, metavar='HOST:PORT',
+                        help=f"无界面模式下指标服务的监听地址（默认 {METRICS_LISTEN}）")
+    parser.add_argument('--replay', metavar='PCAP',
+                        help="回放pcap/pcapng抓包文件代替实时抓包（--ip all 时从文件推断本机地址）")
+    parser.add_argument('--fast', action='store_true', help="全速回放并输出吞吐量（不按原始时间戳节奏）")
+    parser.add_argument('--record', metavar='FILE', help="把每个采样周期的数据录制到二进制文件")
+    parser.add_argument('--analyze', metavar='FILE', help="离线分析录制文件（默认输出流量最大的远端）")
+    parser.add_argument('--top', type=int, default=10, help="分析: 输出流量最大的前N个远端")
+    parser.add_argument('--peer', metavar='IP', help="分析: 输出该远端速度超过阈值的时间段")
+    parser.add_argument('--threshold', type=float, default=100, help="分析: --peer 的速度阈值 (KB/s)")
+    parser.add_argument('--minute', type=int, help="分析: 输出会话第N分钟（从0开始）内出现的远端")
+    parser.add_argument('--capture-process', action='store_true',
+                        help="在独立进程中抓包，计数经共享内存传回（不受界面和查询线程的GIL占用影响）")
+    parser.add_argument('--backend', choices=['auto', 'raw', 'afpacket'], default=CAPTURE_BACKEND,
+                        help="抓包后端（afpacket 仅Linux，可在内核中按端口过滤）")
+    parser.add_argument('--resolution', type=float, default=SAMPLE_RESOLUTION, metavar='SECONDS',
+                        help=f"读取流量计数的间隔，决定突发峰值的时间粒度（最小 {MIN_SAMPLE_RESOLUTION}s）")
+    parser.add_argument('--dns-server', default=DNS_SERVER, metavar='IP[:PORT]',
+                        help="反向DNS服务器（auto 读取系统配置，system 使用系统解析函数）")
+    return parser.parse_args()
+
+
+def run_fast_replay(path):
+    """全速回放抓包文件并输出吞吐量统计（性能测试用）"""
+    total, accepted, elapsed = replay_capture(path, realtime=False)
+    rate = total / elapsed if elapsed > 0 else 0
+    print(f"{Fore.GREEN}回放完成: {total} 个数据包，计入 {accepted} 个，"
+          f"耗时 {elapsed:.2f}s，{rate:,.0f} 包/秒{Style.RESET_ALL}")
+
+    top = sorted(byte_counters.swap().items(), key=lambda x: x[1], reverse=True)[:20]
+    for ip, total_bytes in top:
+        print(f"  {pad_text(int_to_ip(ip), 15)} {total_bytes / 1024.0:>12.1f} KB")
+
+
+def run_headless(listen):
+    """无界面模式：启动指标服务，直到收到 Ctrl+C 或 SIGTERM"""
+    global metrics_exporter
+
+    try:
+        host, port = parse_listen_address(listen)
+        metrics_exporter = MetricsExporter(host, port)
+    except (OSError, ValueError) as e:
+        print(f"{Fore.RED}指标服务启动失败 ({listen}): {e}{Style.RESET_ALL}")
+        cleanup()
+        return
+
+    metrics_exporter.start()
+    print(f"{Fore.GREEN}指标服务: http://{metrics_exporter.address}/metrics | "
+          f"NDJSON流: http://{metrics_exporter.address}/stream | "
+          f"历史: http://{metrics_exporter.address}/history?ip=&minutes={Style.RESET_ALL}")
+    signal.signal(signal.SIGTERM, _raise_interrupt)
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print(f"{Fore.YELLOW}收到停止信号，正在关闭监控...{Style.RESET_ALL}")
+    finally:
+        cleanup()
+
+
 def main():
-    global LOCAL_IP
+    global LOCAL_IP, CAPTURE_BACKEND, SAMPLE_RESOLUTION, ui_active, session_recorder, packet_dedup
+    global byte_counters, packet_stats, flow_table, capture_process
+
+    args = parse_args()
+    CAPTURE_BACKEND = args.backend
+    dns_resolver.server = args.dns_server
+    SAMPLE_RESOLUTION = max(args.resolution, MIN_SAMPLE_RESOLUTION)
+
+    if args.analyze:
+        run_analysis(args)
+        return
 
-    # 清屏开始
-    os.system('cls' if os.name == 'nt' else 'clear')
+    # 清屏开始（无界面模式输出的是日志，不清屏）
+    if not args.headless:
+        os.system('cls' if os.name == 'nt' else 'clear')
 
     print(f"{Fore.CYAN}=== GTA5 战局网络监控 (ASN精准识别版) ==={Style.RESET_ALL}")
     print(f"{Fore.YELLOW}版本: 3.5 | EXE兼容版{Style.RESET_ALL}")
 
+    # 预热持久化缓存，已知IP无需联网即可显示
+    with geo_lock:
+        geo_count = geo_cache.open()
+    with dns_lock:
+        dns_cache.open()
+    if geo_count:
+        print(f"{Fore.GREEN}已加载 {geo_count} 条地理位置缓存{Style.RESET_ALL}")
+    range_count = load_offline_db()
+    server_rules.load()
+    if range_count:
+        print(f"{Fore.GREEN}已加载离线IP库: {range_count} 个IP段{Style.RESET_ALL}")
+
+    if args.iface:
+        if args.iface.strip().lower() == "all":
+            LOCAL_IP = "all"
+        else:
+            names = [name.strip() for name in args.iface.split(",") if name.strip()]
+            missing = [name for name in names if not interface_ip(name)]
+            if missing or not names:
+                print(f"{Fore.RED}网卡 {', '.join(missing) or args.iface} 没有IPv4地址{Style.RESET_ALL}")
+                cleanup()
+                return
+            LOCAL_IP = ",".join(interface_ip(name) for name in names)
+    elif args.headless and not args.ip:
+        print(f"{Fore.RED}无界面模式需要用 --ip 或 --iface 指定监控的本地IP{Style.RESET_ALL}")
+        cleanup()
+        return
+
     # 获取用户输入的IP
     try:
-        LOCAL_IP = get_user_input_ip()
+        LOCAL_IP = LOCAL_IP or args.ip or get_user_input_ip()
     except Exception as e:
         print(f"{Fore.RED}获取IP失败: {e}{Style.RESET_ALL}")
         # 尝试自动获取IP
@@ -697,8 +4623,14 @@ def main():
             LOCAL_IP = "127.0.0.1"
             print(f"{Fore.RED}使用默认IP: {LOCAL_IP}{Style.RESET_ALL}")
 
+    if args.replay and args.fast:
+        run_fast_replay(args.replay)
+        cleanup()
+        return
+
     # 清屏显示配置信息
-    os.system('cls' if os.name == 'nt' else 'clear')
+    if not args.headless:
+        os.system('cls' if os.name == 'nt' else 'clear')
 
     print(f"{Fore.CYAN}=== GTA5 战局网络监控 (ASN精准识别版) ==={Style.RESET_ALL}")
     print(f"{Fore.RED}⚠️  连接状况仅供参考，请根据实际情况自行判断{Style.RESET_ALL}")
@@ -706,12 +4638,13 @@ def main():
 
     # 显示官方服务器配置信息
     print(f"{Fore.GREEN}官方服务器配置:{Style.RESET_ALL}")
-    print(f"  交易服务器: {', '.join(TRADE_SERVER_IPS)}")
-    print(f"  云存档服务器: {', '.join(CLOUD_SAVE_SERVER_IPS)}")
-    print(f"  官方中转网段: 52.139.*.*")
+    print(f"  识别规则: {server_rules.source} ({server_rules.index.rule_count} 条，"
+          f"{len(server_rules.index.ips)} 个IP / {len(server_rules.index.starts)} 个网段区间)")
 
     print(f"\n{Fore.YELLOW}监控本地IP: {LOCAL_IP}{Style.RESET_ALL}")
-    print(f"{Fore.YELLOW}采样间隔: {SAMPLE_INTERVAL}s | 刷新率: {UI_REFRESH_RATE}s{Style.RESET_ALL}")
+    if args.replay:
+        print(f"{Fore.YELLOW}回放抓包文件: {args.replay}{Style.RESET_ALL}")
+    print(f"{Fore.YELLOW}采样间隔: {SAMPLE_INTERVAL}s (突发粒度 {SAMPLE_RESOLUTION}s) | 刷新率: {UI_REFRESH_RATE}s{Style.RESET_ALL}")
     print(f"{Fore.YELLOW}目标进程: {TARGET_PROCESS_KEYWORDS}{Style.RESET_ALL}")
     print(f"{Fore.YELLOW}隐私保护: 国内玩家IP显示为 X.X.*.* 格式{Style.RESET_ALL}")
     print(f"{Fore.YELLOW}UDP监控端口: {sorted(UDP_PORTS_TO_MONITOR)}{Style.RESET_ALL}")
@@ -720,7 +4653,6 @@ def main():
     # 检查管理员权限
     if psutil.WINDOWS:
         try:
-            import ctypes
             is_admin = ctypes.windll.shell32.IsUserAnAdmin()
             if not is_admin:
                 print(f"{Fore.RED}警告: 可能需要管理员权限运行以捕获原始套接字{Style.RESET_ALL}")
@@ -729,160 +4661,80 @@ def main():
             pass
 
     # 启动工作线程
-    threads = []
-    for func in [sniffer, sampler, port_scanner]:
-        t = threading.Thread(target=func, daemon=True)
+    def replay_worker():
+        total, _, _ = replay_capture(args.replay)
+        log_event(f"{Fore.GREEN}抓包文件回放结束: {total} 个数据包{Style.RESET_ALL}")
+
+    if args.record:
+        try:
+            session_recorder = SessionRecorder(args.record)
+            print(f"{Fore.YELLOW}录制会话到: {args.record}{Style.RESET_ALL}")
+        except OSError as e:
+            print(f"{Fore.RED}无法创建录制文件: {e}{Style.RESET_ALL}")
+
+    workers = []
+    if args.replay:
+        workers.append((replay_worker, ()))
+    else:
+        # 每个本地IP一个抓包线程，多个网卡时跨网卡去重
+        capture = sniffer_af_packet if use_af_packet() else sniffer
+        targets = parse_local_ips()
+        capture_interfaces[:] = [find_interface_name(ip) or ip for ip, _ in targets]
+        if len(targets) > 1:
+            packet_dedup = PacketDeduplicator()
+            print(f"{Fore.YELLOW}同时抓包的网卡: {', '.join(capture_interfaces)}{Style.RESET_ALL}")
+        if args.capture_process:
+            # 抓包子进程写共享计数表，采样线程直接从表中读取增量
+            capture_process = CaptureProcess(targets)
+            byte_counters = packet_stats = flow_table = capture_process.table
+            capture_process.start()
+            print(f"{Fore.YELLOW}抓包进程已启动 (PID {capture_process.process.pid}){Style.RESET_ALL}")
+        else:
+            workers.extend((capture, target) for target in targets)
+    workers.append((sampler, ()))
+    workers.append((port_scanner, ()))
+    workers.append((rules_watcher, ()))
+
+    for func, func_args in workers:
+        t = threading.Thread(target=func, args=func_args, daemon=True)
         t.start()
-        threads.append(t)
+        # 端口扫描和规则检查线程不读写计数表，且休眠较长，退出时不等待
+        if func not in (port_scanner, rules_watcher):
+            worker_threads.append(t)
         time.sleep(0.1)
 
     print(f"{Fore.GREEN}监控已启动...{Style.RESET_ALL}")
     print(f"{Fore.YELLOW}按 Ctrl+C 停止监控{Style.RESET_ALL}")
     print(f"{Fore.CYAN}{'=' * 60}{Style.RESET_ALL}")
 
+    if args.headless:
+        run_headless(args.listen)
+        return
+
+    renderer = TerminalRenderer()
+    ui_active = True
+    time.sleep(2)  # 留出时间查看启动信息
+
     try:
-        last_refresh = time.time()
         refresh_count = 0
 
         while True:
-            current_time = time.time()
-            time_to_wait = max(1, UI_REFRESH_RATE - (current_time - last_refresh))
-
-            for i in range(int(time_to_wait), 0, -1):
-                sys.stdout.write(
-                    f"\r{Fore.YELLOW}⏱️ 刷新倒计时 {i}s | 活跃连接: {len(peers_map)} | UDP端口: {len(gta_ports)} | 按Ctrl+C退出...")
-                sys.stdout.flush()
-                time.sleep(1)
-
-            last_refresh = time.time()
             refresh_count += 1
 
-            os.system('cls' if os.name == 'nt' else 'clear')
-
-            print(f"{Fore.CYAN}=== GTA5 战局网络监控 (ASN精准识别版) ==={Style.RESET_ALL}")
-            print(f"{Fore.RED}⚠️  连接状况仅供参考，请根据实际情况自行判断{Style.RESET_ALL}")
-            print(f"{Fore.CYAN}{'=' * 60}{Style.RESET_ALL}")
+            snapshot = peer_snapshot
+            renderer.render(build_frame(snapshot.rows, refresh_count, snapshot.peer_count))
 
-            print(f"{Fore.YELLOW}监控IP: {LOCAL_IP} | 刷新次数: {refresh_count}{Style.RESET_ALL}")
-            print(
-                f"{Fore.YELLOW}活跃连接数: {len(peers_map)} | UDP端口: {sorted(gta_ports) if gta_ports else '等待GTA5进程...'}{Style.RESET_ALL}")
-            print(f"{Fore.CYAN}{'=' * 130}{Style.RESET_ALL}")
-
-            rows = []
-            with data_lock:
-                for peer in list(peers_map.values()):
-                    stats = peer.get_summary()
-                    if not stats:
-                        continue
-                    rows.append({'peer': peer, 'stats': stats})
-
-            rows.sort(key=lambda x: x['stats']['avg_speed'], reverse=True)
-
-            header = (
-                f"{pad_text('状态', 4)} | "
-                f"{pad_text('IP地址', 15)} | "
-                f"{pad_text('地区', 57)} | "
-                f"{pad_text('均速', 4)} | "
-                f"{pad_text('峰值', 4)} | "
-                f"{pad_text('延迟', 4)} | "
-                f"{pad_text('ASN/运营商', 22)}"
-            )
-            print(Style.BRIGHT + header + Style.RESET_ALL)
-            print(f"{Fore.CYAN}{'-' * 130}{Style.RESET_ALL}")
-
-            if not rows:
-                print(f"\n{Fore.YELLOW}暂无活跃连接，等待GTA5网络流量...{Style.RESET_ALL}")
-                print(f"{Fore.YELLOW}请确保GTA5正在运行且已进入在线战局{Style.RESET_ALL}")
-            else:
-                for item in rows:
-                    p = item['peer']
-                    s = item['stats']
-
-                    location_display = p.location
-
-                    if p.is_chinese:
-                        location_display += " [裸连]"
-
-                    if p.server_type:
-                        location_display += f" [{p.server_type}]"
-
-                    if s['is_lagger']:
-                        location_display += " [疑似卡逼]"
-
-                    if not s['is_alive']:
-                        row_color = Fore.RED
-                        status_indicator = "💀"
-                    elif s['last_seen_sec'] > SAMPLE_INTERVAL * 5:
-                        row_color = Fore.YELLOW
-                        status_indicator = "🏁"
-                    elif s['avg_speed'] > 10:
-                        row_color = Fore.GREEN
-                        status_indicator = "🚀"
-                    elif s['avg_speed'] > 3:
-                        row_color = Fore.CYAN
-                        status_indicator = "📡"
-                    else:
-                        row_color = Fore.WHITE
-                        status_indicator = "📶"
-
-                    if p.server_type and "官方" in p.server_type:
-                        if "交易" in p.server_type:
-                            row_color = Fore.MAGENTA
-                        elif "云存档" in p.server_type:
-                            row_color = Fore.LIGHTMAGENTA_EX
-                        elif "CDN" in p.server_type:
-                            row_color = Fore.LIGHTCYAN_EX
-                        elif "中转" in p.server_type:
-                            row_color = Fore.LIGHTRED_EX
-                        else:
-                            row_color = Fore.LIGHTYELLOW_EX
-							
-                    if p.location == "区域网":
-                        row_color = Style.DIM
-
-                    spd_str = f"{s['avg_speed']:.1f}"
-                    max_str = f"{s['max_speed']:.1f}"
-                    lat_str = f"{int(s['avg_lat'])}" if s['avg_lat'] else "N/A"
-
-                    if s['is_lagger']:
-                        spd_str = f"{Fore.RED}{s['avg_speed']:.1f}{row_color}"
-                        max_str = f"{Fore.RED}{s['max_speed']:.1f}{row_color}"
-
-                    col_status = pad_text(f"{status_indicator}", 3, 'center')
-                    display_ip = mask_ip_for_privacy(p.ip, p.is_chinese)
-                    col_ip = pad_text(display_ip, 15)
-                    col_loc = pad_text(location_display, 57)
-                    col_spd = pad_text(spd_str, 4, 'right')
-                    col_max = pad_text(max_str, 4, 'right')
-                    col_lat = pad_text(lat_str, 4, 'right')
-                    col_isp = pad_text(p.isp, 22)
-
-                    print(
-                        f"{row_color}{col_status} | "
-                        f"{col_ip} | "
-                        f"{col_loc} | "
-                        f"{Style.BRIGHT}{col_spd}{Style.NORMAL} | "
-                        f"{Style.DIM}{col_max}{Style.NORMAL} | "
-                        f"{col_lat} | "
-                        f"{Style.DIM}{col_isp}{Style.RESET_ALL}"
-                    )
-
-            print(f"\n{Fore.CYAN}{'=' * 130}{Style.RESET_ALL}")
-            print(f"{Style.DIM}状态: 💀断线 🏁空闲 🚀活跃 📡正常 📶低速 | 速度单位: KB/s | 延迟单位: ms{Style.RESET_ALL}")
-            print(
-                f"{Style.DIM}提示: [裸连]国内IP (IP隐私保护) | [官方-*]服务器类型 | [疑似卡逼]速度>100KB/s{Style.RESET_ALL}")
-            print(f"{Style.DIM}服务器: 紫色=交易 亮紫=云存档 亮青=CDN 亮红=中转 亮黄=其他官方{Style.RESET_ALL}")
-            print(f"{Style.DIM}地理: 国内[省份城市] 国外[国家 地区] | ASN: AS号码(运营商简名){Style.RESET_ALL}")
-            print(f"{Fore.CYAN}{'=' * 60}{Style.RESET_ALL}")
-            print(f"{Fore.RED}⚠️  连接状况仅供参考，请根据实际情况自行判断{Style.RESET_ALL}")
+            time.sleep(UI_REFRESH_RATE)
 
     except KeyboardInterrupt:
         print(f"\n{Fore.YELLOW}\n收到停止信号，正在关闭监控...{Style.RESET_ALL}")
     except Exception as e:
         print(f"{Fore.RED}程序运行错误: {e}{Style.RESET_ALL}")
     finally:
+        ui_active = False
         cleanup()
 
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()  # PyInstaller 打包后子进程需要
     main()
\ No newline at end of file
@@ -0,0 +1,545 @@
+"""GTA5 战局网络监控 - 性能测试
+
+覆盖抓包解析/过滤、采样与统计、表格渲染、地理位置批量查询、反向DNS查询五个环节，
+输出吞吐量、分阶段延迟分位数和峰值内存，可保存为JSON用于前后对比。
+capture 环节在回环网卡上实际收发流量，对比线程抓包和独立进程抓包的丢包数（需要root/管理员权限，默认不运行）。
+
+用法:
+    python benchmark.py                          # 全部测试
+    python benchmark.py --stages parse,render    # 只跑部分环节
+    python benchmark.py --output new.json --compare old.json
+    sudo python benchmark.py --stages capture    # 实时抓包丢包对比
+"""
+import argparse
+import contextlib
+import copy
+import io
+import json
+import multiprocessing
+import os
+import platform
+import random
+import socket
+import struct
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+
+import Main
+from tests.fakes import FakeDnsServer, FakeIpApi
+
+LOCAL_IP = "192.168.1.10"
+STAGES = ["parse", "sampler", "render", "geo", "dns"]
+ALL_STAGES = STAGES + ["capture"]
+legacy_bytes_map = defaultdict(int)
+
+
+# === 合成流量 ===
+def build_udp_packet(src, dst, src_port, dst_port, payload_size):
+    """构造IPv4/UDP数据包"""
+    udp = struct.pack('!HHHH', src_port, dst_port, 8 + payload_size, 0) + b'\x00' * payload_size
+    ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(udp), 0, 0, 64, 17, 0,
+                     socket.inet_aton(src), socket.inet_aton(dst))
+    return ip + udp
+
+
+def peer_addresses(peers):
+    return [Main.int_to_ip(0x08080001 + i) for i in range(peers)]
+
+
+def generate_packets(count, peers, min_size=40, max_size=400, ports=(6672,), other_ratio=0.2, seed=1):
+    """生成合成流量：other_ratio 比例的包使用非GTA端口，收发各半"""
+    rng = random.Random(seed)
+    peer_ips = peer_addresses(peers)
+    packets = []
+    for _ in range(count):
+        peer = rng.choice(peer_ips)
+        port = 5353 if rng.random() < other_ratio else rng.choice(ports)
+        size = rng.randint(min_size, max_size)
+        if rng.random() < 0.5:
+            packets.append(build_udp_packet(peer, LOCAL_IP, port, port, size))
+        else:
+            packets.append(build_udp_packet(LOCAL_IP, peer, port, port, size))
+    return packets
+
+
+# === 统计工具 ===
+def percentiles(samples):
+    """返回 p50/p95/p99/max（输入单位保持不变）"""
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+
+    def pick(q):
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    return {'p50': pick(0.50), 'p95': pick(0.95), 'p99': pick(0.99), 'max': ordered[-1]}
+
+
+def peak_memory(func, *args):
+    """在tracemalloc下再跑一遍，返回峰值内存（KB）"""
+    tracemalloc.start()
+    try:
+        func(*args)
+        return tracemalloc.get_traced_memory()[1] / 1024.0
+    finally:
+        tracemalloc.stop()
+
+
+@contextlib.contextmanager
+def quiet():
+    """屏蔽被测代码的控制台输出"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+
+# === 抓包解析 ===
+def legacy_account_packet(raw, local_ip):
+    """旧版 sniffer() 循环体（对照组）"""
+    iph = struct.unpack('!BBHHHBBH4s4s', raw[0:20])
+    if iph[6] != 17:
+        return
+    ihl = (iph[0] & 0xF) * 4
+    udph = struct.unpack('!HHHH', raw[ihl:ihl + 8])
+    if not (udph[0] in Main.gta_ports or udph[1] in Main.gta_ports):
+        return
+    s_ip = socket.inet_ntoa(iph[8])
+    d_ip = socket.inet_ntoa(iph[9])
+    remote = d_ip if s_ip == local_ip else s_ip
+    if remote.startswith(("224.", "239.", "255.")) or remote == local_ip:
+        return
+    with Main.data_lock:
+        legacy_bytes_map[remote] += len(raw)
+
+
+def run_parse_legacy(packets, chunk=1000):
+    legacy_bytes_map.clear()
+    timings = []
+    for i in range(0, len(packets), chunk):
+        start = time.perf_counter()
+        for pkt in packets[i:i + chunk]:
+            raw = bytes(pkt)  # recvfrom 每个包都会分配新的bytes
+            legacy_account_packet(raw, LOCAL_IP)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def run_parse_fast(packets, chunk=1000):
+    Main.flow_table.clear()
+    Main.packet_stats.clear()
+    local_ip = Main.ip_to_int(LOCAL_IP)
+    table = Main.flow_table.shard()  # 与抓包线程一样启动时取一次本线程的计数分片
+    buf = bytearray(65535)
+    view = memoryview(buf)
+    timings = []
+    for i in range(0, len(packets), chunk):
+        start = time.perf_counter()
+        for pkt in packets[i:i + chunk]:
+            n = len(pkt)
+            buf[:n] = pkt  # recv_into 拷贝到预分配缓冲区
+            Main.account_packet(view, n, local_ip, time.monotonic(), None, table)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def bench_parse(args):
+    ports = tuple(int(p) for p in args.ports.split(','))
+    Main.gta_ports = set(ports)
+    packets = generate_packets(args.packets, args.peers, args.min_size, args.max_size, ports)
+    chunk = 1000
+    results = {}
+    for name, func in [('legacy', run_parse_legacy), ('fast', run_parse_fast)]:
+        timings = func(packets, chunk)
+        elapsed = sum(timings)
+        results[name] = {
+            'packets': len(packets),
+            'packets_per_sec': len(packets) / elapsed,
+            'ns_per_packet': {k: v / chunk * 1e9 for k, v in percentiles(timings).items()},
+            'peak_kb': peak_memory(func, packets[:min(len(packets), 100000)], chunk),
+        }
+        print(f"  解析[{name:<6}] {results[name]['packets_per_sec']:>12,.0f} 包/秒 | "
+              f"p50 {results[name]['ns_per_packet']['p50']:.0f}ns/包 | 峰值内存 {results[name]['peak_kb']:.0f}KB")
+    results['speedup'] = results['fast']['packets_per_sec'] / results['legacy']['packets_per_sec']
+    return results
+
+
+# === 采样与统计 ===
+def populate_peers(count):
+    """创建指定数量的远端（不触发地理位置查询和延迟探测）"""
+    for peer in Main.peers_map.values():
+        peer.release()
+    Main.peers_map.clear()
+    Main.packet_stats.clear()
+    peers = {}
+    for i in range(count):
+        ip_int = 0x08080001 + i
+        peers[ip_int] = Main.Peer(Main.int_to_ip(ip_int))
+    Main.peers_map.update(peers)
+    return list(peers)
+
+
+def run_sampler(keys, rounds):
+    rng = random.Random(2)
+    timings = []
+    for _ in range(rounds):
+        deltas = {k: rng.randint(0, 200000) for k in keys}
+        start = time.perf_counter()
+        with quiet():
+            Main.sample_once(deltas)
+            Main.publish_peer_snapshot()  # 摘要每个周期只算一次，界面和导出读取快照
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def bench_sampler(args):
+    results = {}
+    original_fetch, original_probe = Main.Peer._fetch_geo, Main.latency_prober.probe
+    Main.Peer._fetch_geo = lambda self: None
+    Main.latency_prober.probe = lambda ip, callback: False
+    try:
+        for count in args.peer_counts:
+            keys = populate_peers(count)
+            timings = run_sampler(keys, args.rounds)
+            stats = percentiles([t * 1000 for t in timings])
+            results[str(count)] = {
+                'peers': count,
+                'pass_ms': stats,
+                'us_per_peer': stats['p50'] * 1000 / count,
+                'peak_kb': peak_memory(run_sampler, keys, 2),
+            }
+            print(f"  采样[{count:>6}个远端] p50 {stats['p50']:.2f}ms p99 {stats['p99']:.2f}ms | "
+                  f"峰值内存 {results[str(count)]['peak_kb']:.0f}KB")
+    finally:
+        Main.Peer._fetch_geo, Main.latency_prober.probe = original_fetch, original_probe
+        Main.peers_map.clear()
+    return results
+
+
+# === 表格渲染 ===
+def run_render(rows, rounds):
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        lines = [Main.format_table_header()]
+        lines.extend(Main.format_peer_row(p, s) for p, s in rows)
+        "\n".join(lines)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def mutate_rows(rows, rng, changes):
+    """模拟一个刷新周期：随机改动少量远端的速率，返回实际改变的数值个数"""
+    changed = 0
+    for _ in range(changes):
+        _, stats = rng.choice(rows)
+        for key, value in (('avg_speed', rng.random() * 150), ('avg_pps', rng.random() * 60)):
+            changed += stats[key] != value
+            stats[key] = value
+    return changed
+
+
+def run_frames(rows, rounds, incremental, seed=4):
+    """渲染连续多帧，返回 (每帧耗时列表, 每帧输出字符数列表, 改动的数值总数)"""
+    rng = random.Random(seed)
+    out = io.StringIO()
+    # 终端大小固定为能放下整帧，测量的是完整表格的输出量
+    size = os.terminal_size((200, len(rows) + 40))
+    renderer = Main.TerminalRenderer(out=out, full_redraw_interval=float('inf'), incremental=True, size=size)
+    timings, sizes, changed = [], [], 0
+    for _ in range(rounds):
+        changed += mutate_rows(rows, rng, 3)
+        if not incremental:
+            renderer.invalidate()
+        start = time.perf_counter()
+        sizes.append(renderer.render(Main.build_frame(rows, 1, len(rows))))
+        timings.append(time.perf_counter() - start)
+    return timings, sizes, changed
+
+
+def bench_render(args):
+    rng = random.Random(3)
+    rows = []
+    for i in range(args.render_rows):
+        peer = Main.Peer.__new__(Main.Peer)
+        peer.ip = Main.int_to_ip(0x08080001 + i)
+        peer.location = rng.choice(["广东省深圳市", "美国 加利福尼亚", "日本 东京都", "查询中..."])
+        peer.isp = rng.choice(["AS4134 (电信)", "AS15169 (谷歌)", "-"])
+        peer.is_chinese = rng.random() < 0.5
+        peer.server_type = rng.choice([None, None, "官方-中转服务器"])
+        stats = {'avg_speed': rng.random() * 150, 'max_speed': rng.random() * 200, 'avg_lat': rng.randint(5, 300),
+                 'avg_pps': rng.random() * 60, 'jitter': rng.random() * 20, 'max_gap': rng.random() * 500,
+                 'max_burst': rng.random() * 600, 'avg_up': rng.random() * 50, 'avg_down': rng.random() * 100,
+                 'is_alive': True, 'last_seen_sec': 0, 'is_lagger': rng.random() < 0.1,
+                 'lag_confidence': rng.random(), 'lag_reason': "包速骤降"}
+        rows.append((peer, stats))
+
+    timings = run_render(rows, args.rounds)
+    stats = percentiles([t * 1000 for t in timings])
+    results = {'rows': len(rows), 'frame_ms': stats, 'peak_kb': peak_memory(run_render, rows, 2)}
+    print(f"  格式化[{len(rows)}行] p50 {stats['p50']:.2f}ms p99 {stats['p99']:.2f}ms | 峰值内存 {results['peak_kb']:.0f}KB")
+
+    # 两种模式各自从同一份初始数据出发，保证经历相同的改动序列
+    changes = {}
+    for name, incremental in [('full_redraw', False), ('incremental', True)]:
+        timings, sizes, changes[name] = run_frames(copy.deepcopy(rows), args.rounds + 1, incremental)
+        stats = percentiles([t * 1000 for t in timings[1:]])  # 第一帧总是整屏
+        results[name] = {'frame_ms': stats, 'chars_per_frame': sum(sizes[1:]) / len(sizes[1:]),
+                         'changes': changes[name]}
+        print(f"  终端输出[{name:<11}] p50 {stats['p50']:.2f}ms | 每帧 {results[name]['chars_per_frame']:,.0f} 字符")
+    assert changes['full_redraw'] == changes['incremental'], changes
+    return results
+
+
+# === 地理位置批量查询 ===
+def bench_geo(args):
+    FakeIpApi.reset(args.geo_latency, args.geo_quota, args.geo_quota_window)
+    server, url = FakeIpApi.serve()
+
+    queue = Main.GeoLookupQueue(url=url, batch_size=args.geo_batch_size)
+    ips = peer_addresses(args.geo_ips)
+    done = threading.Event()
+    latencies = []
+    lock = threading.Lock()
+    submitted = {}
+
+    def on_result(ip, d, error):
+        with lock:
+            latencies.append(time.perf_counter() - submitted[ip])
+            if len(latencies) == len(ips):
+                done.set()
+
+    start = time.perf_counter()
+    for ip in ips:
+        submitted[ip] = time.perf_counter()
+        queue.submit(ip, lambda d, error, ip=ip: on_result(ip, d, error))
+    done.wait(60)
+    elapsed = time.perf_counter() - start
+    server.shutdown()
+
+    stats = percentiles([t * 1000 for t in latencies])
+    results = {'ips': len(ips), 'completed': len(latencies), 'http_requests': FakeIpApi.requests,
+               'rejected_429': FakeIpApi.rejected, 'total_s': elapsed, 'lookup_ms': stats}
+    print(f"  查询[{len(ips)}个IP] {FakeIpApi.requests} 次HTTP请求 (429: {FakeIpApi.rejected}) | "
+          f"完成 {len(latencies)} | 总耗时 {elapsed:.2f}s | "
+          f"p50 {stats.get('p50', 0):.0f}ms p99 {stats.get('p99', 0):.0f}ms")
+    return results
+
+
+# === 反向DNS查询 ===
+def bench_dns(args):
+    server = FakeDnsServer(args.dns_latency)
+    resolver = Main.ReverseDnsResolver(server=server.address, timeout=args.dns_timeout,
+                                       max_inflight=args.dns_inflight)
+    ips = peer_addresses(args.dns_ips)
+    done = threading.Event()
+    latencies = []
+    answers = defaultdict(int)
+    lock = threading.Lock()
+    submitted = {}
+    expected = len(ips) * 2
+
+    def on_result(ip, domain):
+        with lock:
+            latencies.append(time.perf_counter() - submitted[ip])
+            answers['ptr' if domain else 'none'] += 1
+            if len(latencies) == expected:
+                done.set()
+
+    Main.dns_cache.clear()
+    start = time.perf_counter()
+    for ip in ips:
+        submitted[ip] = time.perf_counter()
+        # 每个IP连续提交两次，第二次应与第一次合并
+        resolver.resolve(ip, on_result)
+        resolver.resolve(ip, on_result)
+    done.wait(60)
+    elapsed = time.perf_counter() - start
+
+    # 第二轮全部命中正/负缓存
+    cached_start = time.perf_counter()
+    for ip in ips:
+        resolver.resolve(ip, lambda ip, domain: None)
+    cached_us = (time.perf_counter() - cached_start) / max(1, len(ips)) * 1e6
+    server.close()
+
+    stats = percentiles([t * 1000 for t in latencies])
+    results = {'ips': len(ips), 'completed': len(latencies), 'dns_queries': server.queries,
+               'ptr': answers['ptr'], 'no_ptr': answers['none'], 'total_s': elapsed,
+               'cached_lookup_us': cached_us, 'lookup_ms': stats}
+    print(f"  查询[{len(ips)}个IP x2] {server.queries} 次DNS请求 | 有记录 {answers['ptr']} 无记录/超时 {answers['none']} | "
+          f"总耗时 {elapsed:.2f}s | p50 {stats.get('p50', 0):.0f}ms p99 {stats.get('p99', 0):.0f}ms | "
+          f"缓存命中 {cached_us:.1f}µs/次")
+    return results
+
+
+# === 实时抓包丢包 ===
+CAPTURE_PEER = "127.0.0.5"
+
+
+def send_udp_flood(count, port, rate, payload_size):
+    """子进程中按固定速率向本机发送UDP包"""
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.bind((CAPTURE_PEER, port))
+    payload = b'\x00' * payload_size
+    batch = max(1, rate // 1000)
+    start = time.perf_counter()
+    for i in range(0, count, batch):
+        for _ in range(min(batch, count - i)):
+            s.sendto(payload, ("127.0.0.1", port))
+        delay = start + (i + batch) / rate - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+    s.close()
+
+
+def gil_load(stop, rows):
+    """模拟界面刷新和JSON解码：长时间持有GIL的纯Python工作"""
+    while not stop.is_set():
+        json.loads(json.dumps(rows))
+
+
+def run_capture(args, counter, port):
+    """发送流量的同时制造GIL负载，返回被统计到的包数"""
+    remote = Main.ip_to_int(CAPTURE_PEER)
+    counter.collect(remote)
+
+    stop = threading.Event()
+    rows = [{'ip': f"8.8.{i // 256}.{i % 256}", 'location': "美国 加利福尼亚", 'speed': i * 1.5,
+             'history': list(range(20))} for i in range(2000)]
+    loads = [threading.Thread(target=gil_load, args=(stop, rows), daemon=True) for _ in range(args.capture_load)]
+    for t in loads:
+        t.start()
+
+    sender = multiprocessing.Process(target=send_udp_flood,
+                                     args=(args.capture_packets, port, args.capture_rate, args.min_size))
+    sender.start()
+    sender.join()
+    time.sleep(0.5)  # 等待抓包端处理完缓冲区
+    stop.set()
+    for t in loads:
+        t.join()
+
+    return counter.collect(remote)[0]
+
+
+def bench_capture(args):
+    try:
+        socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_UDP).close()
+    except OSError as e:
+        print(f"  跳过: 无法打开原始套接字 ({e})")
+        return {'skipped': str(e)}
+
+    port = 6672
+    Main.gta_ports = {port}
+    Main.LOCAL_IP = "127.0.0.1"
+    targets = Main.parse_local_ips()
+    results = {}
+
+    # 线程抓包：与负载线程共享GIL
+    Main.running = True
+    capture = Main.sniffer_af_packet if Main.use_af_packet() else Main.sniffer
+    with quiet():
+        threading.Thread(target=capture, args=targets[0], daemon=True).start()
+        time.sleep(0.5)
+        received = run_capture(args, Main.packet_stats, port)
+    Main.running = False
+    results['thread'] = received
+
+    # 独立进程抓包：计数经共享内存读取
+    process = Main.CaptureProcess(targets)
+    process.start()
+    try:
+        time.sleep(1.5)  # 等待子进程启动并打开套接字
+        results['process'] = run_capture(args, process.table, port)
+    finally:
+        process.stop()
+
+    for name in ('thread', 'process'):
+        received = results[name]
+        dropped = max(0, args.capture_packets - received)
+        results[name] = {'sent': args.capture_packets, 'received': received, 'dropped': dropped,
+                         'drop_ratio': dropped / args.capture_packets}
+        print(f"  抓包[{name:<7}] 发送 {args.capture_packets} | 统计到 {received} | "
+              f"丢失 {dropped} ({dropped / args.capture_packets:.1%})")
+    return results
+
+
+# === 结果对比 ===
+def flatten(data, prefix=""):
+    items = {}
+    for key, value in data.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            items.update(flatten(value, name + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            items[name] = value
+    return items
+
+
+def compare(old_path, results):
+    """与旧的结果文件逐项对比"""
+    with open(old_path, 'r', encoding='utf-8') as f:
+        old = flatten(json.load(f)['results'])
+    new = flatten(results)
+    print(f"\n=== 与 {old_path} 对比 ===")
+    for key in sorted(new):
+        if key in old and old[key]:
+            change = (new[key] - old[key]) / old[key] * 100
+            print(f"  {key:<45} {old[key]:>14,.2f} -> {new[key]:>14,.2f} ({change:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="GTA5 战局网络监控 - 性能测试")
+    parser.add_argument('--stages', default=",".join(STAGES), help=f"要运行的环节: {','.join(ALL_STAGES)}")
+    parser.add_argument('--packets', type=int, default=300000)
+    parser.add_argument('--peers', type=int, default=30, help="解析测试中的远端数量")
+    parser.add_argument('--min-size', type=int, default=40)
+    parser.add_argument('--max-size', type=int, default=400)
+    parser.add_argument('--ports', default="6672,61455,61456", help="合成流量使用的GTA端口")
+    parser.add_argument('--peer-counts', default="10,100,1000,10000", help="采样测试的远端数量")
+    parser.add_argument('--rounds', type=int, default=20)
+    parser.add_argument('--render-rows', type=int, default=60)
+    parser.add_argument('--geo-ips', type=int, default=300)
+    parser.add_argument('--geo-latency', type=float, default=0.05, help="模拟接口每次请求的延迟（秒）")
+    parser.add_argument('--geo-batch-size', type=int, default=Main.GEO_BATCH_SIZE)
+    parser.add_argument('--geo-quota', type=int, default=0, help="模拟接口每个窗口允许的请求次数（0为不限）")
+    parser.add_argument('--geo-quota-window', type=int, default=5, help="模拟频率限制的窗口长度（秒）")
+    parser.add_argument('--dns-ips', type=int, default=300)
+    parser.add_argument('--dns-latency', type=float, default=0.02, help="模拟DNS服务器的响应延迟（秒）")
+    parser.add_argument('--dns-timeout', type=float, default=0.5, help="反向DNS查询超时（秒）")
+    parser.add_argument('--dns-inflight', type=int, default=Main.DNS_MAX_INFLIGHT)
+    parser.add_argument('--capture-packets', type=int, default=200000)
+    parser.add_argument('--capture-rate', type=int, default=50000, help="实时抓包测试的发送速率（包/秒）")
+    parser.add_argument('--capture-load', type=int, default=2, help="实时抓包测试中占用GIL的负载线程数")
+    parser.add_argument('--output', help="结果保存为JSON")
+    parser.add_argument('--compare', metavar='JSON', help="与之前保存的结果对比")
+    args = parser.parse_args()
+    args.peer_counts = [int(x) for x in args.peer_counts.split(',')]
+
+    benches = {'parse': bench_parse, 'sampler': bench_sampler, 'render': bench_render, 'geo': bench_geo,
+               'dns': bench_dns, 'capture': bench_capture}
+    results = {}
+    for stage in args.stages.split(','):
+        print(f"[{stage}]")
+        results[stage] = benches[stage](args)
+
+    report = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'args': {k: v for k, v in vars(args).items() if k not in ('output', 'compare')},
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n结果已保存: {args.output}")
+    if args.compare:
+        compare(args.compare, results)
+
+
+if __name__ == "__main__":
+    main()
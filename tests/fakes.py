@@ -0,0 +1,134 @@
+"""测试和性能测试共用的本地模拟服务"""
+import json
+import socket
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import Main
+
+
+class FakeIpApi(BaseHTTPRequestHandler):
+    """本地模拟的 ip-api 批量接口
+
+    quota > 0 时模拟频率限制：每 quota_window 秒最多 quota 次请求，响应带 X-Rl/X-Ttl，超出返回429。
+    status 不为200时所有请求直接返回该状态码；fail_ips 中的IP返回 status=fail。
+    batches 按顺序记录每次请求的 (收到时间, IP列表)。
+    """
+    latency = 0.05
+    status = 200
+    fail_ips = frozenset()
+    requests = 0
+    rejected = 0
+    quota = 0
+    quota_window = 60
+    window_start = 0.0
+    window_used = 0
+    batches = []
+    lock = threading.Lock()
+
+    @classmethod
+    def reset(cls, latency=0.05, quota=0, quota_window=60):
+        with cls.lock:
+            cls.latency = latency
+            cls.status = 200
+            cls.fail_ips = frozenset()
+            cls.requests = cls.rejected = 0
+            cls.quota, cls.quota_window = quota, quota_window
+            cls.window_start, cls.window_used = 0.0, 0
+            cls.batches = []
+
+    @classmethod
+    def serve(cls):
+        """在本机随机端口启动，返回 (server, 批量接口URL)"""
+        server = ThreadingHTTPServer(('127.0.0.1', 0), cls)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server, f"http://127.0.0.1:{server.server_port}/batch"
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        with FakeIpApi.lock:
+            FakeIpApi.requests += 1
+            now = time.time()
+            FakeIpApi.batches.append((now, body))
+            if now - FakeIpApi.window_start >= FakeIpApi.quota_window:
+                FakeIpApi.window_start, FakeIpApi.window_used = now, 0
+            FakeIpApi.window_used += 1
+            remaining = FakeIpApi.quota - FakeIpApi.window_used
+            ttl = max(1, int(FakeIpApi.window_start + FakeIpApi.quota_window - now + 0.999))
+            limited = self.quota > 0 and remaining < 0
+            if limited:
+                FakeIpApi.rejected += 1
+        if limited:
+            self.send_response(429)
+            self.send_header('X-Rl', '0')
+            self.send_header('X-Ttl', str(ttl))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if self.status != 200:
+            self.send_response(self.status)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        time.sleep(self.latency)
+        out = [{"status": "fail", "message": "reserved range", "query": ip} if ip in self.fail_ips else
+               {"status": "success", "country": "美国", "regionName": "加利福尼亚", "city": "洛杉矶",
+                "isp": "Google LLC", "org": "Google LLC", "as": "AS15169 Google LLC", "query": ip} for ip in body]
+        data = json.dumps(out, ensure_ascii=False).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        if self.quota > 0:
+            self.send_header('X-Rl', str(max(0, remaining)))
+            self.send_header('X-Ttl', str(ttl))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeDnsServer:
+    """本地模拟的DNS服务器，只回答PTR查询
+
+    按IP最后一段分三类：有PTR记录 / NXDOMAIN / 不响应（测试超时），响应前固定延迟 latency 秒。
+    """
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.queries = 0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.settimeout(0.2)
+        self.address = f"127.0.0.1:{self.sock.getsockname()[1]}"
+        self.stopped = threading.Event()
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def _serve(self):
+        while not self.stopped.is_set():
+            try:
+                data, addr = self.sock.recvfrom(512)
+            except socket.timeout:
+                continue
+            self.queries += 1
+            qname, end = Main.read_dns_name(data, Main.DNS_HEADER.size)
+            ip = ".".join(reversed(qname.split('.')[:4]))
+            kind = int(ip.rsplit('.', 1)[1]) % 3
+            if kind == 2:
+                continue
+            qid = struct.unpack_from('!H', data)[0]
+            question = data[Main.DNS_HEADER.size:end + 4]
+            if kind == 0:
+                name = f"host-{ip.replace('.', '-')}.example.net"
+                rdata = b''.join(bytes([len(p)]) + p.encode() for p in name.split('.')) + b'\x00'
+                answer = b'\xc0\x0c' + Main.DNS_RR.pack(Main.DNS_TYPE_PTR, 1, 3600, len(rdata)) + rdata
+                reply = Main.DNS_HEADER.pack(qid, 0x8180, 1, 1, 0, 0) + question + answer
+            else:
+                reply = Main.DNS_HEADER.pack(qid, 0x8183, 1, 0, 0, 0) + question
+            threading.Timer(self.latency, self.sock.sendto, args=(reply, addr)).start()
+
+    def close(self):
+        self.stopped.set()
@@ -0,0 +1,84 @@
+import socket
+import struct
+
+import pytest
+
+import Main
+from Main import account_packet, ip_to_int
+
+LOCAL = ip_to_int('192.168.1.10')
+NOW = 1000.0
+
+
+def udp(src, dst, src_port=6672, dst_port=6672, payload=b'x' * 20, ihl=5):
+    options = b'\x01' * 4 * (ihl - 5)
+    total = 4 * ihl + 8 + len(payload)
+    ip = struct.pack('!BBHHHBBH4s4s', 0x40 | ihl, 0, total, 0, 0, 64, 17, 0,
+                     socket.inet_aton(src), socket.inet_aton(dst))
+    return bytearray(ip + options + struct.pack('!HHHH', src_port, dst_port, 8 + len(payload), 0) + payload)
+
+
+def account(packet, length=None):
+    """与抓包线程一样传入预分配缓冲区的 memoryview"""
+    buf = bytearray(2048)
+    buf[:len(packet)] = packet
+    return account_packet(memoryview(buf), len(packet) if length is None else length, LOCAL, NOW)
+
+
+@pytest.fixture(autouse=True)
+def counters():
+    Main.flow_table.clear()
+    Main.packet_stats.clear()
+    yield
+    Main.flow_table.clear()
+    Main.packet_stats.clear()
+
+
+def test_direction_split():
+    assert account(udp('192.168.1.10', '8.8.8.8', 50000, 6672))
+    assert account(udp('8.8.8.8', '192.168.1.10', 6672, 50000, b'y' * 72))
+    remote = ip_to_int('8.8.8.8')
+    assert Main.packet_stats.swap() == {remote: 48 + 100}
+    assert Main.flow_table.directions(NOW) == {remote: (48, 100, 1, 1)}
+    flow, = Main.flow_table.flows(remote)
+    assert (flow['local_port'], flow['remote_port']) == (50000, 6672)
+
+
+def test_length_and_header_checks():
+    packet = udp('8.8.8.8', '192.168.1.10')
+    assert not account(packet[:19], 19)  # 不足一个IP首部
+    assert not account(packet, 23)  # 没有完整的UDP端口字段
+    assert account(packet, 24)
+
+    with_options = udp('8.8.8.8', '192.168.1.10', ihl=15)  # 60字节首部
+    assert not account(with_options, 63)
+    assert account(with_options)
+    Main.flow_table.directions(NOW)
+    flow, = Main.flow_table.flows(ip_to_int('8.8.8.8'))
+    assert flow['remote_port'] == 6672  # 端口按IHL偏移读取
+
+
+def test_other_protocols_are_ignored():
+    packet = udp('8.8.8.8', '192.168.1.10')
+    packet[9] = 6  # TCP
+    assert not account(packet)
+
+
+def test_port_filter(monkeypatch):
+    monkeypatch.setattr(Main, 'gta_ports', {6672, 61455})
+    assert account(udp('8.8.8.8', '192.168.1.10', 61455, 1))
+    assert account(udp('8.8.8.8', '192.168.1.10', 1, 6672))
+    assert not account(udp('8.8.8.8', '192.168.1.10', 53, 53))
+    assert Main.packet_stats.swap() == {ip_to_int('8.8.8.8'): 96}
+
+
+@pytest.mark.parametrize('src, dst', [
+    ('192.168.1.10', '224.0.0.251'),  # 组播
+    ('192.168.1.10', '239.255.255.250'),
+    ('192.168.1.10', '255.255.255.255'),  # 广播
+    ('192.168.1.10', '192.168.1.10'),  # 本机发给自己
+])
+def test_dropped_destinations(src, dst):
+    assert not account(udp(src, dst))
+    assert Main.packet_stats.swap() == {}
+    assert Main.flow_table.directions(NOW) == {}
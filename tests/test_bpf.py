@@ -0,0 +1,61 @@
+import struct
+
+import pytest
+
+from Main import BPF_INSN, BPF_MAX_PORTS, build_udp_port_filter
+
+
+def run_bpf(prog, packet):
+    """按内核的语义解释执行用到的几条经典BPF指令，返回放行的字节数"""
+    a = x = 0
+    pc = 0
+    while True:
+        code, jt, jf, k = prog[pc]
+        pc += 1
+        if code == 0x30:  # ldb [k]
+            a = packet[k]
+        elif code == 0x28:  # ldh [k]
+            a = struct.unpack_from('!H', packet, k)[0]
+        elif code == 0x48:  # ldh [x+k]
+            a = struct.unpack_from('!H', packet, x + k)[0]
+        elif code == 0xB1:  # ldxb 4*([k]&0xf)
+            x = 4 * (packet[k] & 0xF)
+        elif code == 0x15:  # jeq #k
+            pc += jt if a == k else jf
+        elif code == 0x45:  # jset #k
+            pc += jt if a & k else jf
+        elif code == 0x06:  # ret #k
+            return k
+        else:
+            raise AssertionError(f"未知指令 {code:#x}")
+
+
+def packet(src_port, dst_port, proto=17, frag=0, ihl=5):
+    options = b'\x01' * 4 * (ihl - 5)
+    ip = struct.pack('!BBHHHBBH4s4s', 0x40 | ihl, 0, 0, 0, frag, 64, proto, 0, b'\x0a\x00\x00\x01', b'\x0a\x00\x00\x02')
+    return ip + options + struct.pack('!HHHH', src_port, dst_port, 8, 0)
+
+
+PORTS = {6672, 61455, 61456}
+
+
+@pytest.mark.parametrize('pkt, accepted', [
+    (packet(6672, 50000), True),
+    (packet(50000, 61456), True),
+    (packet(50000, 50001), False),
+    (packet(6672, 6672, proto=6), False),  # TCP
+    (packet(6672, 6672, frag=0x0010), False),  # 非首个分片
+    (packet(6672, 6672, frag=0x2000), True),  # 首个分片（只有MF标志）
+    (packet(50000, 61455, ihl=7), True),  # 带IP选项
+])
+def test_filter_accepts_only_monitored_ports(pkt, accepted):
+    assert (run_bpf(build_udp_port_filter(PORTS), pkt) > 0) == accepted
+
+
+def test_filter_jump_offsets_fit_at_max_ports():
+    ports = range(1000, 1000 + BPF_MAX_PORTS)
+    prog = build_udp_port_filter(ports)
+    for insn in prog:
+        BPF_INSN.pack(*insn)  # 跳转偏移必须能放进8位
+    assert run_bpf(prog, packet(50000, 1000 + BPF_MAX_PORTS - 1)) > 0
+    assert run_bpf(prog, packet(1000 + BPF_MAX_PORTS, 50000)) == 0
@@ -0,0 +1,76 @@
+import socket
+import struct
+import threading
+import time
+
+from Main import CaptureCounters, FlowTable, PacketStats, account_packet, ip_to_int
+
+LOCAL = ip_to_int('192.168.1.10')
+R1, R2 = ip_to_int('8.8.8.8'), ip_to_int('9.9.9.9')
+
+
+def udp(src, dst, payload=b'x' * 20):
+    ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 28 + len(payload), 0, 0, 64, 17, 0,
+                     socket.inet_aton(src), socket.inet_aton(dst))
+    return ip + struct.pack('!HHHH', 6672, 6672, 8 + len(payload), 0) + payload
+
+
+def test_each_thread_writes_its_own_shard():
+    """多个抓包线程同时累加同一批远端：各写各的分片，合并后计数不丢失"""
+    counters = CaptureCounters()
+    remotes = [f"8.8.{i // 256}.{i % 256}" for i in range(1, 201)]
+    packets = [udp(remote, '192.168.1.10') for remote in remotes]
+    barrier = threading.Barrier(4)
+    tables = []
+
+    def capture():
+        table = counters.shard()
+        tables.append(table)
+        barrier.wait()
+        now = time.monotonic()
+        for _ in range(50):
+            for packet in packets:
+                account_packet(packet, len(packet), LOCAL, now, None, table)
+
+    threads = [threading.Thread(target=capture) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len({id(t) for t in tables}) == 4
+    assert len(counters.shards) == 4
+    assert counters.swap() == {ip_to_int(remote): 48 * 200 for remote in remotes}
+    assert counters.collect(ip_to_int(remotes[0]))[0] == 200
+    assert counters.directions(time.monotonic())[ip_to_int(remotes[0])] == (0, 48 * 200, 0, 200)
+
+
+def test_merged_reads():
+    a, b = FlowTable(PacketStats(capacity=8), capacity=8), FlowTable(PacketStats(capacity=8), capacity=8)
+    counters = CaptureCounters([a, b])
+    a.account(R1, 6672, 6672, 100, True, 10.0)
+    a.account(R1, 6672, 6672, 100, False, 10.5)
+    b.account(R1, 6672, 6672, 50, False, 10.0)  # 同一个流的另一部分在另一个网卡上
+    b.account(R1, 6672, 61455, 50, False, 10.0)
+    b.account(R2, 6672, 6672, 10, True, 10.0)
+
+    assert counters.swap() == {R1: 300, R2: 10}
+    assert counters.directions(11.0) == {R1: (100, 200, 1, 3), R2: (10, 0, 1, 0)}
+    assert [(f['remote_port'], f['tx_bytes'], f['rx_bytes'], f['rx_packets']) for f in counters.flows(R1)] == \
+        [(6672, 100, 150, 2), (61455, 0, 50, 1)]
+    packets, _, max_gap = counters.collect(R1)
+    assert (packets, max_gap) == (4, 0.5)  # 到达间隔取包数最多的分片
+
+    counters.release(R2)
+    assert counters.collect(R2) == (0, 0.0, 0.0)
+    counters.clear()
+    assert counters.swap() == {}
+    assert counters.flows(R1) == []
+
+
+def test_thread_shard_is_reused():
+    counters = CaptureCounters()
+    assert counters.shard() is counters.shard()
+    counters.account(R1, 1, 1, 10, True, 1.0)
+    assert counters.swap() == {R1: 10}
+    assert counters.collect(R1)[0] == 1
@@ -0,0 +1,149 @@
+import socket
+import struct
+import time
+
+import pytest
+
+import Main
+from Main import iter_capture_file, strip_link_header
+
+
+def ipv4_udp(src_port=6672, dst_port=6672, payload=b'x' * 8):
+    ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 28 + len(payload), 0, 0, 64, 17, 0,
+                     bytes([10, 0, 0, 1]), bytes([10, 0, 0, 2]))
+    return ip + struct.pack('!HHHH', src_port, dst_port, 8 + len(payload), 0) + payload
+
+
+def ethernet(ip, vlan=False, ethertype=b'\x08\x00'):
+    header = b'\x11' * 6 + b'\x22' * 6
+    if vlan:
+        header += b'\x81\x00\x00\x05'
+    return header + ethertype + ip
+
+
+def write_pcap(path, packets, endian='<', nanos=False, linktype=1):
+    magic = 0xA1B23C4D if nanos else 0xA1B2C3D4
+    data = struct.pack(endian + 'IHHiIII', magic, 2, 4, 0, 0, 65535, linktype)
+    for sec, frac, frame in packets:
+        data += struct.pack(endian + 'IIII', sec, frac, len(frame), len(frame)) + frame
+    path.write_bytes(data)
+
+
+def pcapng_block(block_type, body):
+    body += b'\x00' * (-len(body) % 4)
+    length = len(body) + 12
+    return struct.pack('<II', block_type, length) + body + struct.pack('<I', length)
+
+
+def test_strip_link_header():
+    ip = ipv4_udp()
+    assert strip_link_header(1, ethernet(ip)) == ip
+    assert strip_link_header(1, ethernet(ip, vlan=True)) == ip
+    assert strip_link_header(1, ethernet(ip, ethertype=b'\x86\xdd')) is None  # IPv6
+    assert strip_link_header(101, ip) == ip
+    assert strip_link_header(113, b'\x00' * 16 + ip) == ip
+    assert strip_link_header(147, ip) is None  # 不支持的链路类型
+    assert strip_link_header(101, ip[:19]) is None
+
+
+@pytest.mark.parametrize('endian', ['<', '>'])
+def test_pcap_microseconds(tmp_path, endian):
+    ip = ipv4_udp()
+    path = tmp_path / 'cap.pcap'
+    write_pcap(path, [(100, 250000, ethernet(ip)), (101, 0, ethernet(ip, ethertype=b'\x08\x06')),
+                      (102, 500000, ethernet(ip, vlan=True))], endian=endian)
+    assert list(iter_capture_file(str(path))) == [(100.25, ip), (102.5, ip)]
+
+
+def test_pcap_nanoseconds_and_truncated_record(tmp_path):
+    ip = ipv4_udp()
+    path = tmp_path / 'cap.pcap'
+    write_pcap(path, [(5, 500000000, ip), (6, 0, ip)], nanos=True, linktype=101)
+    path.write_bytes(path.read_bytes()[:-3])  # 最后一个包写到一半
+    assert list(iter_capture_file(str(path))) == [(5.5, ip)]
+
+
+def test_not_a_capture_file(tmp_path):
+    path = tmp_path / 'cap.pcap'
+    path.write_bytes(b'hello world')
+    with pytest.raises(ValueError):
+        list(iter_capture_file(str(path)))
+
+
+def test_pcapng(tmp_path):
+    ip = ipv4_udp()
+    shb = pcapng_block(0x0A0D0D0A, struct.pack('<IHHq', 0x1A2B3C4D, 1, 0, -1))
+    idb_us = pcapng_block(1, struct.pack('<HHI', 1, 0, 65535))
+    # if_tsresol = 9 (纳秒)
+    idb_ns = pcapng_block(1, struct.pack('<HHI', 101, 0, 65535) + struct.pack('<HHB3x', 9, 1, 9) + b'\x00' * 4)
+    frame = ethernet(ip)
+    ts_us = 1_000_000 * 10 + 250_000
+    ts_ns = 1_000_000_000 * 20 + 500_000_000
+    epb0 = pcapng_block(6, struct.pack('<IIIII', 0, ts_us >> 32, ts_us & 0xFFFFFFFF, len(frame), len(frame)) + frame)
+    epb1 = pcapng_block(6, struct.pack('<IIIII', 1, ts_ns >> 32, ts_ns & 0xFFFFFFFF, len(ip), len(ip)) + ip)
+    epb_unknown = pcapng_block(6, struct.pack('<IIIII', 5, 0, 0, len(ip), len(ip)) + ip)
+    spb = pcapng_block(3, struct.pack('<I', len(frame)) + frame)
+    path = tmp_path / 'cap.pcapng'
+    path.write_bytes(shb + idb_us + idb_ns + epb0 + epb_unknown + epb1 + spb)
+
+    packets = list(iter_capture_file(str(path)))
+    assert [data for _, data in packets] == [ip, ip, ip]
+    assert packets[0][0] == pytest.approx(10.25)
+    assert packets[1][0] == pytest.approx(20.5)
+    assert packets[2][0] == packets[1][0]  # 简单分组块沿用上一个时间戳
+
+
+def udp(src, dst, src_port, dst_port, payload=b'x' * 8):
+    ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 28 + len(payload), 0, 0, 64, 17, 0,
+                     socket.inet_aton(src), socket.inet_aton(dst))
+    return ip + struct.pack('!HHHH', src_port, dst_port, 8 + len(payload), 0) + payload
+
+
+@pytest.fixture
+def counters(monkeypatch):
+    monkeypatch.setattr(Main, 'LOCAL_IP', 'all')
+    Main.flow_table.clear()
+    Main.packet_stats.clear()
+    yield
+    Main.flow_table.clear()
+    Main.packet_stats.clear()
+
+
+def write_session(path):
+    """本机 192.168.1.10 与两个远端通信，另有一条不相关端口的流量"""
+    local = '192.168.1.10'
+    packets = []
+    for i in range(10):
+        packets.append((100 + i, 0, ethernet(udp(local, '8.8.8.8', 6672, 6672, b'u' * 92))))
+        packets.append((100 + i, 1, ethernet(udp('8.8.8.8', local, 6672, 6672, b'd' * 172))))
+        packets.append((100 + i, 2, ethernet(udp('9.9.9.9', local, 6672, 6672))))
+        packets.append((100 + i, 3, ethernet(udp('9.9.9.9', '1.2.3.4', 53, 53))))
+    write_pcap(path, packets)
+
+
+def test_replay_infers_local_address_from_capture(tmp_path, counters):
+    path = tmp_path / 'cap.pcap'
+    write_session(path)
+    assert [Main.int_to_ip(ip) for ip, _ in Main.capture_local_ips(str(path))][0] == '192.168.1.10'
+
+    total, accepted, _ = Main.replay_capture(str(path), realtime=False)
+    assert (total, accepted) == (40, 30)
+    directions = Main.flow_table.directions(time.monotonic())
+    assert directions == {Main.ip_to_int('8.8.8.8'): (1200, 2000, 10, 10),
+                          Main.ip_to_int('9.9.9.9'): (0, 360, 0, 10)}
+
+
+def test_single_remote_prefers_private_address(tmp_path):
+    path = tmp_path / 'cap.pcap'
+    write_pcap(path, [(1, 0, udp('8.8.8.8', '10.1.1.1', 6672, 6672)),
+                      (1, 1, udp('10.1.1.1', '8.8.8.8', 6672, 6672))], linktype=101)
+    assert Main.capture_local_ips(str(path))[0][0] == Main.ip_to_int('10.1.1.1')
+
+
+def test_explicit_address_is_used(tmp_path, counters, monkeypatch):
+    path = tmp_path / 'cap.pcap'
+    write_session(path)
+    monkeypatch.setattr(Main, 'LOCAL_IP', '9.9.9.9')
+    assert Main.replay_local_ip(str(path)) == Main.ip_to_int('9.9.9.9')
+    monkeypatch.setattr(Main, 'LOCAL_IP', '10.0.0.1,192.168.1.10')
+    assert Main.replay_local_ip(str(path)) == Main.ip_to_int('192.168.1.10')
@@ -0,0 +1,61 @@
+import threading
+import time
+from collections import OrderedDict
+from types import SimpleNamespace
+
+import Main
+
+
+class Table:
+    """记录被清空时写入线程是否还在运行"""
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.cleared_while_running = None
+
+    def clear(self):
+        self.cleared_while_running = self.writer.is_alive()
+
+
+def fake_state(monkeypatch, writer):
+    """把 cleanup 会清空的全局数据换成测试对象，返回计数表"""
+    monkeypatch.setattr(Main, 'running', True)
+    tables = [Table(writer) for _ in range(5)]
+    for name, table in zip(('peers_map', 'byte_counters', 'packet_stats', 'flow_table', 'history_store'), tables):
+        monkeypatch.setattr(Main, name, table)
+    monkeypatch.setattr(Main, 'peer_interfaces', {})
+    monkeypatch.setattr(Main, 'departed_timelines', OrderedDict())
+    monkeypatch.setattr(Main, 'gta_ports', set())
+    closed = SimpleNamespace(close=lambda: None)
+    monkeypatch.setattr(Main, 'geo_cache', closed)
+    monkeypatch.setattr(Main, 'dns_cache', closed)
+    monkeypatch.setattr(Main, 'worker_threads', [writer])
+    return tables
+
+
+def test_cleanup_waits_for_workers_before_clearing(monkeypatch):
+    def sampler():
+        while Main.running:
+            time.sleep(0.05)
+        time.sleep(0.2)  # 模拟退出前还在处理的最后一轮
+
+    writer = threading.Thread(target=sampler, daemon=True)
+    tables = fake_state(monkeypatch, writer)
+    writer.start()
+
+    Main.cleanup()
+    assert [table.cleared_while_running for table in tables] == [False] * 5
+    assert Main.worker_threads == []
+
+
+def test_cleanup_gives_up_on_stuck_workers(monkeypatch):
+    stuck = threading.Event()
+    writer = threading.Thread(target=stuck.wait, daemon=True)  # 如没有流量时阻塞在 recv 中的抓包线程
+    fake_state(monkeypatch, writer)
+    monkeypatch.setattr(Main, 'CLEANUP_JOIN_TIMEOUT', 0.2)
+    writer.start()
+
+    start = time.monotonic()
+    Main.cleanup()
+    assert time.monotonic() - start < 1.0
+    stuck.set()
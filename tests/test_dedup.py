@@ -0,0 +1,50 @@
+import pytest
+
+import Main
+from Main import PacketDeduplicator, account_packet, ip_to_int
+from test_account_packet import LOCAL, NOW, udp
+
+KEY = (0x08080808, 6672, 28, b'payload')
+
+
+def test_second_copy_from_other_interface_is_dropped():
+    dedup = PacketDeduplicator(window=0.5)
+    assert not dedup.is_duplicate(KEY, 'eth0', NOW)
+    assert dedup.is_duplicate(KEY, 'tap0', NOW + 0.01)
+    # 同一网卡上重复出现的相同载荷是真实的重复包，照常统计
+    assert not dedup.is_duplicate(KEY, 'eth0', NOW + 0.02)
+    assert not dedup.is_duplicate(KEY[:3] + (b'other',), 'tap0', NOW + 0.03)
+
+
+def test_keys_survive_one_rotation_and_expire_after_two():
+    dedup = PacketDeduplicator(window=0.5)
+    dedup.rotated = NOW
+    assert not dedup.is_duplicate(KEY, 'eth0', NOW)
+    assert dedup.is_duplicate(KEY, 'tap0', NOW + 0.6)  # 已轮换到上一代
+    assert not dedup.is_duplicate(KEY, 'tap0', NOW + 1.2)  # 两次轮换后过期
+    assert dedup.is_duplicate(KEY, 'eth0', NOW + 1.3)  # 此时 tap0 先到
+
+
+@pytest.fixture
+def dedup(monkeypatch):
+    monkeypatch.setattr(Main, 'packet_dedup', PacketDeduplicator())
+    monkeypatch.setattr(Main, 'peer_interfaces', {})
+    Main.flow_table.clear()
+    yield
+    Main.flow_table.clear()
+
+
+def account(packet, iface, local=LOCAL):
+    buf = bytearray(2048)
+    buf[:len(packet)] = packet
+    return account_packet(memoryview(buf), len(packet), local, NOW, iface)
+
+
+def test_account_packet_counts_nat_copies_once(dedup):
+    # 虚拟网卡上是内网地址，物理网卡上是NAT改写后的地址和端口
+    assert account(udp('8.8.8.8', '10.0.0.2', 6672, 6672), 'tap0', ip_to_int('10.0.0.2'))
+    assert not account(udp('8.8.8.8', '192.168.1.10', 6672, 50000), 'eth0')
+    assert account(udp('8.8.8.8', '192.168.1.10', 6672, 50000, b'z' * 20), 'eth0')
+    remote = ip_to_int('8.8.8.8')
+    assert Main.packet_stats.swap() == {remote: 96}
+    assert Main.peer_interfaces == {remote: {'tap0', 'eth0'}}
@@ -0,0 +1,162 @@
+import struct
+import threading
+import time
+
+import pytest
+
+import Main
+from Main import (DNS_HEADER, DNS_RR, DNS_TYPE_PTR, ReverseDnsResolver, build_ptr_query, parse_ptr_response,
+                  ptr_query_name, read_dns_name)
+from tests.fakes import FakeDnsServer
+
+
+def encode_name(name):
+    return b''.join(bytes([len(label)]) + label.encode('ascii') for label in name.split('.')) + b'\x00'
+
+
+def make_response(query, flags=0x8180, answers=()):
+    """在请求报文后追加回答，回答的名字用指向问题的压缩指针"""
+    qid, _, qdcount, _, _, _ = DNS_HEADER.unpack_from(query)
+    data = DNS_HEADER.pack(qid, flags, qdcount, len(answers), 0, 0) + query[DNS_HEADER.size:]
+    for rtype, rdata in answers:
+        data += b'\xc0\x0c' + DNS_RR.pack(rtype, 1, 300, len(rdata)) + rdata
+    return data
+
+
+def test_ptr_query_name():
+    assert ptr_query_name('1.2.3.4') == '4.3.2.1.in-addr.arpa'
+
+
+def test_build_ptr_query():
+    query = build_ptr_query(0x1234, '8.8.4.4')
+    qid, flags, qdcount, ancount, _, _ = DNS_HEADER.unpack_from(query)
+    assert (qid, flags, qdcount, ancount) == (0x1234, 0x0100, 1, 0)
+    name, offset = read_dns_name(query, DNS_HEADER.size)
+    assert name == '4.4.8.8.in-addr.arpa'
+    assert struct.unpack_from('!HH', query, offset) == (DNS_TYPE_PTR, 1)
+    assert offset + 4 == len(query)
+
+
+def test_parse_ok_skips_other_records():
+    query = build_ptr_query(7, '1.2.3.4')
+    cname = encode_name('alias.example')
+    response = make_response(query, answers=[(5, cname), (DNS_TYPE_PTR, encode_name('host.example.com'))])
+    assert parse_ptr_response(response) == (7, '4.3.2.1.in-addr.arpa', 'ok', 'host.example.com')
+
+
+def test_parse_compressed_answer_name():
+    query = build_ptr_query(9, '1.2.3.4')
+    # 域名的后缀指回问题中的 "in-addr.arpa"（偏移 12 + 8）
+    rdata = b'\x04host\xc0\x14'
+    response = make_response(query, answers=[(DNS_TYPE_PTR, rdata)])
+    assert parse_ptr_response(response)[2:] == ('ok', 'host.in-addr.arpa')
+
+
+@pytest.mark.parametrize('flags, status', [(0x8183, 'nxdomain'), (0x8182, 'error'), (0x8380, 'error')])
+def test_parse_failure_status(flags, status):
+    response = make_response(build_ptr_query(3, '1.2.3.4'), flags=flags)
+    assert parse_ptr_response(response) == (3, '4.3.2.1.in-addr.arpa', status, None)
+
+
+def test_parse_noerror_without_ptr():
+    response = make_response(build_ptr_query(3, '1.2.3.4'))
+    assert parse_ptr_response(response)[2:] == ('nxdomain', None)
+
+
+def test_parse_rejects_query():
+    with pytest.raises(ValueError):
+        parse_ptr_response(build_ptr_query(1, '1.2.3.4'))
+
+
+def test_pointer_loop_is_rejected():
+    data = DNS_HEADER.pack(1, 0x8180, 1, 0, 0, 0) + b'\xc0\x0c'
+    with pytest.raises(ValueError):
+        read_dns_name(data, DNS_HEADER.size)
+
+
+@pytest.fixture
+def dns_server(monkeypatch):
+    """最后一段 %3：0 有PTR记录，1 为NXDOMAIN，2 不响应"""
+    monkeypatch.setattr(Main, 'dns_cache', {})
+    server = FakeDnsServer(latency=0.01)
+    yield server
+    server.close()
+
+
+class Answers:
+    def __init__(self, expected):
+        self.expected = expected
+        self.items = {}
+        self.cond = threading.Condition()
+
+    def __call__(self, ip, domain):
+        with self.cond:
+            self.items[ip] = domain
+            self.cond.notify_all()
+
+    def wait(self, timeout=5):
+        with self.cond:
+            assert self.cond.wait_for(lambda: len(self.items) >= self.expected, timeout)
+        return self.items
+
+
+def test_answer_nxdomain_and_timeout(dns_server):
+    resolver = ReverseDnsResolver(server=dns_server.address, timeout=0.3)
+    answers = Answers(3)
+    for ip in ('8.8.8.9', '8.8.8.10', '8.8.8.11'):
+        resolver.resolve(ip, answers)
+    assert answers.wait() == {'8.8.8.9': 'host-8-8-8-9.example.net', '8.8.8.10': None, '8.8.8.11': None}
+    assert Main.dns_cache == {'8.8.8.9': 'host-8-8-8-9.example.net'}
+    now = time.time()
+    assert now + Main.DNS_NEGATIVE_TTL - 5 < resolver.negative['8.8.8.10'] <= now + Main.DNS_NEGATIVE_TTL
+    assert now + Main.DNS_FAILURE_TTL - 5 < resolver.negative['8.8.8.11'] <= now + Main.DNS_FAILURE_TTL
+
+    # 缓存和负缓存直接命中，不再发查询
+    queries = dns_server.queries
+    again = Answers(3)
+    for ip in ('8.8.8.9', '8.8.8.10', '8.8.8.11'):
+        resolver.resolve(ip, again)
+    assert again.wait() == answers.items
+    assert dns_server.queries == queries == 3
+
+
+def test_inflight_limit(dns_server):
+    resolver = ReverseDnsResolver(server=dns_server.address, timeout=0.3, max_inflight=2)
+    ips = [f"8.8.8.{3 * i + 2}" for i in range(6)]  # 都不响应，只能等超时
+    answers = Answers(len(ips))
+    for ip in ips:
+        resolver.resolve(ip, answers)
+    with resolver.cond:
+        assert len(resolver.inflight) == 2
+        assert list(resolver.pending) == ips[2:]
+    assert answers.wait() == dict.fromkeys(ips)
+    assert dns_server.queries == len(ips)
+    assert resolver.inflight == {} and not resolver.pending
+
+
+class BrokenSocket:
+    def recvfrom(self, size):
+        raise OSError("网络不可用")
+
+    def close(self):
+        pass
+
+
+def test_socket_error_requeues_inflight_to_system_lookup(dns_server, monkeypatch):
+    looked_up = []
+    monkeypatch.setattr(Main.socket, 'gethostbyaddr',
+                        lambda ip: looked_up.append(ip) or (f"sys-{ip}.example", [], [ip]))
+    resolver = ReverseDnsResolver(server=dns_server.address, timeout=5.0, max_inflight=2)
+    ips = [f"8.8.8.{3 * i + 2}" for i in range(4)]
+    answers = Answers(len(ips))
+    for ip in ips:
+        resolver.resolve(ip, answers)
+    with resolver.cond:
+        sock, resolver.sock = resolver.sock, BrokenSocket()
+    sock.close()
+
+    # 在途的两个查询不用等 5 秒超时，立即改用系统解析
+    assert answers.wait(timeout=2) == {ip: f"sys-{ip}.example" for ip in ips}
+    assert sorted(looked_up) == sorted(ips)
+    assert resolver.address is None
+    assert resolver.inflight == {} and resolver.blocking == 0
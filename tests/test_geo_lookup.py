@@ -0,0 +1,75 @@
+import threading
+
+import pytest
+
+from Main import GeoLookupQueue
+from tests.fakes import FakeIpApi
+
+
+@pytest.fixture
+def api():
+    FakeIpApi.reset(latency=0.01)
+    server, url = FakeIpApi.serve()
+    yield url
+    server.shutdown()
+    server.server_close()
+
+
+class Results:
+    """收集回调结果，全部到齐后唤醒"""
+
+    def __init__(self, expected):
+        self.expected = expected
+        self.items = []
+        self.cond = threading.Condition()
+
+    def callback(self, key):
+        def on_result(d, error):
+            with self.cond:
+                self.items.append((key, d, error))
+                self.cond.notify_all()
+        return on_result
+
+    def wait(self, timeout=10):
+        with self.cond:
+            assert self.cond.wait_for(lambda: len(self.items) >= self.expected, timeout)
+        return self.items
+
+
+def test_lookups_are_batched(api):
+    queue = GeoLookupQueue(url=api, window=0.1, batch_size=100, workers=1)
+    ips = [f"8.8.{i // 256}.{i % 256}" for i in range(250)]
+    results = Results(len(ips))
+    for ip in ips:
+        queue.submit(ip, results.callback(ip))
+
+    items = results.wait()
+    assert FakeIpApi.requests == 3
+    assert sorted(len(batch) for _, batch in FakeIpApi.batches) == [50, 100, 100]
+    assert all(error is None and d['query'] == ip for ip, d, error in items)
+
+
+def test_duplicate_ips_are_coalesced(api):
+    queue = GeoLookupQueue(url=api, window=0.1, workers=2)
+    results = Results(6)
+    for i in range(3):
+        queue.submit('8.8.8.8', results.callback(i))
+        queue.submit('1.1.1.1', results.callback(i))
+
+    items = results.wait()
+    sent = [ip for _, batch in FakeIpApi.batches for ip in batch]
+    assert sorted(sent) == ['1.1.1.1', '8.8.8.8']  # 每个IP只查询一次
+    assert sorted(d['query'] for _, d, _ in items) == ['1.1.1.1'] * 3 + ['8.8.8.8'] * 3
+
+
+def test_failed_status_is_delivered_once(api):
+    """接口明确返回失败的IP不重试，直接把结果交给所有等待者"""
+    FakeIpApi.fail_ips = frozenset({'10.0.0.1'})
+    queue = GeoLookupQueue(url=api, window=0.05, workers=1)
+    results = Results(2)
+    queue.submit('10.0.0.1', results.callback(0))
+    queue.submit('10.0.0.1', results.callback(1))
+
+    items = results.wait()
+    assert FakeIpApi.requests == 1
+    assert [(d['status'], error) for _, d, error in items] == [('fail', None), ('fail', None)]
@@ -0,0 +1,100 @@
+import time
+
+import pytest
+
+import Main
+from Main import GeoLookupQueue
+from test_geo_lookup import Results, api  # noqa: F401  api 为 fixture
+from tests.fakes import FakeIpApi
+
+
+def test_pop_order_follows_latest_priority():
+    queue = GeoLookupQueue(workers=0)
+    for i, ip in enumerate(['a', 'b', 'c']):
+        queue._push(ip, (i,))
+    queue.reprioritize({'c': (-1,), 'a': (5,), 'missing': (0,)})
+    assert [queue._pop()[0] for _ in range(4)] == ['c', 'b', 'a', None]
+
+
+def test_stale_entries_are_compacted():
+    queue = GeoLookupQueue(workers=0)
+    for i in range(50):
+        queue._push(str(i), (i,))
+    for round_ in range(100):
+        queue.reprioritize({str(i): (round_, -i) for i in range(50)})
+    assert len(queue.heap) <= 2 * 50 + 64
+    assert [queue._pop()[0] for _ in range(50)] == [str(i) for i in range(49, -1, -1)]
+    assert queue._pop() == (None, None)
+
+
+@pytest.fixture
+def no_jitter(monkeypatch):
+    """退避和限速等待的随机部分取上限，等待时间可预期"""
+    monkeypatch.setattr(Main.random, 'uniform', lambda a, b: b)
+
+
+def lookup(queue, ip):
+    results = Results(1)
+    queue.submit(ip, results.callback(ip))
+    _, d, error = results.wait()[0]
+    return d, error
+
+
+def test_rate_limited_batch_is_resent_after_window(api, monkeypatch):
+    """429 不算失败：等到 X-Ttl 给出的窗口重置后重发，即使只允许查询一次"""
+    monkeypatch.setattr(Main, 'GEO_MAX_ATTEMPTS', 1)
+    monkeypatch.setattr(Main.random, 'uniform', lambda a, b: 0.0)  # 窗口重置后不再额外等待
+    FakeIpApi.quota, FakeIpApi.quota_window = 1, 1
+    FakeIpApi.window_start, FakeIpApi.window_used = time.time(), 1  # 当前窗口的配额已用完
+
+    d, error = lookup(GeoLookupQueue(url=api, window=0.01, workers=1), '8.8.8.8')
+    assert error is None and d['status'] == 'success'
+    assert (FakeIpApi.requests, FakeIpApi.rejected) == (2, 1)
+    (first, _), (second, _) = FakeIpApi.batches
+    assert second - first >= 0.9
+
+
+def test_requests_are_paced_by_remaining_quota(api, monkeypatch):
+    monkeypatch.setattr(Main.random, 'uniform', lambda a, b: 0.0)
+    FakeIpApi.quota, FakeIpApi.quota_window = 1, 1
+    queue = GeoLookupQueue(url=api, window=0.01, workers=1)
+
+    assert lookup(queue, '8.8.8.8')[1] is None  # X-Rl: 0, X-Ttl: 1
+    assert lookup(queue, '1.1.1.1')[1] is None
+    (first, _), (second, _) = FakeIpApi.batches
+    assert second - first >= 0.9  # 等到窗口重置才发第二批
+    assert FakeIpApi.rejected == 0
+
+
+def test_retries_are_bounded_and_back_off(api, no_jitter, monkeypatch):
+    monkeypatch.setattr(Main, 'GEO_MAX_ATTEMPTS', 3)
+    monkeypatch.setattr(Main, 'GEO_BACKOFF_BASE', 0.1)
+    FakeIpApi.status = 503
+    queue = GeoLookupQueue(url=api, window=0.01, workers=1)
+
+    d, error = lookup(queue, '8.8.8.8')
+    assert d is None and 'HTTP 503' in str(error)
+    assert FakeIpApi.requests == 3
+    times = [t for t, _ in FakeIpApi.batches]
+    gaps = [b - a for a, b in zip(times, times[1:])]
+    assert gaps[0] >= 0.1 and gaps[1] >= 0.2  # 0.1s、0.2s 指数退避
+    assert gaps[1] > gaps[0]
+
+
+def test_failed_ip_is_requeried_after_negative_cache_expires(api, no_jitter, monkeypatch):
+    monkeypatch.setattr(Main, 'GEO_MAX_ATTEMPTS', 1)
+    monkeypatch.setattr(Main, 'GEO_FAILURE_TTL', 0.5)
+    FakeIpApi.status = 503
+    queue = GeoLookupQueue(url=api, window=0.01, workers=1)
+    assert lookup(queue, '8.8.8.8')[1] is not None
+    assert FakeIpApi.requests == 1
+
+    FakeIpApi.status = 200
+    d, error = lookup(queue, '8.8.8.8')  # 负缓存期内直接返回上次的错误
+    assert d is None and error is not None
+    assert FakeIpApi.requests == 1
+
+    time.sleep(0.6)
+    d, error = lookup(queue, '8.8.8.8')
+    assert error is None and d['status'] == 'success'
+    assert FakeIpApi.requests == 2
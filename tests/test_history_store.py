@@ -0,0 +1,73 @@
+import math
+
+from Main import HistoryStore
+
+
+def test_summary_of_partial_row():
+    store = HistoryStore(capacity=2, size=4)
+    slot = store.allocate()
+    assert store.summary(slot) is None
+    store.append(slot, 10.0, 20.0, 5.0, 1.0, 30.0, burst=12.0, up=4.0, down=6.0)
+    store.append(slot, 30.0, None, 7.0, 2.0, 10.0, burst=40.0, up=8.0, down=22.0)
+
+    summary = store.summary(slot)
+    assert summary['avg_speed'] == 20.0
+    assert summary['max_speed'] == 30.0
+    assert summary['avg_lat'] == 20.0  # 缺失的延迟不参与平均
+    assert summary['avg_pps'] == 6.0
+    assert summary['jitter'] == 2.0  # 取最新一个样本
+    assert summary['max_gap'] == 30.0
+    assert summary['max_burst'] == 40.0
+    assert (summary['avg_up'], summary['avg_down']) == (6.0, 14.0)
+
+
+def test_ring_wraps_and_keeps_latest_samples():
+    store = HistoryStore(capacity=1, size=4)
+    slot = store.allocate()
+    for i in range(1, 7):  # 6 个样本写入 4 格环形缓冲：保留 3..6
+        store.append(slot, float(i), None, 0.0, float(i), 0.0)
+    summary = store.summary(slot)
+    assert store.count[slot] == 4
+    assert store.head[slot] == 2
+    assert summary['avg_speed'] == 4.5
+    assert summary['max_speed'] == 6.0
+    assert summary['jitter'] == 6.0
+    assert summary['avg_lat'] is None
+
+
+def test_summary_is_cached_until_next_sample():
+    store = HistoryStore(capacity=1, size=4)
+    slot = store.allocate()
+    store.append(slot, 10.0, 5.0, 0.0, 0.0, 0.0)
+    first = store.summary(slot)
+    assert store.summary(slot) is first
+    store.append(slot, 20.0, 5.0, 0.0, 0.0, 0.0)
+    assert store.summary(slot)['avg_speed'] == 15.0
+
+
+def test_release_clears_row_and_slot_is_reused():
+    store = HistoryStore(capacity=2, size=4)
+    a, b = store.allocate(), store.allocate()
+    store.append(a, 10.0, 5.0, 0.0, 0.0, 0.0)
+    store.append(b, 99.0, 5.0, 0.0, 0.0, 0.0)
+    store.release(a)
+    assert store.summary(a) is None
+    assert store.summary(b)['avg_speed'] == 99.0
+
+    assert store.allocate() == a
+    assert store.count[a] == 0
+    assert math.isnan(store.columns['latency'][a * store.size])
+    store.append(a, 1.0, None, 0.0, 0.0, 0.0)
+    assert store.summary(a)['avg_speed'] == 1.0
+
+
+def test_grows_when_slots_run_out():
+    store = HistoryStore(capacity=2, size=4)
+    slots = [store.allocate() for _ in range(5)]
+    assert sorted(slots) == list(range(5))
+    assert store.capacity == 8
+    assert len(store.columns['speed']) == 8 * 4
+    store.append(slots[-1], 7.0, None, 0.0, 0.0, 0.0)
+    assert store.summary(slots[-1])['avg_speed'] == 7.0
+    store.clear()
+    assert sorted(store.free) == list(range(8))
@@ -0,0 +1,79 @@
+import pytest
+
+from Main import LAG_EXIT, LAG_WARMUP, LagDetector, session_baseline
+
+# (速度 KB/s, 包速, 延迟 ms, 抖动 ms, 最大间隔 ms)
+STEADY = (10.0, 30.0, 40, 2.0, 50.0)
+
+
+def feed(detector, samples, baseline=None, eligible=True):
+    return [detector.update(sample, baseline, eligible) for sample in samples]
+
+
+def warmed_up():
+    detector = LagDetector()
+    feed(detector, [STEADY] * 20)
+    return detector
+
+
+def test_steady_trace_is_never_flagged():
+    detector = LagDetector()
+    assert not any(feed(detector, [STEADY] * 50, baseline=(10.0, 1.0)))
+    assert detector.confidence == 0.0
+    assert detector.reason == ""
+
+
+def test_packet_rate_drop_needs_two_samples_then_clears():
+    detector = warmed_up()
+    drop = (10.0, 3.0, 40, 2.0, 50.0)
+    assert not detector.update(drop)  # 离开战局的远端也会骤降一次
+    assert detector.confidence == pytest.approx(0.9 - 3.0 / (30.0 * 0.25) * 0.4, abs=0.01)
+    assert detector.update(drop)
+    assert detector.reason == "包速骤降"
+    flagged_confidence = detector.confidence
+
+    results = feed(detector, [STEADY] * LAG_EXIT)
+    assert all(results[:-1]) and not results[-1]  # 连续 LAG_EXIT 个正常样本后解除
+    assert detector.reason == ""
+    assert detector.confidence < flagged_confidence * 0.2
+
+
+def test_gap_then_recovery_is_flagged_at_once():
+    detector = warmed_up()
+    assert detector.update((10.0, 30.0, 40, 2.0, 2500.0))
+    assert detector.reason == "断流后恢复"
+    assert detector.confidence == 1.0
+
+
+def test_traffic_far_above_session_baseline():
+    detector = warmed_up()
+    baseline = session_baseline([8.0, 10.0, 11.0, 12.0, 9.0])
+    assert not detector.update((25.0, 30.0, 40, 2.0, 50.0), baseline)  # 低于会话中位数的3倍
+    assert detector.update((120.0, 30.0, 40, 2.0, 50.0), baseline)
+    assert detector.reason == "流量异常"
+    assert detector.confidence == 1.0
+
+
+def test_latency_spike():
+    detector = warmed_up()
+    spike = (10.0, 30.0, 150, 2.0, 50.0)
+    assert not detector.update(spike)
+    assert detector.update(spike)
+    assert detector.reason == "延迟突增"
+    assert 0.5 < detector.confidence < 1.0
+
+
+def test_warmup_and_ineligible_peers_only_learn():
+    detector = LagDetector()
+    burst = (10.0, 30.0, 40, 2.0, 2500.0)
+    assert not any(feed(detector, [burst] * (LAG_WARMUP - 1) + [STEADY]))
+    assert detector.samples == LAG_WARMUP
+
+    official = warmed_up()
+    assert not any(feed(official, [burst] * 5, eligible=False))
+    assert official.confidence == 0.0
+
+
+def test_session_baseline():
+    assert session_baseline([1.0, 2.0]) is None
+    assert session_baseline([1.0, 2.0, 3.0, 100.0]) == (2.5, 1.0)
@@ -0,0 +1,62 @@
+import socket
+import threading
+
+import pytest
+
+import Main
+from Main import LatencyProber
+
+
+def icmp_available():
+    for kind in (socket.SOCK_RAW, socket.SOCK_DGRAM):
+        try:
+            socket.socket(socket.AF_INET, kind, socket.IPPROTO_ICMP).close()
+            return True
+        except OSError:
+            pass
+    return False
+
+
+pytestmark = pytest.mark.skipif(not icmp_available(), reason="没有权限打开ICMP套接字")
+
+
+class Replies:
+    def __init__(self):
+        self.items = []
+        self.cond = threading.Condition()
+
+    def __call__(self, ip, rtt):
+        with self.cond:
+            self.items.append((ip, rtt))
+            self.cond.notify_all()
+
+    def wait(self, count, timeout=5):
+        with self.cond:
+            assert self.cond.wait_for(lambda: len(self.items) >= count, timeout)
+        return self.items
+
+
+@pytest.fixture(autouse=True)
+def loopback(monkeypatch):
+    monkeypatch.setattr(Main, 'LOCAL_IP', '127.0.0.1')
+
+
+def test_loopback_probe_and_min_interval():
+    prober = LatencyProber(timeout=2, min_interval=60)
+    replies = Replies()
+    assert prober.probe('127.0.0.1', replies)
+    ip, rtt = replies.wait(1)[0]
+    assert ip == '127.0.0.1'
+    assert rtt is not None and 0 <= rtt < 1000
+    assert not prober.probe('127.0.0.1', replies)  # min_interval 内不重复探测
+    assert not prober.inflight
+
+
+def test_unanswered_probe_times_out_and_frees_inflight():
+    prober = LatencyProber(timeout=0.3, min_interval=0, max_inflight=1)
+    replies = Replies()
+    if not prober.probe('192.0.2.1', replies):  # TEST-NET-1，不会有回包
+        pytest.skip("没有到测试地址的路由")
+    assert not prober.probe('192.0.2.2', replies)  # 等待表已满
+    assert replies.wait(1) == [('192.0.2.1', None)]
+    assert prober.probe('192.0.2.2', replies)
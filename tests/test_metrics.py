@@ -0,0 +1,54 @@
+from types import SimpleNamespace
+
+from Main import PEER_METRICS, format_prometheus, peer_record
+
+
+def make_record(ip, is_chinese=False, location='上海', asn='AS4812 "China Telecom"', **values):
+    peer = SimpleNamespace(ip=ip, location=location, isp='电信', asn_info=asn,
+                           server_type='玩家', is_chinese=is_chinese)
+    stats = {key: 1.0 for _, key, _ in PEER_METRICS}
+    stats.update(values)
+    return peer_record(peer, stats)
+
+
+def parse(text):
+    """返回 {(指标名, 标签): 数值}"""
+    result = {}
+    for line in text.decode('utf-8').splitlines():
+        if line.startswith('#'):
+            continue
+        name_labels, value = line.rsplit(' ', 1)
+        name, _, labels = name_labels.partition('{')
+        result[name, labels.rstrip('}')] = float(value)
+    return result
+
+
+def test_peer_record_masks_chinese_peers():
+    assert make_record('1.2.3.4', is_chinese=True)['ip'] == '1.2.*.*'
+    assert make_record('8.8.8.8')['ip'] == '8.8.8.8'
+
+
+def test_format_prometheus():
+    records = [make_record('8.8.8.8', avg_speed=12.5, avg_lat=None),
+               make_record('1.2.3.4', is_chinese=True, location='a\nb')]
+    text = format_prometheus(records, 1700000000.5)
+    metrics = parse(text)
+    assert metrics['gtao_peers', ''] == 2
+    assert metrics['gtao_snapshot_timestamp_seconds', ''] == 1700000000.5
+
+    label = 'ip="8.8.8.8",location="上海",asn="AS4812 \\"China Telecom\\"",server_type="玩家"'
+    assert metrics['gtao_peer_avg_speed_kbps', label] == 12.5
+    assert ('gtao_peer_latency_ms', label) not in metrics  # 没有数据的指标不输出
+    masked = 'ip="1.2.*.*",location="a\\nb",asn="AS4812 \\"China Telecom\\"",server_type="玩家"'
+    assert metrics['gtao_peer_latency_ms', masked] == 1.0
+    for name, _, _ in PEER_METRICS:
+        assert f"# TYPE {name} gauge" in text.decode('utf-8')
+
+
+def test_masked_duplicates_keep_first_series():
+    records = [make_record('1.2.3.4', is_chinese=True, avg_speed=50.0),
+               make_record('1.2.9.9', is_chinese=True, avg_speed=20.0)]
+    lines = [line for line in format_prometheus(records, 0).decode('utf-8').splitlines()
+             if line.startswith('gtao_peer_avg_speed_kbps{')]
+    assert len(lines) == 1
+    assert lines[0].endswith(' 50')
@@ -0,0 +1,101 @@
+import sys
+from array import array
+
+import pytest
+
+from Main import OfflineGeoDB
+
+TSV = (
+    "16777216\t16777471\t13335\tUS\tCLOUDFLARENET\n"
+    "1.0.1.0\t1.0.3.255\t4134\tCN\tCHINANET\n"
+    "1.0.4.0\t1.0.7.255\t0\tNone\tNot routed\n"
+    "8.8.8.0\t8.8.8.255\t15169\tUS\tGOOGLE\n"
+    "broken line\n"
+)
+CSV = (
+    "network,country,region,city,asn,as_name\n"
+    "52.139.0.0/16,HK,,香港,8075,MICROSOFT\n"
+    "2001:db8::/32,US,,,1,IPV6\n"
+)
+
+
+def load_tsv(tmp_path):
+    path = tmp_path / 'ip2asn-v4.tsv'
+    path.write_text(TSV, encoding='utf-8')
+    db = OfflineGeoDB()
+    assert db.load_text(str(path)) == 3  # AS0 和格式错误的行被跳过
+    return db
+
+
+def check_lookups(db):
+    assert db.lookup('1.0.0.0')['as'] == 'AS13335 CLOUDFLARENET'
+    assert db.lookup('1.0.0.255')['country'] == '美国'
+    cn = db.lookup('1.0.3.255')
+    assert (cn['country'], cn['isp'], cn['as']) == ('中国', 'CHINANET', 'AS4134 CHINANET')
+    assert db.lookup('1.0.4.1') is None  # 未分配
+    assert db.lookup('0.255.255.255') is None  # 第一个区间之前
+    assert db.lookup('8.8.9.0') is None  # 最后一个区间之后
+    assert db.lookup('not an ip') is None
+
+
+def test_tsv_lookup(tmp_path):
+    check_lookups(load_tsv(tmp_path))
+
+
+def test_csv_networks_and_ranges(tmp_path):
+    path = tmp_path / 'ipdb.csv'
+    path.write_text(CSV, encoding='utf-8')
+    db = OfflineGeoDB()
+    assert db.load_text(str(path)) == 1  # IPv6 网段跳过
+    hk = db.lookup('52.139.255.255')
+    assert (hk['country'], hk['city'], hk['as']) == ('香港', '香港', 'AS8075 MICROSOFT')
+
+    path = tmp_path / 'ranges.csv'
+    path.write_text("start,end,country_iso_code,autonomous_system_number,autonomous_system_organization\n"
+                    "10.0.0.0,10.0.0.9,JP,2497,IIJ\n", encoding='utf-8')
+    assert db.load_text(str(path)) == 1
+    assert db.lookup('10.0.0.9')['as'] == 'AS2497 IIJ'
+    assert db.lookup('52.139.0.1') is None  # 重新加载替换旧数据
+
+
+def test_binary_round_trip(tmp_path):
+    path = str(tmp_path / 'ipdb.bin')
+    load_tsv(tmp_path).save(path)
+    db = OfflineGeoDB()
+    assert db.load_binary(path) == 3
+    assert db.mm is not None  # 同字节序直接映射
+    check_lookups(db)
+
+
+def test_binary_with_other_byte_order(tmp_path):
+    """另一种字节序的机器上生成的文件需要翻转后使用"""
+    source = load_tsv(tmp_path)
+    path = str(tmp_path / 'ipdb.bin')
+    source.save(path)
+    data = bytearray(open(path, 'rb').read())
+    header = OfflineGeoDB.HEADER
+    magic, version, little, n, n_records, blob_len = header.unpack_from(data)
+    header.pack_into(data, 0, magic, version, 0 if sys.byteorder == 'little' else 1, n, n_records, blob_len)
+    for i in range(3):
+        start = header.size + i * n * 4
+        swapped = array('I', data[start:start + n * 4])
+        swapped.byteswap()
+        data[start:start + n * 4] = swapped.tobytes()
+    open(path, 'wb').write(bytes(data))
+
+    db = OfflineGeoDB()
+    assert db.load_binary(path) == 3
+    assert db.mm is None
+    assert list(db.starts) == list(source.starts)
+    check_lookups(db)
+
+
+def test_rejects_other_files(tmp_path):
+    path = tmp_path / 'ipdb.bin'
+    path.write_bytes(b'NOTIPDB!' + bytes(32))
+    with pytest.raises(ValueError):
+        OfflineGeoDB().load_binary(str(path))
+
+
+def test_empty_database():
+    assert OfflineGeoDB().lookup('1.1.1.1') is None
@@ -0,0 +1,55 @@
+import time
+
+from Main import FlowTable, PacketStats
+
+R1, R2 = 0x01020304, 0x05060708
+
+
+def test_flow_and_peer_counts():
+    table = FlowTable(PacketStats(capacity=8), capacity=8, idle_timeout=10)
+    now = time.monotonic()
+    table.account(R1, 6672, 6672, 100, True, now)
+    table.account(R1, 6672, 6672, 300, False, now + 0.1)
+    table.account(R1, 6672, 61455, 50, False, now + 0.3)
+    table.account(R2, 6672, 6672, 10, True, now)
+
+    assert table.directions(now + 1) == {R1: (100, 350, 1, 2), R2: (10, 0, 1, 0)}
+    assert table.directions(now + 2) == {}  # 增量已读取
+    assert table.stats.swap() == {R1: 450, R2: 10}
+    packets, jitter, max_gap = table.stats.collect(R1)
+    assert packets == 3
+    assert abs(max_gap - 0.2) < 1e-9
+    assert abs(jitter - 0.1 / 16) < 1e-9
+    assert [(f['local_port'], f['remote_port'], f['rx_bytes']) for f in table.flows(R1)] == \
+        [(6672, 6672, 300), (6672, 61455, 50)]
+
+
+def test_idle_flows_expire_and_slots_are_reused():
+    table = FlowTable(PacketStats(capacity=4), capacity=2, idle_timeout=5)
+    now = time.monotonic()
+    table.account(R1, 1, 1, 10, True, now)
+    table.account(R1, 1, 2, 10, True, now)
+    table.account(R1, 1, 3, 10, True, now)  # 流表已满，只计入远端
+    assert table.dropped == 1
+    assert table.stats.swap() == {R1: 30}
+
+    table.directions(now)
+    table.account(R1, 1, 1, 10, True, now + 4)
+    table.directions(now + 4)
+    assert table.expire(now + 7) == 1  # 1/2 空闲超时，1/1 仍有流量
+    assert [f['remote_port'] for f in table.flows(R1)] == [1]
+    table.account(R1, 1, 3, 10, True, now + 7)
+    assert table.dropped == 1
+
+
+def test_released_peer_is_reallocated():
+    """远端统计槽位回收后，仍在流表中的流重新分配槽位"""
+    stats = PacketStats(capacity=4)
+    table = FlowTable(stats, capacity=4)
+    now = time.monotonic()
+    table.account(R1, 1, 1, 10, True, now)
+    stats.release(R1)
+    stats.record(R2, 5, now)  # 复用 R1 的旧槽位
+    table.account(R1, 1, 1, 20, True, now)
+    assert stats.swap() == {R1: 20, R2: 5}
+
@@ -0,0 +1,79 @@
+import sqlite3
+
+import pytest
+
+import Main
+from Main import PersistentCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """可手动推进的 time.time"""
+    now = [1000.0]
+    monkeypatch.setattr(Main.time, 'time', lambda: now[0])
+    return now
+
+
+def test_ttl_expiry(clock):
+    cache = PersistentCache('geo', ttl=60)
+    cache['1.1.1.1'] = ('北京', 'AS1')
+    clock[0] += 59
+    assert cache.get('1.1.1.1') == ('北京', 'AS1')
+    clock[0] += 1
+    assert '1.1.1.1' not in cache
+    assert cache.get('1.1.1.1', 'missing') == 'missing'
+    assert len(cache) == 0
+
+
+def test_lru_eviction(clock):
+    cache = PersistentCache('geo', ttl=60, max_entries=3)
+    for ip in ['a', 'b', 'c']:
+        cache[ip] = ip
+    assert cache['a'] == 'a'  # a 变为最近使用
+    cache['d'] = 'd'
+    assert list(cache.data) == ['c', 'a', 'd']  # 淘汰最久未使用的 b
+
+
+def test_round_trip_through_sqlite(tmp_path, clock):
+    path = str(tmp_path / 'cache.db')
+    cache = PersistentCache('geo', ttl=60, max_entries=3)
+    assert cache.open(path) == 0
+    for ip in ['a', 'b', 'c', 'd']:  # a 被淘汰，也要从磁盘删除
+        cache[ip] = (ip, 1)
+        clock[0] += 1
+    assert cache['b'] == ('b', 1)  # b 变为最近使用
+    cache.close()
+
+    rows = sqlite3.connect(path).execute("SELECT ip FROM geo ORDER BY last_access").fetchall()
+    assert [ip for ip, in rows] == ['c', 'd', 'b']
+
+    reopened = PersistentCache('geo', ttl=60, max_entries=2)
+    assert reopened.open(path) == 2  # 只加载最近使用的 max_entries 个
+    assert list(reopened.data) == ['d', 'b']  # 保持LRU顺序
+    assert reopened['d'] == ('d', 1)  # JSON 列表还原为元组
+    reopened.close()
+
+
+def test_expired_rows_are_dropped_on_open(tmp_path, clock):
+    path = str(tmp_path / 'cache.db')
+    cache = PersistentCache('dns', ttl=60)
+    cache.open(path)
+    cache['old'] = 'x.example'
+    clock[0] += 30
+    cache['new'] = 'y.example'
+    cache.close()
+
+    clock[0] += 40
+    reopened = PersistentCache('dns', ttl=60)
+    assert reopened.open(path) == 1
+    assert reopened.get('new') == 'y.example'
+    reopened.close()
+    assert sqlite3.connect(path).execute("SELECT COUNT(*) FROM dns").fetchone() == (1,)
+
+
+def test_unreadable_file_falls_back_to_memory(tmp_path, capsys):
+    cache = PersistentCache('geo', ttl=60)
+    assert cache.open(str(tmp_path)) == 0  # 目录不能作为数据库打开
+    cache['a'] = 1
+    assert cache.get('a') == 1
+    cache.close()
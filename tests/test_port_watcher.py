@@ -0,0 +1,84 @@
+import os
+import socket
+from types import SimpleNamespace
+
+import pytest
+
+import Main
+from Main import GamePortWatcher, read_proc_udp_inodes
+
+PROC_UDP = """\
+   sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode ref pointer drops
+  12: 0100007F:1A10 00000000:0000 07 00000000:00000000 00:00000000 00000000  1000        0 4242 2 0000000000000000 0
+  37: 00000000:F00F 00000000:0000 07 00000000:00000000 00:00000000 00000000  1000        0 4343 2 0000000000000000 0
+"""
+PROC_UDP6 = """\
+  sl  local_address                         remote_address                        st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode ref pointer drops
+   5: 00000000000000000000000000000000:1A0B 00000000000000000000000000000000:0000 07 00000000:00000000 00:00000000 00000000  1000        0 4444 2 0000000000000000 0
+"""
+
+needs_proc = pytest.mark.skipif(not os.path.isdir('/proc/self/fd'), reason="需要 /proc")
+
+
+def test_read_proc_udp_inodes(tmp_path):
+    (tmp_path / 'udp').write_text(PROC_UDP)
+    (tmp_path / 'udp6').write_text(PROC_UDP6)
+    paths = (str(tmp_path / 'udp'), str(tmp_path / 'udp6'), str(tmp_path / 'missing'))
+    assert read_proc_udp_inodes(paths) == {4242: 6672, 4343: 61455, 4444: 6667}
+
+
+@needs_proc
+def test_finds_udp_ports_of_process():
+    watcher = GamePortWatcher(())
+    watcher.processes = [SimpleNamespace(pid=os.getpid())]
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        assert port in watcher.ports()
+    assert port not in watcher.ports()
+
+
+@needs_proc
+def test_udp_table_reread_only_for_new_inodes(monkeypatch):
+    calls = []
+    real = Main.read_proc_udp_inodes
+    monkeypatch.setattr(Main, 'read_proc_udp_inodes', lambda: calls.append(1) or real())
+    watcher = GamePortWatcher(())
+    pid = os.getpid()
+
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as udp:
+        udp.bind(('127.0.0.1', 0))
+        port = udp.getsockname()[1]
+        assert port in watcher._proc_ports(pid)
+        reads = len(calls)
+        assert reads >= 1
+        assert port in watcher._proc_ports(pid)
+        assert len(calls) == reads  # 没有新套接字：不重新解析
+
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as tcp:
+            tcp.bind(('127.0.0.1', 0))
+            assert port in watcher._proc_ports(pid)
+            assert len(calls) == reads + 1  # 新inode不在UDP表中，解析一次后记为非UDP
+            assert port in watcher._proc_ports(pid)
+            assert len(calls) == reads + 1
+
+
+def test_refresh_rescans_only_after_processes_exit(monkeypatch):
+    class FakeProcess:
+        def __init__(self, pid, name):
+            self.pid, self.info, self.alive = pid, {'name': name}, True
+
+        def is_running(self):
+            return self.alive
+
+    game, other = FakeProcess(1, 'GTA5.exe'), FakeProcess(2, 'bash')
+    scans = []
+    monkeypatch.setattr(Main.psutil, 'process_iter', lambda attrs: scans.append(1) or iter([game, other]))
+    watcher = GamePortWatcher(['GTA5'])
+
+    assert watcher.refresh() == [game]
+    assert watcher.refresh() == []
+    assert len(scans) == 1
+    game.alive = False  # 游戏重启
+    assert watcher.refresh() == [game]
+    assert len(scans) == 2
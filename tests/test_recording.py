@@ -0,0 +1,135 @@
+import math
+import time
+
+import pytest
+
+from Main import (RECORD_COLUMNS, RECORD_FOOTER, RECORD_INDEX_EVERY, SessionRecorder, SessionRecording,
+                  ip_to_int)
+
+A, B, C = '1.1.1.1', '2.2.2.2', '3.3.3.3'
+
+
+def sample(speed):
+    return (speed,) + (1.0,) * (len(RECORD_COLUMNS) - 1)
+
+
+def write_session(path, frames=100):
+    """A 全程 10 KB/s，B 在第 20~29 个周期 200 KB/s，C 只出现在第二分钟"""
+    recorder = SessionRecorder(str(path), interval=1)
+    base = time.time()
+    for i in range(frames):
+        ips = [ip_to_int(A), ip_to_int(B)]
+        samples = [sample(10.0), sample(200.0 if 20 <= i < 30 else 1.0)]
+        if 60 <= i < 70:
+            ips.append(ip_to_int(C))
+            samples.append((5.0, None, None, None, None))
+        recorder.record(base + 1 + i, ips, samples)
+    recorder.close()
+    return base
+
+
+def check_session(recording, frames=100):
+    assert len(recording.frames) == frames
+    assert recording.frame_times == sorted(recording.frame_times)
+    talkers = dict(recording.top_talkers())
+    assert talkers[A] == pytest.approx(10.0 * frames)
+    assert talkers[B] == pytest.approx(200.0 * 10 + 1.0 * (frames - 10))
+    periods = recording.exceed_periods(B, threshold=100)
+    assert len(periods) == 1
+    start, end, peak = periods[0]
+    assert end - start == pytest.approx(10)
+    assert peak == pytest.approx(200.0)
+    assert recording.exceed_periods('9.9.9.9') == []
+    minute = recording.peers_in_minute(1)
+    assert minute[0][0] == A
+    assert dict(minute)[C] == pytest.approx(50.0)
+    assert C not in dict(recording.peers_in_minute(0))
+
+
+def test_round_trip(tmp_path):
+    path = tmp_path / 'session.rec'
+    write_session(path)
+    recording = SessionRecording(str(path))
+    try:
+        check_session(recording)
+        ids, speeds, latency = recording.frame(recording.frames[65][1], 'speed', 'latency')
+        assert len(ids) == 3
+        assert list(speeds) == [10.0, 1.0, 5.0]
+        assert math.isnan(latency[2])  # None 存为 NaN
+    finally:
+        recording.close()
+
+
+def test_truncated_file_is_scanned(tmp_path):
+    """没有文件尾（程序崩溃）时逐块扫描，写到一半的块被丢弃"""
+    path = tmp_path / 'session.rec'
+    write_session(path)
+    data = path.read_bytes()
+    truncated = tmp_path / 'truncated.rec'
+    truncated.write_bytes(data[:len(data) // 2])
+    recording = SessionRecording(str(truncated))
+    try:
+        assert 0 < len(recording.frames) < 100
+        assert recording.frame_times == sorted(recording.frame_times)
+        assert dict(recording.top_talkers())[A] == pytest.approx(10.0 * len(recording.frames))
+    finally:
+        recording.close()
+
+
+@pytest.mark.parametrize('corrupt', ['self_loop', 'points_at_frame', 'out_of_range'])
+def test_corrupt_index_falls_back_to_scan(tmp_path, corrupt):
+    path = tmp_path / 'session.rec'
+    write_session(path)
+    data = bytearray(path.read_bytes())
+    last_index, dict_offset, magic = RECORD_FOOTER.unpack_from(data, len(data) - RECORD_FOOTER.size)
+    if corrupt == 'self_loop':
+        # 索引块的 prev 指向自己
+        data[last_index + 16:last_index + 24] = last_index.to_bytes(8, 'little')
+    elif corrupt == 'points_at_frame':
+        last_index = SessionRecording(str(path)).frames[0][1]
+    else:
+        dict_offset = len(data) * 2
+    data[len(data) - RECORD_FOOTER.size:] = RECORD_FOOTER.pack(last_index, dict_offset, magic)
+    path.write_bytes(bytes(data))
+
+    recording = SessionRecording(str(path))
+    try:
+        check_session(recording)
+    finally:
+        recording.close()
+
+
+def test_record_after_close_is_ignored(tmp_path):
+    path = tmp_path / 'session.rec'
+    recorder = SessionRecorder(str(path), interval=1)
+    recorder.record(time.time(), [ip_to_int(A)], [sample(1.0)])
+    recorder.close()
+    recorder.record(time.time(), [ip_to_int(B)], [sample(1.0)])
+    recorder.close()
+    recording = SessionRecording(str(path))
+    try:
+        assert len(recording.frames) == 1
+        assert list(recording.ips.values()) == [ip_to_int(A)]
+    finally:
+        recording.close()
+
+
+def test_index_blocks_are_chained(tmp_path):
+    """多个索引块时只沿链表读取，得到的帧与逐块扫描一致"""
+    path = tmp_path / 'session.rec'
+    write_session(path, frames=RECORD_INDEX_EVERY * 3 + 5)
+    recording = SessionRecording(str(path))
+    try:
+        indexed = list(recording.frames)
+        recording.frames = []
+        recording._scan()
+        assert indexed == recording.frames
+    finally:
+        recording.close()
+
+
+def test_rejects_other_files(tmp_path):
+    path = tmp_path / 'other.rec'
+    path.write_bytes(b'x' * 64)
+    with pytest.raises(ValueError):
+        SessionRecording(str(path))
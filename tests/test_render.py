@@ -0,0 +1,25 @@
+from Main import TerminalRenderer, get_str_width
+
+
+def test_frame_fits_without_clipping():
+    frame = [['ab', 'cd'], ['中文']]
+    assert TerminalRenderer.clip(frame, 80, 24) == (frame, False)
+
+
+def test_clip_height_and_width():
+    frame = [['x' * 10, '中' * 10, 'y' * 15, 'z'] for _ in range(30)]
+    clipped, was_clipped = TerminalRenderer.clip(frame, 40, 10)
+    assert was_clipped
+    assert len(clipped) == 9  # 最后一行留空
+    assert '省略 22 行' in clipped[-1][0]
+    for row in clipped[:-1]:
+        assert row[:2] == ['x' * 10, '中' * 10]
+        assert len(row) == 3  # 跨越右边界的单元格截断，之后的丢弃
+        assert row[2].startswith('y' * 7)
+        assert sum(get_str_width(cell) for cell in row) <= 39
+
+
+def test_cell_dropped_when_no_room_left():
+    clipped, was_clipped = TerminalRenderer.clip([['x' * 38, 'yyyy']], 40, 10)
+    assert was_clipped
+    assert clipped == [['x' * 38]]
@@ -0,0 +1,58 @@
+import json
+import os
+
+from Main import ServerRuleIndex, ServerRules
+
+RULES = [
+    {'type': 'A', 'cidrs': ['10.0.0.0/8'], 'domains': ['*.example.com'], 'asns': ['AS100']},
+    {'type': 'B', 'cidrs': ['10.1.0.0/16'], 'ips': ['10.1.2.3'], 'domains': ['cdn.example.com'],
+     'asn_names': ['Akamai']},
+    {'type': 'C', 'cidrs': ['10.0.0.0/8', '10.1.2.0/24'], 'asns': [100]},
+]
+
+
+def test_nested_cidrs_prefer_the_most_specific():
+    index = ServerRuleIndex(RULES)
+    assert index.classify('10.9.9.9', None, None) == 'A'
+    assert index.classify('10.1.9.9', None, None) == 'B'
+    assert index.classify('10.1.2.9', None, None) == 'C'
+    assert index.classify('11.0.0.1', None, None) is None
+    # 拆分后的区间仍然不重叠且有序
+    assert list(index.starts) == sorted(index.starts)
+    assert all(e < s for e, s in zip(index.ends, index.starts[1:]))
+
+
+def test_match_order():
+    index = ServerRuleIndex(RULES)
+    assert index.classify('10.1.2.3', 'www.example.com', None) == 'B'  # 精确IP最优先
+    assert index.classify('10.9.9.9', 'a.cdn.example.com', None) == 'B'  # 域名先于网段，最长后缀
+    assert index.classify('10.9.9.9', 'www.EXAMPLE.com.', None) == 'A'
+    assert index.classify('11.0.0.1', 'example.org', 'AS100 Foo') == 'A'  # ASN号先出现的规则
+    assert index.classify('11.0.0.1', None, 'AS200 AKAMAI-AS') == 'B'
+    assert index.classify('11.0.0.1', 'example.com', None) == 'A'  # 通配规则也匹配域名本身
+    assert index.classify('11.0.0.1', 'example.net', 'AS300') is None
+
+
+def test_rules_file_reload(tmp_path):
+    path = tmp_path / 'rules.json'
+    rules = ServerRules(str(path), defaults=[{'type': 'D', 'ips': ['1.1.1.1']}])
+    assert rules.load() is False  # 文件不存在，保持内置规则
+    assert rules.classify('1.1.1.1', None, None) == 'D'
+
+    path.write_text(json.dumps({'rules': [{'type': 'E', 'cidrs': ['1.1.1.0/24']}]}), encoding='utf-8')
+    assert rules.load() is True
+    assert rules.source == str(path)
+    assert rules.classify('1.1.1.1', None, None) == 'E'
+    assert rules.load() is False  # 没有修改
+
+
+def test_bad_rules_file_keeps_current_rules(tmp_path):
+    path = tmp_path / 'rules.json'
+    path.write_text(json.dumps({'rules': [{'type': 'E', 'cidrs': ['1.1.1.0/24']}]}), encoding='utf-8')
+    rules = ServerRules(str(path), defaults=[])
+    assert rules.load() is True
+
+    path.write_text(json.dumps({'rules': [{'cidrs': ['2.2.2.0/24']}]}), encoding='utf-8')
+    os.utime(path, ns=(0, 1))
+    assert rules.load() is False
+    assert rules.classify('1.1.1.1', None, None) == 'E'
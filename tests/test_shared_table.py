@@ -0,0 +1,97 @@
+import pytest
+
+import Main
+from Main import CaptureCounters, SharedCounterTable
+
+R1, R2, R3 = 0x08080808, 0x01010101, 0x09090909
+
+
+@pytest.fixture
+def tables():
+    """写端创建共享内存，读端按名称打开同一块内存（与主进程/抓包进程的关系相同）"""
+    created = []
+
+    def make(capacity=16):
+        writer = SharedCounterTable(capacity=capacity)
+        reader = SharedCounterTable(writer.name)
+        created.extend((reader, writer))
+        return writer, reader
+
+    yield make
+    for table in created:
+        table.close()
+    for table in created[1::2]:
+        table.unlink()
+
+
+def test_reader_sees_writer_deltas(tables):
+    writer, reader = tables()
+    assert reader.capacity == 16
+    writer.account(R1, 6672, 6672, 100, True, 10.0)
+    writer.account(R1, 6672, 6672, 300, False, 10.1)
+    writer.account(R1, 6672, 6672, 50, False, 10.3)
+    writer.account(R2, 6672, 6672, 10, False, 10.0)
+
+    assert reader.swap() == {R1: 450, R2: 10}
+    assert reader.swap() == {}
+    packets, jitter, max_gap = reader.collect(R1)
+    assert packets == 3
+    assert max_gap == pytest.approx(0.2)
+    assert jitter == pytest.approx(0.1 / 16)
+    assert reader.collect(R1)[0] == 0
+    assert reader.directions(11.0) == {R1: (100, 350, 1, 2), R2: (0, 10, 0, 1)}
+
+    writer.account(R2, 6672, 6672, 5, True, 11.0)
+    assert reader.swap() == {R2: 5}
+    assert reader.directions(12.0) == {R2: (5, 0, 1, 0)}
+
+
+def test_clear_sets_new_baseline(tables):
+    writer, reader = tables()
+    writer.account(R1, 6672, 6672, 100, False, 10.0)
+    reader.clear()
+    writer.account(R1, 6672, 6672, 7, False, 10.5)
+    assert reader.swap() == {R1: 7}
+    assert reader.collect(R1)[0] == 1
+
+
+def test_full_table_resets_and_reader_rebases(tables):
+    writer, reader = tables(capacity=4)  # 用满 3 个槽位后整表清空
+    for remote in (R1, R2, R3):
+        writer.account(remote, 6672, 6672, 100, False, 10.0)
+    assert reader.swap() == {R1: 100, R2: 100, R3: 100}
+    epoch = reader.header[Main.SHM_EPOCH]
+
+    writer.account(0x0A0A0A0A, 6672, 6672, 40, False, 11.0)
+    writer.account(R1, 6672, 6672, 30, False, 11.0)
+    assert reader.header[Main.SHM_EPOCH] == epoch + 1
+    # 新一代的累计值全部是增量，旧远端的基线不再沿用
+    assert reader.swap() == {0x0A0A0A0A: 40, R1: 30}
+    assert reader.collect(R1)[0] == 1
+
+
+def test_opening_foreign_memory_fails():
+    from multiprocessing import shared_memory
+    shm = shared_memory.SharedMemory(create=True, size=4096)
+    try:
+        with pytest.raises(ValueError):
+            SharedCounterTable(shm.name)
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def test_capture_counters_merge_tables(tables):
+    """多网卡时每个抓包线程写一张表，主进程合并读取"""
+    (w1, r1), (w2, r2) = tables(), tables()
+    w1.account(R1, 6672, 6672, 100, False, 10.0)
+    w1.account(R1, 6672, 6672, 100, False, 10.05)
+    w2.account(R1, 6672, 6672, 60, True, 10.0)
+    w2.account(R2, 6672, 6672, 10, False, 10.0)
+
+    counters = CaptureCounters((r1, r2))
+    assert counters.swap() == {R1: 260, R2: 10}
+    assert counters.collect(R1)[0] == 3
+    assert counters.collect(R2)[0] == 1
+    assert counters.directions(11.0) == {R1: (60, 200, 1, 2), R2: (0, 10, 0, 1)}
+    assert counters.swap() == {}
@@ -0,0 +1,44 @@
+from types import SimpleNamespace
+
+import pytest
+
+import Main
+from Main import PEER_METRICS, compact_number, format_peer_cells, format_table_header, get_str_width
+
+# 实际会出现的较大数值（速度/上传/下载/峰值/突发/包速/抖动/断流）
+LARGE = {'avg_speed': 123.4, 'avg_up': 100.0, 'avg_down': 1234.5, 'max_speed': 45678.0, 'max_burst': 12800.0,
+         'avg_pps': 12345.0, 'jitter': 10500.0, 'max_gap': 60000.0}
+
+
+def make_row(**values):
+    peer = SimpleNamespace(ip='8.8.8.8', location='美国 加利福尼亚', is_chinese=False, server_type=None,
+                           isp='AS15169 (谷歌)')
+    stats = {key: 1.0 for _, key, _ in PEER_METRICS}
+    stats.update(is_alive=True, last_seen_sec=0, is_lagger=False, lag_reason='', lag_confidence=0.0)
+    stats.update(values)
+    return peer, stats
+
+
+@pytest.mark.parametrize('value, width, decimals, expected', [
+    (12.34, 5, 1, '12.3'),
+    (123.45, 5, 1, '123.5'),
+    (1234.5, 5, 1, '1234'),
+    (12345.6, 5, 1, '12346'),
+    (123456, 5, 0, '123k'),
+    (123456, 4, 1, '123k'),
+    (98765432, 5, 0, '98.8M'),
+    (0, 4, 0, '0'),
+])
+def test_compact_number(value, width, decimals, expected):
+    assert compact_number(value, width, decimals) == expected
+
+
+def test_cells_line_up_with_header_and_fit(monkeypatch):
+    monkeypatch.setattr(Main, 'capture_interfaces', [])
+    header = [get_str_width(cell) for cell in format_table_header().split(' | ')]
+    for values in ({}, LARGE, dict(LARGE, is_lagger=True, lag_reason='流量异常', lag_confidence=0.9)):
+        cells = format_peer_cells(*make_row(**values))
+        widths = [get_str_width(cell.removesuffix(' | ')) for cell in cells]
+        assert widths == header
+        # 数值列不应被截断成 "xx.."
+        assert not any('..' in Main.ANSI_ESCAPE.sub('', cell) for cell in cells[3:-1])
@@ -0,0 +1,61 @@
+from collections import OrderedDict
+from types import SimpleNamespace
+
+import Main
+from Main import TieredSeries, ip_to_int, query_peer_history
+
+TIERS = ((1, 10), (60, 10), (600, 10))
+
+
+def test_rollups_into_every_tier():
+    series = TieredSeries(TIERS)
+    for t in range(120):
+        series.add(6000 + t, float(t % 60), 50.0 if t % 2 else None)
+
+    width, points = series.query(6110, 6119)
+    assert width == 1
+    assert [p[0] for p in points] == list(range(6110, 6120))
+    assert points[0][1:] == (50.0, 50.0, 50.0, 1)
+
+    width, points = series.query(6000, 6119, resolution=60)
+    assert width == 60
+    assert points == [(6000, 0.0, 29.5, 59.0, 60), (6060, 0.0, 29.5, 59.0, 60)]
+    width, points = series.query(6000, 6119, 'latency', resolution=60)
+    assert points == [(6000, 50.0, 50.0, 50.0, 30), (6060, 50.0, 50.0, 50.0, 30)]  # 缺失的延迟不计数
+
+    width, points = series.query(6000, 6119, resolution=600)
+    assert width == 600
+    assert points == [(6000, 0.0, 29.5, 59.0, 120)]
+
+
+def test_picks_finest_tier_covering_the_window():
+    series = TieredSeries(TIERS)
+    for t in range(0, 1200):
+        series.add(t, 1.0, None)
+    # 原始采样只保留最近 10 秒，1 分钟级保留 600 秒
+    assert series.query(1195, 1199)[0] == 1
+    assert series.query(700, 1199)[0] == 60
+    width, points = series.query(0, 1199)
+    assert width == 600  # 没有一级覆盖起点时用最粗的一级
+    assert [p[0] for p in points] == [0, 600]
+
+
+def test_ring_overwrites_oldest_buckets():
+    series = TieredSeries(((1, 4),))
+    for t in range(10):
+        series.add(t, float(t), None)
+    width, points = series.query(0, 9)
+    assert [(p[0], p[2]) for p in points] == [(6, 6.0), (7, 7.0), (8, 8.0), (9, 9.0)]
+
+
+def test_query_peer_history_covers_live_and_departed_peers(monkeypatch):
+    live, departed = TieredSeries(TIERS), TieredSeries(TIERS)
+    live.add(100, 5.0, 20.0)
+    departed.add(100, 7.0, None)
+    monkeypatch.setattr(Main, 'peers_map', {ip_to_int('8.8.8.8'): SimpleNamespace(timeline=live)})
+    monkeypatch.setattr(Main, 'departed_timelines', OrderedDict({ip_to_int('1.1.1.1'): departed}))
+
+    assert query_peer_history('8.8.8.8', 100, 100) == (1, [(100, 5.0, 5.0, 5.0, 1)])
+    assert query_peer_history('8.8.8.8', 100, 100, 'latency') == (1, [(100, 20.0, 20.0, 20.0, 1)])
+    assert query_peer_history('1.1.1.1', 100, 100) == (1, [(100, 7.0, 7.0, 7.0, 1)])
+    assert query_peer_history('9.9.9.9', 100, 100) is None
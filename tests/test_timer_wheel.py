@@ -0,0 +1,45 @@
+import random
+
+from Main import TimerWheel
+
+
+def test_items_expire_at_their_tick():
+    wheel = TimerWheel(tick=1.0, size=8, levels=3, now=0)
+    wheel.schedule('a', 3)
+    wheel.schedule('b', 5.5)
+    assert wheel.advance(2.9) == []
+    assert wheel.advance(3) == ['a']
+    assert wheel.advance(4.9) == []
+    assert wheel.advance(5) == ['b']
+
+
+def test_past_deadline_fires_on_next_tick():
+    wheel = TimerWheel(tick=1.0, size=8, now=10)
+    wheel.schedule('late', 2)
+    assert wheel.advance(10.5) == []
+    assert wheel.advance(11) == ['late']
+
+
+def test_cascade_from_upper_levels():
+    """超出底层范围的条目经过下放后在正确的刻度到期"""
+    wheel = TimerWheel(tick=1.0, size=4, levels=3, now=0)
+    rng = random.Random(1)
+    deadlines = {i: rng.randrange(1, 200) for i in range(300)}  # 包括超出 4**3 的范围
+    for item, when in deadlines.items():
+        wheel.schedule(item, when)
+
+    fired = {}
+    for t in range(1, 201):
+        for item in wheel.advance(t):
+            fired[item] = t
+    assert fired == deadlines
+
+
+def test_long_jump_returns_everything_due():
+    """长时间没有推进时一次返回所有到期条目，未到期的保留"""
+    wheel = TimerWheel(tick=1.0, size=4, levels=2, now=0)
+    wheel.schedule('soon', 3)
+    wheel.schedule('later', 1000)
+    assert wheel.advance(500) == ['soon']
+    assert wheel.advance(999) == []
+    assert wheel.advance(1000) == ['later']